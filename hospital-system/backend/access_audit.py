@@ -0,0 +1,109 @@
+"""
+Medical Record Access Audit
+Records who read which medical record without adding a write to every read.
+
+Reads are appended to an in-process buffer that is flushed as one multi-row
+INSERT into RecordAccessLog when it reaches FLUSH_SIZE entries or every
+FLUSH_INTERVAL seconds, and at interpreter exit. If the database cannot be
+written, the batch is appended to a rotated local file instead so that no
+entry is lost. The buffer is reset in forked children (e.g. gunicorn
+workers), which start their own flusher.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from flask import current_app, request
+from flask_login import current_user
+
+FLUSH_SIZE = 200
+FLUSH_INTERVAL = 5  # seconds
+# Access entries name patients and users: keep the log in the app's instance folder, not in the source tree
+FALLBACK_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'audit', 'record_access.log')
+
+class AccessAuditBuffer:
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._app = None
+        self._fallback = None
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        # Entries buffered by the parent are the parent's to flush; the child starts empty
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._entries = []
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(self, action, patient_id=None, record_ids=None):
+        """Buffer one entry per record id (or a single entry if none) for the current user and request"""
+        if os.getpid() != self._pid:
+            self._reset()
+        if self._app is None:
+            self._app = current_app._get_current_object()
+
+        now = datetime.utcnow()
+        base = {
+            'user_id': current_user.id,
+            'user_role': current_user.role,
+            'patient_id': patient_id,
+            'action': action,
+            'ip_address': request.remote_addr,
+            'accessed_at': now
+        }
+        entries = [dict(base, record_id=record_id) for record_id in (record_ids or [None])]
+
+        with self._lock:
+            self._entries.extend(entries)
+            full = len(self._entries) >= self.flush_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='access-audit-flusher', daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        pid = os.getpid()
+        while os.getpid() == pid:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all buffered entries; returns the number written"""
+        with self._lock:
+            entries, self._entries = self._entries, []
+        if not entries or self._app is None:
+            return 0
+
+        from models import RecordAccessLog
+
+        try:
+            with self._app.app_context():
+                with current_app.db.engine.begin() as conn:
+                    conn.execute(RecordAccessLog.__table__.insert(), entries)
+        except Exception:
+            self._write_fallback(entries)
+        return len(entries)
+
+    def _write_fallback(self, entries):
+        if self._fallback is None:
+            os.makedirs(os.path.dirname(FALLBACK_LOG), exist_ok=True)
+            self._fallback = logging.getLogger('access_audit.fallback')
+            self._fallback.propagate = False
+            self._fallback.setLevel(logging.INFO)
+            self._fallback.addHandler(RotatingFileHandler(FALLBACK_LOG, maxBytes=10 * 1024 * 1024, backupCount=10))
+        for entry in entries:
+            self._fallback.info(json.dumps(entry, default=str))
+
+# Global access audit buffer
+access_audit = AccessAuditBuffer()
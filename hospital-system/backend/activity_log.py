@@ -0,0 +1,105 @@
+"""
+Ticket and Work Order Activity Log
+Records every creation, assignment, status change, priority change and
+comment as an ActivityEvent row.
+
+Events are added to the session of the change they describe, so they are
+committed (or rolled back) together with it and the log never disagrees with
+the tickets. Feeds read the log by id: a client keeps the id of the last
+event it has seen and asks for the events after it, which is a range scan on
+an index instead of a scan of the ticket and comment tables. SQLite lets one
+writer commit at a time, so ids become visible in order and no event is
+skipped by a cursor.
+"""
+
+from flask import current_app, has_request_context
+from flask_login import current_user
+
+ENTITY_TYPES = ('ticket', 'work_order')
+# field -> event recorded when it changes
+TRACKED_FIELDS = {'assigned_to': 'assigned', 'status': 'status_changed', 'priority': 'priority_changed'}
+SUMMARY_LENGTH = 255
+DEFAULT_FEED_LIMIT = 50
+MAX_FEED_LIMIT = 500
+
+def _current_actor_id():
+    if has_request_context() and current_user and current_user.is_authenticated:
+        return current_user.id
+    return None
+
+def _value(value):
+    return None if value is None else str(value)
+
+def record_event(entity_type, entity_id, event_type, old_value=None, new_value=None, summary=None, actor_id=None):
+    """Add an event to the current transaction; the actor defaults to the logged-in user"""
+    from models import ActivityEvent
+
+    event = ActivityEvent(
+        entity_type=entity_type,
+        entity_id=entity_id,
+        event_type=event_type,
+        actor_id=actor_id if actor_id is not None else _current_actor_id(),
+        old_value=_value(old_value),
+        new_value=_value(new_value),
+        summary=summary[:SUMMARY_LENGTH] if summary else None
+    )
+    current_app.db.session.add(event)
+    return event
+
+def snapshot(entity):
+    """Tracked field values of a ticket or work order, taken before changing it"""
+    return {field: getattr(entity, field) for field in TRACKED_FIELDS}
+
+def record_changes(entity_type, entity, before, actor_id=None):
+    """Record an event for each tracked field that differs from the snapshot"""
+    for field, event_type in TRACKED_FIELDS.items():
+        if getattr(entity, field) != before[field]:
+            record_event(entity_type, entity.id, event_type, before[field], getattr(entity, field), actor_id=actor_id)
+
+def record_created(entity_type, entity, actor_id=None):
+    """Record the creation of a flushed ticket or work order"""
+    return record_event(entity_type, entity.id, 'created', new_value=entity.status, summary=entity.title,
+                        actor_id=actor_id)
+
+def record_comment(entity_type, entity_id, comment, actor_id=None):
+    return record_event(entity_type, entity_id, 'commented', summary=comment, actor_id=actor_id)
+
+def events_since(cursor=0, limit=DEFAULT_FEED_LIMIT, entity_type=None):
+    """Events with an id above cursor, oldest first"""
+    from models import ActivityEvent
+
+    query = ActivityEvent.query.filter(ActivityEvent.id > cursor)
+    if entity_type:
+        query = query.filter(ActivityEvent.entity_type == entity_type)
+    return query.order_by(ActivityEvent.id).limit(min(limit, MAX_FEED_LIMIT)).all()
+
+def recent_events(limit=20):
+    """The latest events, newest first"""
+    from models import ActivityEvent
+
+    return ActivityEvent.query.order_by(ActivityEvent.id.desc()).limit(limit).all()
+
+def serialize_events(events):
+    """Event dicts with actor names and entity titles, loaded in one query each"""
+    from models import User, Ticket, WorkOrder
+
+    db = current_app.db
+    actor_ids = {e.actor_id for e in events if e.actor_id}
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(actor_ids))) if actor_ids else {}
+    titles = {}
+    for entity_type, model in (('ticket', Ticket), ('work_order', WorkOrder)):
+        ids = {e.entity_id for e in events if e.entity_type == entity_type}
+        if ids:
+            titles[entity_type] = dict(db.session.query(model.id, model.title).filter(model.id.in_(ids)))
+    return [{
+        'id': e.id,
+        'entity_type': e.entity_type,
+        'entity_id': e.entity_id,
+        'entity_title': titles.get(e.entity_type, {}).get(e.entity_id),
+        'event_type': e.event_type,
+        'actor': usernames.get(e.actor_id) if e.actor_id else 'system',
+        'old_value': e.old_value,
+        'new_value': e.new_value,
+        'summary': e.summary,
+        'created_at': e.created_at.isoformat() if e.created_at else None
+    } for e in events]
@@ -41,12 +41,27 @@ def load_user(user_id):
 # Create database tables
 with app.app_context():
     db.create_all()
+    from schema_upgrade import upgrade_schema
+    upgrade_schema(db)
+    # The queue only lists ranked tickets; rank those from before triage ranking existed
+    from triage import recompute_triage_ranks
+    recompute_triage_ranks(unranked_only=True)
+    from search_index import init_search_indexes
+    init_search_indexes(db)
     print("Database tables created. Run 'python backend/init_db.py' to populate with sample data.")
 
 # Import routes after app creation to avoid circular imports
 from routes import register_blueprints
 register_blueprints(app)
 
+# Rebuild cached appointment slot grids when doctors change
+from scheduling import schedule_cache
+schedule_cache.watch_doctors()
+
+# Start the SLA breach scheduler with the first request
+from sla_engine import sla_scheduler
+sla_scheduler.init_app(app)
+
 # Initialize appointment models
 from routes.appointment_routes import init_appointment_models
 init_appointment_models(db)
@@ -0,0 +1,153 @@
+"""
+Content-Addressed Attachment Storage
+Stores ticket and work order attachments once per distinct content.
+
+An upload is copied to a temporary file in fixed-size chunks while it is
+hashed with SHA-256, and the copy is abandoned as soon as it passes the size
+limit. The finished file is moved to uploads/blobs/<ab>/<cd>/<hash> (the
+first two hash bytes shard the directories), or discarded if a blob with the
+same hash already exists. StoredBlob.ref_count counts the attachments
+pointing at each blob; the file is removed when the last one is deleted.
+The file is in place before the caller commits, so an upload route that
+fails to commit rolls back and calls remove_blob_file for it.
+
+Downloads are handed to the WSGI server as a file (sendfile where the server
+supports it, or X-Sendfile when USE_X_SENDFILE is set), so large files never
+pass through Python memory.
+"""
+
+import hashlib
+import os
+import tempfile
+from datetime import timezone
+from flask import current_app, send_file
+from sqlalchemy.exc import IntegrityError
+
+BLOB_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads', 'blobs')
+CHUNK_SIZE = 64 * 1024
+# Downscaled JPEG copies stored next to an image blob (see image_previews.py)
+VARIANTS = ('thumbnail', 'preview')
+
+class FileTooLarge(Exception):
+    pass
+
+def blob_path(content_hash):
+    return os.path.join(BLOB_FOLDER, content_hash[:2], content_hash[2:4], content_hash)
+
+def variant_path(path, variant):
+    return f'{path}.{variant}.jpg'
+
+def _stream_to_temp(stream, max_size):
+    """Copy stream to a temporary file next to the blobs; returns (temp path, sha256 hex, size)"""
+    os.makedirs(BLOB_FOLDER, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=BLOB_FOLDER, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLarge(f'File exceeds {max_size // (1024 * 1024)}MB')
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), size
+
+def store_upload(stream, max_size):
+    """Store an upload and take a reference to its blob; returns the StoredBlob.
+
+    The reference is part of the caller's transaction: commit it together
+    with the attachment row that uses it.
+    """
+    from models import StoredBlob
+
+    db = current_app.db
+    temp_path, content_hash, size = _stream_to_temp(stream, max_size)
+    path = blob_path(content_hash)
+    try:
+        # The UPDATE comes first so the transaction is open before the savepoint: pysqlite only
+        # begins one on a write, and a savepoint outside it would commit the new row on release
+        take_reference = db.session.query(StoredBlob).filter_by(content_hash=content_hash)
+        if not take_reference.update({'ref_count': StoredBlob.ref_count + 1}, synchronize_session=False):
+            try:
+                with db.session.begin_nested():
+                    db.session.add(StoredBlob(content_hash=content_hash, size=size, filepath=path, ref_count=1))
+            except IntegrityError:
+                # Stored by a concurrent upload of the same content
+                take_reference.update({'ref_count': StoredBlob.ref_count + 1}, synchronize_session=False)
+        # Replacing an existing blob is harmless (same content) and restores a missing file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    blob = db.session.get(StoredBlob, content_hash)
+    db.session.refresh(blob)
+    return blob
+
+def release_blob(content_hash):
+    """Drop one reference; returns the file path to delete after commit if it was the last one"""
+    from models import StoredBlob
+
+    if not content_hash:
+        return None
+    db = current_app.db
+    db.session.query(StoredBlob).filter_by(content_hash=content_hash)\
+        .update({'ref_count': StoredBlob.ref_count - 1}, synchronize_session=False)
+    blob = db.session.get(StoredBlob, content_hash)
+    db.session.refresh(blob)
+    if blob.ref_count > 0:
+        return None
+    db.session.delete(blob)
+    return blob.filepath
+
+def release_attachment(attachment):
+    """Drop an attachment's hold on its file; returns the file path to delete after commit, if any"""
+    if attachment.content_hash:
+        return release_blob(attachment.content_hash)
+    # Uploaded before content addressing: the file sits under uploads/tickets or uploads/work_orders
+    return attachment.filepath
+
+def remove_blob_file(path):
+    """Delete a file no committed row refers to: after its release commits, or after an upload rolled back"""
+    from models import StoredBlob, TicketAttachment, WorkOrderAttachment
+
+    if not path:
+        return
+    db = current_app.db
+    # The same content may have been uploaded again since it was released
+    if db.session.get(StoredBlob, os.path.basename(path)) is not None:
+        return
+    # Older uploads were named by upload second, so two attachments can share a file
+    if any(db.session.query(model.id).filter(model.filepath == path).first()
+           for model in (TicketAttachment, WorkOrderAttachment)):
+        return
+    for file_path in [path] + [variant_path(path, variant) for variant in VARIANTS]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def send_attachment(attachment, variant=None):
+    """Stream an attachment (or its thumbnail/preview inline) with Range, ETag and Last-Modified support"""
+    if variant and not attachment.content_hash:
+        return None
+    path = variant_path(attachment.filepath, variant) if variant else attachment.filepath
+    if not os.path.exists(path):
+        return None
+    # The content hash is a strong validator; older attachments fall back to size and mtime
+    response = send_file(
+        path,
+        download_name=f"{attachment.filename.rsplit('.', 1)[0]}-{variant}.jpg" if variant else attachment.filename,
+        as_attachment=not variant,
+        conditional=True,
+        etag=(f'{attachment.content_hash}-{variant}' if variant else attachment.content_hash) or True,
+        last_modified=attachment.uploaded_at.replace(tzinfo=timezone.utc) if attachment.uploaded_at else None
+    )
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
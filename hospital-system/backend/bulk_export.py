@@ -0,0 +1,259 @@
+"""
+Bulk NDJSON Export
+Writes Patient, Encounter (medical records), Appointment and Observation
+resources as FHIR-style NDJSON files, one file per resource type, from a
+background thread. Rows are streamed with server-side cursors and written in
+chunks, so memory use does not grow with the size of the export.
+"""
+
+import json
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+
+# Exports hold patient data: keep them in the app's instance folder, next to the database, not in the source tree
+EXPORT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'exports')
+RESOURCE_TYPES = ['Patient', 'Encounter', 'Appointment', 'Observation']
+CHUNK_SIZE = 1000
+
+APPOINTMENT_STATUS_MAP = {
+    'scheduled': 'booked',
+    'confirmed': 'booked',
+    'completed': 'fulfilled',
+    'cancelled': 'cancelled',
+    'no_show': 'noshow'
+}
+
+# (column, code, display, unit)
+VITAL_SIGNS = [
+    ('blood_pressure_systolic', '8480-6', 'Systolic blood pressure', 'mm[Hg]'),
+    ('blood_pressure_diastolic', '8462-4', 'Diastolic blood pressure', 'mm[Hg]'),
+    ('heart_rate', '8867-4', 'Heart rate', '/min'),
+    ('temperature', '8310-5', 'Body temperature', 'Cel'),
+    ('weight', '29463-7', 'Body weight', 'kg'),
+    ('height', '8302-2', 'Body height', 'cm'),
+    ('bmi', '39156-5', 'Body mass index', 'kg/m2')
+]
+
+def format_instant(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ') if value else None
+
+def _meta(updated_at):
+    return {'lastUpdated': format_instant(updated_at)} if updated_at else {}
+
+def _patient_resource(patient):
+    resource = {
+        'resourceType': 'Patient',
+        'id': str(patient.id),
+        'meta': _meta(patient.updated_at),
+        'identifier': [{'system': 'urn:solu-hms:mrn', 'value': patient.medical_record_number}]
+                      if patient.medical_record_number else [],
+        'name': [{'text': patient.name}],
+        'gender': (patient.gender or 'unknown').lower(),
+        'birthDate': patient.date_of_birth.isoformat() if patient.date_of_birth else None,
+        'telecom': [t for t in [
+            {'system': 'phone', 'value': patient.phone} if patient.phone else None,
+            {'system': 'email', 'value': patient.email} if patient.email else None
+        ] if t],
+        'address': [{
+            'text': patient.address,
+            'city': patient.city,
+            'state': patient.state,
+            'postalCode': patient.zip_code
+        }] if patient.address or patient.city else []
+    }
+    return {k: v for k, v in resource.items() if v not in (None, [], {})}
+
+def _encounter_resource(record):
+    resource = {
+        'resourceType': 'Encounter',
+        'id': str(record.id),
+        'meta': _meta(record.updated_at),
+        'status': 'finished',
+        'type': [{'text': record.visit_type}],
+        'subject': {'reference': f'Patient/{record.patient_id}'},
+        'participant': [{'individual': {'reference': f'Practitioner/{record.doctor_id}'}}] if record.doctor_id else [],
+        'period': {'start': record.visit_date.isoformat()},
+        'reasonCode': [{'text': record.chief_complaint}],
+        'diagnosis': [{'condition': {'display': record.diagnosis}}] if record.diagnosis else [],
+        'serviceProvider': {'reference': f'Organization/{record.department_id}'}
+    }
+    return {k: v for k, v in resource.items() if v not in (None, [], {})}
+
+def _appointment_resource(appt):
+    start = datetime.combine(appt.appointment_date, appt.appointment_time)
+    participants = [{'actor': {'reference': f'Patient/{appt.patient_id}'}, 'status': 'accepted'}]
+    if appt.doctor_id:
+        participants.append({'actor': {'reference': f'Practitioner/{appt.doctor_id}'}, 'status': 'accepted'})
+    resource = {
+        'resourceType': 'Appointment',
+        'id': str(appt.id),
+        'meta': _meta(appt.updated_at),
+        'status': APPOINTMENT_STATUS_MAP.get(appt.status, 'booked'),
+        'appointmentType': {'text': appt.appointment_type},
+        'description': appt.reason,
+        'start': start.isoformat(),
+        'end': (start + timedelta(minutes=appt.duration_minutes or 30)).isoformat(),
+        'minutesDuration': appt.duration_minutes or 30,
+        'participant': participants
+    }
+    return {k: v for k, v in resource.items() if v not in (None, [], {})}
+
+def _lab_resource(observation, updated_at):
+    resource = {
+        'resourceType': 'Observation',
+        'id': f'lab-{observation.id}',
+        'meta': _meta(updated_at),
+        'status': 'final',
+        'category': [{'coding': [{'code': 'laboratory'}]}],
+        'code': {'coding': [{'code': observation.analyte}], 'text': observation.analyte_name},
+        'subject': {'reference': f'Patient/{observation.patient_id}'},
+        'encounter': {'reference': f'Encounter/{observation.record_id}'},
+        'effectiveDateTime': observation.visit_date.isoformat()
+    }
+    if observation.value is not None:
+        resource['valueQuantity'] = {'value': observation.value, 'unit': observation.unit}
+    elif observation.value_text:
+        resource['valueString'] = observation.value_text
+    if observation.reference_low is not None or observation.reference_high is not None:
+        resource['referenceRange'] = [{k: {'value': v} for k, v in
+                                       (('low', observation.reference_low), ('high', observation.reference_high))
+                                       if v is not None}]
+    return resource
+
+def _vital_resources(record):
+    for column, code, display, unit in VITAL_SIGNS:
+        value = getattr(record, column)
+        if value is None:
+            continue
+        yield {
+            'resourceType': 'Observation',
+            'id': f'vital-{record.id}-{column}',
+            'meta': _meta(record.updated_at),
+            'status': 'final',
+            'category': [{'coding': [{'code': 'vital-signs'}]}],
+            'code': {'coding': [{'system': 'http://loinc.org', 'code': code, 'display': display}]},
+            'subject': {'reference': f'Patient/{record.patient_id}'},
+            'encounter': {'reference': f'Encounter/{record.id}'},
+            'effectiveDateTime': record.visit_date.isoformat(),
+            'valueQuantity': {'value': value, 'unit': unit}
+        }
+
+def _stream(db, statement):
+    """Iterate ORM rows through a server-side cursor, CHUNK_SIZE rows at a time"""
+    return db.session.execute(statement.execution_options(yield_per=CHUNK_SIZE))
+
+def _iter_resources(resource_type, since):
+    from sqlalchemy import select
+    from models import Appointment, LabObservation, MedicalRecord, Patient
+
+    db = current_app.db
+    if resource_type == 'Patient':
+        statement = select(Patient).order_by(Patient.id)
+        if since:
+            statement = statement.where(Patient.updated_at >= since)
+        for (patient,) in _stream(db, statement):
+            yield _patient_resource(patient)
+
+    elif resource_type == 'Encounter':
+        statement = select(MedicalRecord).order_by(MedicalRecord.id)
+        if since:
+            statement = statement.where(MedicalRecord.updated_at >= since)
+        for (record,) in _stream(db, statement):
+            yield _encounter_resource(record)
+
+    elif resource_type == 'Appointment':
+        statement = select(Appointment).order_by(Appointment.id)
+        if since:
+            statement = statement.where(Appointment.updated_at >= since)
+        for (appt,) in _stream(db, statement):
+            yield _appointment_resource(appt)
+
+    elif resource_type == 'Observation':
+        # Lab results and vital signs both live on the record, so the record's updated_at drives _since
+        statement = select(LabObservation, MedicalRecord.updated_at)\
+            .join(MedicalRecord, LabObservation.record_id == MedicalRecord.id).order_by(LabObservation.id)
+        if since:
+            statement = statement.where(MedicalRecord.updated_at >= since)
+        for observation, updated_at in _stream(db, statement):
+            yield _lab_resource(observation, updated_at)
+
+        statement = select(MedicalRecord).order_by(MedicalRecord.id)
+        if since:
+            statement = statement.where(MedicalRecord.updated_at >= since)
+        for (record,) in _stream(db, statement):
+            yield from _vital_resources(record)
+
+def _write_ndjson(path, resources):
+    """Write resources to path in CHUNK_SIZE batches; the file only appears once complete"""
+    count = 0
+    chunk = []
+    with open(path + '.part', 'w', encoding='utf-8') as f:
+        for resource in resources:
+            chunk.append(json.dumps(resource, separators=(',', ':')))
+            if len(chunk) >= CHUNK_SIZE:
+                f.write('\n'.join(chunk) + '\n')
+                count += len(chunk)
+                chunk = []
+                current_app.db.session.expunge_all()
+        if chunk:
+            f.write('\n'.join(chunk) + '\n')
+            count += len(chunk)
+    os.replace(path + '.part', path)
+    return count
+
+def job_folder(job_id):
+    return os.path.join(EXPORT_FOLDER, str(job_id))
+
+def run_export(job_id):
+    """Run an export job to completion, recording progress and the output manifest on the job row"""
+    from models import ExportJob
+
+    db = current_app.db
+    job = db.session.get(ExportJob, job_id)
+    job.status = 'running'
+    job.started_at = datetime.utcnow()
+    db.session.commit()
+
+    resource_types = json.loads(job.resource_types)
+    since = job.since
+    folder = job_folder(job_id)
+    output = []
+    try:
+        os.makedirs(folder, exist_ok=True)
+        for resource_type in resource_types:
+            count = _write_ndjson(os.path.join(folder, f'{resource_type}.ndjson'), _iter_resources(resource_type, since))
+            output.append({'type': resource_type, 'count': count})
+
+            job = db.session.get(ExportJob, job_id)
+            job.output = json.dumps(output)
+            db.session.commit()
+
+        job = db.session.get(ExportJob, job_id)
+        job.status = 'completed'
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(ExportJob, job_id)
+        job.status = 'failed'
+        job.error_message = str(e)
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+
+def start_export(job_id):
+    """Run the export in a daemon thread with its own app context and session"""
+    app = current_app._get_current_object()
+
+    def worker():
+        with app.app_context():
+            run_export(job_id)
+
+    thread = threading.Thread(target=worker, name=f'export-{job_id}', daemon=True)
+    thread.start()
+    return thread
+
+def delete_export_files(job_id):
+    shutil.rmtree(job_folder(job_id), ignore_errors=True)
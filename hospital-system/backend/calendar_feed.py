@@ -0,0 +1,114 @@
+"""
+iCalendar Feeds for Doctor and Department Schedules
+Renders appointments as .ics and caches each feed behind a version counter
+that appointment writes bump, so unchanged calendars are answered from memory.
+"""
+
+import threading
+from datetime import date, datetime, timedelta
+from flask import current_app
+
+FEED_PAST_DAYS = 30
+FEED_STATUSES = ['scheduled', 'confirmed', 'completed']
+
+def _escape(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _fold(line):
+    """Fold content lines longer than 75 octets (RFC 5545 section 3.1)"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        # Never split inside a multi-byte character
+        while cut > 0 and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode('utf-8'))
+        encoded = encoded[cut:]
+    parts.append(encoded.decode('utf-8'))
+    return '\r\n '.join(parts)
+
+def render_calendar(name, appointments):
+    """Render (appointment, patient_name) pairs as an iCalendar document"""
+    status_map = {'scheduled': 'TENTATIVE', 'confirmed': 'CONFIRMED', 'completed': 'CONFIRMED'}
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//SOLU-HMS//Appointments//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{_escape(name)}'
+    ]
+    for appt, patient_name in appointments:
+        start = datetime.combine(appt.appointment_date, appt.appointment_time)
+        end = start + timedelta(minutes=appt.duration_minutes or 30)
+        stamp = appt.updated_at or appt.created_at or datetime.utcnow()
+        lines.extend([
+            'BEGIN:VEVENT',
+            f'UID:appointment-{appt.id}@solu-hms',
+            f"DTSTAMP:{stamp.strftime('%Y%m%dT%H%M%SZ')}",
+            f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+            f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}",
+            f'SUMMARY:{_escape(f"{appt.appointment_type} - {patient_name}")}',
+            f'DESCRIPTION:{_escape(appt.reason)}',
+            f"STATUS:{status_map.get(appt.status, 'TENTATIVE')}",
+            'END:VEVENT'
+        ])
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+class CalendarFeedCache:
+    """Rendered feeds keyed by ('doctor' | 'department', id).
+
+    Every appointment write bumps the CalendarFeedVersion row of the affected
+    doctor and department in its own transaction. The ETag is derived from
+    that version alone, so a conditional request for an unchanged calendar
+    costs one primary key lookup. Versions live in the database, so every
+    worker sees a write as soon as it commits; each process keeps its own
+    rendered bodies and rebuilds one when the ETag moves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._feeds = {}
+
+    def bump(self, *keys):
+        """Bump the versions of the given feeds within the caller's transaction"""
+        from models import CalendarFeedVersion
+
+        db = current_app.db
+        for scope, scope_id in keys:
+            if not scope_id:
+                continue
+            # In-place increment, so concurrent writers do not lose a bump
+            updated = CalendarFeedVersion.query.filter_by(scope=scope, scope_id=scope_id)\
+                .update({CalendarFeedVersion.version: CalendarFeedVersion.version + 1}, synchronize_session=False)
+            if not updated:
+                db.session.add(CalendarFeedVersion(scope=scope, scope_id=scope_id, version=1))
+                db.session.flush()
+
+    def etag(self, key):
+        from models import CalendarFeedVersion
+
+        version = current_app.db.session.query(CalendarFeedVersion.version)\
+            .filter_by(scope=key[0], scope_id=key[1]).scalar() or 0
+        # The feed window moves daily, so the day is part of the version
+        return f'{key[0]}-{key[1]}-{version}-{date.today().isoformat()}'
+
+    def get(self, key, build, etag=None):
+        """Return (etag, body), rebuilding the body only if the ETag moved"""
+        etag = etag or self.etag(key)
+        with self._lock:
+            cached = self._feeds.get(key)
+        if cached and cached[0] == etag:
+            return cached
+
+        body = build()
+        with self._lock:
+            self._feeds[key] = (etag, body)
+        return etag, body
+
+# Global calendar feed cache instance
+calendar_cache = CalendarFeedCache()
@@ -5,4 +5,8 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///database.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SESSION_COOKIE_SAMESITE = 'None'
-    SESSION_COOKIE_SECURE = False
\ No newline at end of file
+    SESSION_COOKIE_SECURE = False
+    # Reject oversized request bodies while they are read (attachments are limited to 10MB each)
+    MAX_CONTENT_LENGTH = 11 * 1024 * 1024
+    # Let a fronting nginx/Apache send attachment files (X-Sendfile) instead of the app server
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
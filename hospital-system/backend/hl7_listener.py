@@ -0,0 +1,361 @@
+"""
+HL7 v2 ADT Listener
+Accepts ADT A01 (admit), A04 (register) and A08 (update) messages over MLLP
+and upserts them into Patient, keyed on the medical record number in PID-3.
+
+Connection threads only parse and enqueue; a single writer thread applies
+queued messages in batches (up to BATCH_SIZE, or whatever arrived within
+BATCH_WAIT seconds) with one commit per batch, and each sender receives its
+ACK only after the commit that contains its message.
+
+Run the listener:
+    python hl7_listener.py [host] [port]
+Send a sample admission (or an HL7 file) to a running listener:
+    python hl7_listener.py send [host] [port] [file]
+"""
+
+import queue
+import secrets
+import socket
+import socketserver
+import sys
+import threading
+from datetime import date, datetime
+from flask import current_app
+
+MLLP_START = b'\x0b'
+MLLP_END = b'\x1c\r'
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 2575
+BATCH_SIZE = 50
+BATCH_WAIT = 0.5  # seconds
+ACK_TIMEOUT = 30  # seconds a connection waits for its batch to commit
+
+SUPPORTED_EVENTS = {'A01', 'A04', 'A08'}
+GENDER_MAP = {'M': 'Male', 'F': 'Female', 'O': 'Other', 'A': 'Other'}
+
+class HL7ParseError(ValueError):
+    pass
+
+class ADTMessage:
+    """The parts of an ADT message that map onto Patient"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        segments = [s for s in raw.replace('\r\n', '\r').replace('\n', '\r').split('\r') if s.strip()]
+        if not segments or not segments[0].startswith('MSH'):
+            raise HL7ParseError('Message does not start with an MSH segment')
+
+        msh = segments[0]
+        self.field_sep = msh[3]
+        self.component_sep = msh[4] if len(msh) > 4 else '^'
+        self.segments = {}
+        for segment in segments:
+            fields = segment.split(self.field_sep)
+            self.segments.setdefault(fields[0], []).append(fields)
+
+        # MSH-1 is the separator itself, so MSH field n sits at index n - 1
+        header = self.segments['MSH'][0]
+        self.sending_application = self._at(header, 2)
+        self.sending_facility = self._at(header, 3)
+        message_type = self._at(header, 8).split(self.component_sep)
+        self.message_type = message_type[0]
+        self.event = message_type[1] if len(message_type) > 1 else ''
+        self.control_id = self._at(header, 9)
+        self.version = self._at(header, 11) or '2.5'
+
+        if 'PID' not in self.segments and self.message_type == 'ADT':
+            raise HL7ParseError('ADT message has no PID segment')
+
+    @staticmethod
+    def _at(fields, index):
+        return fields[index] if len(fields) > index else ''
+
+    def field(self, segment, index, component=1):
+        """Value of segment-index.component (1-based as in the spec), first repetition only"""
+        rows = self.segments.get(segment)
+        if not rows:
+            return None
+        value = self._at(rows[0], index).split('~')[0]
+        parts = value.split(self.component_sep)
+        value = parts[component - 1] if len(parts) >= component else ''
+        return value.replace('\\T\\', '&').replace('\\S\\', '^').replace('\\F\\', '|').strip() or None
+
+    @property
+    def medical_record_number(self):
+        return self.field('PID', 3)
+
+    def patient_fields(self):
+        """Patient columns carried by the message; absent HL7 fields are left out so they do not blank data"""
+        fields = {}
+        family, given = self.field('PID', 5, 1), self.field('PID', 5, 2)
+        if family or given:
+            fields['name'] = ' '.join(p for p in [given, family] if p)
+
+        birth = self.field('PID', 7)
+        if birth and len(birth) >= 8:
+            try:
+                fields['date_of_birth'] = datetime.strptime(birth[:8], '%Y%m%d').date()
+            except ValueError:
+                pass
+        if 'date_of_birth' in fields:
+            dob, today = fields['date_of_birth'], date.today()
+            fields['age'] = today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
+
+        # U (unknown) and unmapped codes keep the stored gender
+        gender = GENDER_MAP.get((self.field('PID', 8) or '').upper())
+        if gender:
+            fields['gender'] = gender
+
+        for column, component in [('address', 1), ('city', 3), ('state', 4), ('zip_code', 5)]:
+            value = self.field('PID', 11, component)
+            if value:
+                fields[column] = value
+        phone = self.field('PID', 13, 1)
+        if phone:
+            fields['phone'] = phone[:20]
+        email = self.field('PID', 13, 4)
+        if email:
+            fields['email'] = email
+
+        # NK1 = next of kin
+        for column, index, component in [('emergency_contact_name', 2, 1), ('emergency_contact_phone', 5, 1),
+                                         ('emergency_contact_relationship', 3, 2)]:
+            value = self.field('NK1', index, component)
+            if value:
+                fields[column] = value
+        if fields.get('emergency_contact_name') and self.field('NK1', 2, 2):
+            fields['emergency_contact_name'] = f"{self.field('NK1', 2, 2)} {fields['emergency_contact_name']}"
+
+        allergies = [self._allergy(row) for row in self.segments.get('AL1', [])]
+        if any(allergies):
+            fields['allergies'] = ', '.join(a for a in allergies if a)
+
+        # PV1-44 = admit date/time
+        admitted = self.field('PV1', 44)
+        if self.event == 'A01' and admitted and len(admitted) >= 8:
+            try:
+                fields['admission_date'] = datetime.strptime(admitted[:8], '%Y%m%d').date()
+            except ValueError:
+                pass
+        return fields
+
+    def _allergy(self, row):
+        allergen = self._at(row, 3).split(self.component_sep)
+        return (allergen[1] if len(allergen) > 1 and allergen[1] else allergen[0]).strip()
+
+def build_ack(message, code, text=None):
+    """Build an ACK for message ('AA' accepted, 'AE' error, 'AR' rejected)"""
+    stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    sep = message.field_sep if message else '|'
+    comp = message.component_sep if message else '^'
+    control_id = message.control_id if message else ''
+    event = message.event if message else ''
+    version = message.version if message else '2.5'
+    segments = [
+        sep.join(['MSH', f'{comp}~\\&', 'SOLU-HMS', 'HOSPITAL',
+                  message.sending_application if message else '', message.sending_facility if message else '',
+                  stamp, '', f'ACK{comp}{event}', f'ACK{stamp}{secrets.token_hex(2)}', 'P', version]),
+        sep.join(['MSA', code, control_id] + ([text.replace(sep, ' ')] if text else []))
+    ]
+    return '\r'.join(segments) + '\r'
+
+def apply_adt_message(message):
+    """Upsert the patient described by message into the current session (no commit)"""
+    from models import Patient, User
+    from patient_summary import refresh_patient_summary
+
+    db = current_app.db
+    mrn = message.medical_record_number
+    if not mrn:
+        raise HL7ParseError('PID-3 (medical record number) is required')
+
+    fields = message.patient_fields()
+    patient = Patient.query.filter_by(medical_record_number=mrn).first()
+    if not patient:
+        if not fields.get('name'):
+            raise HL7ParseError('PID-5 (patient name) is required for a new patient')
+        # Registered patients get a login they can claim later. The hash is deliberately
+        # unusable until a password is set, and skipping the key derivation keeps the writer fast.
+        user = User(username=f'mrn-{mrn.lower()}@patients.hospital', role='patient', password_hash='!unusable')
+        db.session.add(user)
+        db.session.flush()
+        patient = Patient(user_id=user.id, medical_record_number=mrn, name=fields['name'])
+        db.session.add(patient)
+
+    for column, value in fields.items():
+        setattr(patient, column, value)
+    db.session.flush()
+    refresh_patient_summary(patient.id, 'profile')
+    return patient
+
+class ADTBatchWriter:
+    """Single writer thread that commits queued ADT messages in batches"""
+
+    def __init__(self, app, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT):
+        self.app = app
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='hl7-batch-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+
+    def submit(self, message):
+        """Queue a message and block until its batch has committed; returns (ack code, text)"""
+        pending = {'message': message, 'done': threading.Event(), 'result': ('AE', 'Timed out waiting for commit')}
+        self._queue.put(pending)
+        pending['done'].wait(ACK_TIMEOUT)
+        return pending['result']
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.batch_wait)]
+        except queue.Empty:
+            return []
+        deadline = datetime.utcnow().timestamp() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - datetime.utcnow().timestamp()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with self.app.app_context():
+            while not (self._stopping.is_set() and self._queue.empty()):
+                batch = self._next_batch()
+                if batch:
+                    self._write(batch)
+
+    def _write(self, batch):
+        db = self.app.db
+        try:
+            for pending in batch:
+                apply_adt_message(pending['message'])
+            db.session.commit()
+            results = [('AA', None)] * len(batch)
+        except Exception:
+            # Fall back to one transaction per message so one bad message cannot reject the batch
+            db.session.rollback()
+            results = []
+            for pending in batch:
+                try:
+                    apply_adt_message(pending['message'])
+                    db.session.commit()
+                    results.append(('AA', None))
+                except HL7ParseError as e:
+                    db.session.rollback()
+                    results.append(('AR', str(e)))
+                except Exception as e:
+                    db.session.rollback()
+                    results.append(('AE', str(e)))
+        finally:
+            db.session.remove()
+
+        for pending, result in zip(batch, results):
+            pending['result'] = result
+            pending['done'].set()
+
+class MLLPHandler(socketserver.BaseRequestHandler):
+    """Reads MLLP frames from one connection and answers each with an ACK"""
+
+    def handle(self):
+        buffer = b''
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buffer += data
+            while MLLP_END in buffer:
+                frame, buffer = buffer.split(MLLP_END, 1)
+                start = frame.find(MLLP_START)
+                if start != -1:
+                    frame = frame[start + 1:]
+                ack = self.server.process(frame.decode('utf-8', errors='replace'))
+                self.request.sendall(MLLP_START + ack.encode('utf-8') + MLLP_END)
+
+class MLLPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, app, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        super().__init__((host, port), MLLPHandler)
+        self.writer = ADTBatchWriter(app)
+
+    def process(self, raw):
+        try:
+            message = ADTMessage(raw)
+        except (HL7ParseError, IndexError, KeyError) as e:
+            return build_ack(None, 'AR', f'Unparseable message: {e}')
+
+        if message.message_type != 'ADT' or message.event not in SUPPORTED_EVENTS:
+            return build_ack(message, 'AR', f'Unsupported message type {message.message_type}^{message.event}')
+        if not message.medical_record_number:
+            return build_ack(message, 'AR', 'PID-3 (medical record number) is required')
+
+        code, text = self.writer.submit(message)
+        return build_ack(message, code, text)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.writer.start()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.writer.stop()
+
+def send_message(raw, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=ACK_TIMEOUT + 5):
+    """Send one HL7 message over MLLP and return the ACK text (test sender)"""
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        conn.sendall(MLLP_START + raw.replace('\n', '\r').encode('utf-8') + MLLP_END)
+        buffer = b''
+        while MLLP_END not in buffer:
+            data = conn.recv(65536)
+            if not data:
+                break
+            buffer += data
+    return buffer.split(MLLP_END, 1)[0].lstrip(MLLP_START).decode('utf-8')
+
+SAMPLE_ADT_A01 = '\r'.join([
+    'MSH|^~\\&|ADMIT|HOSPITAL|SOLU-HMS|HOSPITAL|{stamp}||ADT^A01|{control}|P|2.5',
+    'EVN|A01|{stamp}',
+    'PID|1||MRN900^^^HOSPITAL^MR||Otieno^Grace||19880412|F|||12 River Rd^^Nairobi^Nairobi County^00100||+254700000900^^^grace.otieno@email.com',
+    'NK1|1|Otieno^Peter|^Spouse|||+254700000901',
+    'PV1|1|I|WARD-A^101^1' + '|' * 41 + '{stamp}',
+    'AL1|1|DA|^Penicillin'
+])
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'send':
+        host = args[1] if len(args) > 1 else DEFAULT_HOST
+        port = int(args[2]) if len(args) > 2 else DEFAULT_PORT
+        if len(args) > 3:
+            with open(args[3], encoding='utf-8') as f:
+                raw = f.read()
+        else:
+            stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+            raw = SAMPLE_ADT_A01.format(stamp=stamp, control=f'MSG{stamp}')
+        print(send_message(raw, host, port).replace('\r', '\n'))
+    else:
+        from app import app
+
+        host = args[0] if args else DEFAULT_HOST
+        port = int(args[1]) if len(args) > 1 else DEFAULT_PORT
+        server = MLLPServer(app, host, port)
+        print(f"HL7 ADT listener on {host}:{port} (batch size {BATCH_SIZE}, wait {BATCH_WAIT}s)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,149 @@
+"""
+Image Attachment Previews
+Generates a small thumbnail and a web-sized preview for every image blob,
+stored next to the original as <hash>.thumbnail.jpg and <hash>.preview.jpg,
+so ticket and work order views do not download full-resolution photos.
+
+Uploads only queue the work: a small thread pool decodes and downscales the
+image after the upload has been committed. Blobs are content-addressed, so
+an image attached to several tickets is processed once.
+
+Pillow is optional; without it no previews are generated and images are
+only available at full size. Generate missing previews with:
+    python image_previews.py
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from attachment_storage import variant_path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+IMAGE_TYPES = {'png', 'jpg', 'jpeg', 'gif'}
+# variant -> (bounding box, JPEG quality); generated largest first
+VARIANT_SIZES = {
+    'preview': ((1280, 1280), 82),
+    'thumbnail': ((320, 320), 75),
+}
+MAX_WORKERS = 2
+
+def previews_available():
+    return Image is not None
+
+def mark_for_previews(blob, file_type):
+    """Queue previews for a newly stored image blob; call before committing the upload"""
+    if previews_available() and file_type in IMAGE_TYPES and blob.preview_status is None:
+        blob.preview_status = 'pending'
+
+def _flatten(image):
+    # JPEG has no alpha channel: put transparent images on white rather than black
+    # Palette, greyscale and RGB images can mark a transparent colour instead of having an alpha channel
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB') if image.mode != 'RGB' else image
+
+def render_previews(path):
+    """Write every variant of the image at path; raises if it cannot be decoded"""
+    largest = max(size for size, _ in VARIANT_SIZES.values())
+    with Image.open(path) as original:
+        # Let the JPEG decoder downscale while decoding instead of decoding every pixel
+        original.draft('RGB', largest)
+        image = _flatten(ImageOps.exif_transpose(original))
+        image.load()
+
+    for variant, (size, quality) in VARIANT_SIZES.items():
+        # Each variant is downscaled from the previous, larger one
+        image.thumbnail(size, Image.LANCZOS)
+        target = variant_path(path, variant)
+        image.save(target + '.part', 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.replace(target + '.part', target)
+
+def generate_previews(content_hash):
+    """Generate previews for one pending blob; returns the resulting status"""
+    from models import StoredBlob
+
+    db = current_app.db
+    blob = db.session.get(StoredBlob, content_hash)
+    if not blob or blob.preview_status != 'pending':
+        return blob.preview_status if blob else None
+    try:
+        render_previews(blob.filepath)
+        blob.preview_status = 'ready'
+    except Exception:
+        current_app.logger.exception('Could not generate previews for blob %s', content_hash)
+        blob.preview_status = 'failed'
+    db.session.commit()
+    return blob.preview_status
+
+class PreviewWorker:
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Pool threads do not survive a fork; children start their own pool
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, content_hash):
+        """Generate previews for a committed blob in the background"""
+        if not previews_available():
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='image-previews')
+        return self._executor.submit(self._run, current_app._get_current_object(), content_hash)
+
+    def _run(self, app, content_hash):
+        with app.app_context():
+            return generate_previews(content_hash)
+
+# Global preview worker pool, started on first use
+preview_worker = PreviewWorker()
+
+def ready_previews(content_hashes):
+    """Return the subset of content hashes whose previews are ready"""
+    from models import StoredBlob
+
+    content_hashes = {h for h in content_hashes if h}
+    if not content_hashes:
+        return set()
+    rows = current_app.db.session.query(StoredBlob.content_hash)\
+        .filter(StoredBlob.content_hash.in_(content_hashes), StoredBlob.preview_status == 'ready')
+    return {row[0] for row in rows}
+
+def generate_missing_previews():
+    """Queue image blobs that never got previews (e.g. uploaded before Pillow was installed) and process them"""
+    from models import StoredBlob, TicketAttachment, WorkOrderAttachment
+
+    db = current_app.db
+    image_hashes = set()
+    for model in (TicketAttachment, WorkOrderAttachment):
+        image_hashes.update(row[0] for row in db.session.query(model.content_hash)
+                            .filter(model.content_hash.isnot(None), model.file_type.in_(IMAGE_TYPES)))
+    for blob in StoredBlob.query.filter(StoredBlob.content_hash.in_(image_hashes), StoredBlob.preview_status.is_(None)):
+        blob.preview_status = 'pending'
+    db.session.commit()
+
+    pending = [row[0] for row in db.session.query(StoredBlob.content_hash).filter_by(preview_status='pending')]
+    return {content_hash: generate_previews(content_hash) for content_hash in pending}
+
+if __name__ == '__main__':
+    from app import app
+
+    if not previews_available():
+        raise SystemExit('Pillow is not installed: pip install Pillow')
+    with app.app_context():
+        results = generate_missing_previews()
+        ready = sum(1 for status in results.values() if status == 'ready')
+        print(f"Generated previews for {ready} of {len(results)} images")
@@ -6,12 +6,16 @@ from models import User, Department, WorkOrder, Technician, Equipment, Patient,
 import json
 from werkzeug.security import generate_password_hash
 from datetime import datetime, timedelta
+from search_index import init_search_indexes
+from triage import update_triage_rank
+from sla_engine import update_sla
 
 def init_database():
     with app.app_context():
         # Drop all tables and recreate
         db.drop_all()
         db.create_all()
+        init_search_indexes(db)
 
         print("Creating sample users...")
 
@@ -282,7 +286,10 @@ def init_database():
 
         for ticket_data in tickets_data:
             ticket = Ticket(**ticket_data)
+            update_triage_rank(ticket)
             db.session.add(ticket)
+            db.session.flush()
+            update_sla(ticket)
 
         db.session.commit()
 
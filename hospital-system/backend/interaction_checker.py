@@ -0,0 +1,183 @@
+"""
+Prescription Interaction Checker
+Checks new prescriptions against each other, the patient's current
+medications and their allergies, using the local dataset in
+data/drug_interactions.json.
+
+The dataset is indexed once at import: interactions by frozenset of the two
+canonical drug names, and allergies as allergen -> drugs to avoid, so a check
+is a handful of dictionary lookups per medication pair.
+"""
+
+import json
+import os
+import re
+from itertools import combinations
+
+DATASET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'drug_interactions.json')
+SEVERITY_ORDER = {'contraindicated': 0, 'major': 1, 'moderate': 2, 'minor': 3}
+MAX_PHRASE_WORDS = 3
+NONE_VALUES = {'none', 'nil', 'nka', 'nkda', 'n/a', 'no known allergies', 'no known drug allergies'}
+# Reaction notes recorded with an allergy: "(rash)", "[2019]", or anything after a spaced dash
+ALLERGY_NOTE = re.compile(r'\([^)]*\)|\[[^\]]*\]|\s[-\u2013\u2014:]\s.*$')
+
+# (prescribed, recorded allergy, expected top severity or None); run with: python interaction_checker.py
+SELF_CHECK_CASES = [
+    ('Amoxicillin 500mg', 'Penicillin', 'contraindicated'),
+    ('Amoxicillin 500mg', 'Penicillin (rash)', 'contraindicated'),
+    ('Amoxicillin 500mg', 'Penicillin allergy', 'contraindicated'),
+    ('Amoxicillin 500mg', 'penicillin - anaphylaxis', 'contraindicated'),
+    ('Amoxil 500mg tds', 'Allergic to penicillins', 'contraindicated'),
+    ('Bactrim DS', 'Sulfa drugs', 'contraindicated'),
+    ('Keflex 500mg', 'Penicillin (hives)', 'moderate'),
+    ('Advil 400mg', 'NSAIDs - wheeze', 'contraindicated'),
+    ('Co-trimoxazole 960mg', 'Latex', None),
+]
+
+def _key(text):
+    return re.sub(r'\s+', ' ', re.sub(r'[^a-z0-9\- ]', ' ', text.lower())).strip()
+
+class InteractionIndex:
+    def __init__(self, path=DATASET_PATH):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+
+        self.aliases = {_key(alias): name for alias, name in data.get('aliases', {}).items()}
+        self.pairs = {}
+        for item in data.get('interactions', []):
+            first, second = item['drugs']
+            self.pairs[frozenset((first, second))] = (item['severity'], item['description'])
+        self.known_drugs = {name for pair in self.pairs for name in pair} | set(self.aliases.values())
+
+        # allergen (class or drug) -> {drug: (severity, description)}
+        classes = data.get('allergy_classes', {})
+        self.allergy_aliases = {_key(alias): name for alias, name in data.get('allergy_aliases', {}).items()}
+        self.avoid = {}
+        for class_name, members in classes.items():
+            self.known_drugs.update(members)
+            reaction = {drug: ('contraindicated', f'Patient is allergic to {class_name}s.') for drug in members}
+            self.avoid.setdefault(class_name, {}).update(reaction)
+            # An allergy to one member implies the whole class
+            for drug in members:
+                self.avoid.setdefault(drug, {}).update(reaction)
+        for cross in data.get('cross_reactions', []):
+            reaction = {drug: (cross['severity'], cross['description']) for drug in classes.get(cross['class'], [])}
+            for allergen in [cross['allergy']] + classes.get(cross['allergy'], []):
+                for drug, warning in reaction.items():
+                    self.avoid.setdefault(allergen, {}).setdefault(drug, warning)
+
+    def _phrase(self, words, aliases, names):
+        """The longest phrase of up to MAX_PHRASE_WORDS words that is an alias or a known name, leftmost first"""
+        for size in range(min(MAX_PHRASE_WORDS, len(words)), 0, -1):
+            for start in range(len(words) - size + 1):
+                phrase = ' '.join(words[start:start + size])
+                for alias_map in aliases:
+                    if phrase in alias_map:
+                        return alias_map[phrase]
+                if phrase in names:
+                    return phrase
+        return None
+
+    def canonical(self, medication):
+        """Map free text such as "Amoxil 500mg tds" to a canonical drug name (or its first word)"""
+        words = _key(medication).split()
+        return self._phrase(words, [self.aliases], self.known_drugs) or (words[0] if words else None)
+
+    def allergen(self, allergy):
+        """Map free text such as "Penicillin (rash)" or "Sulfa drugs" to an allergen class or drug name"""
+        key = _key(ALLERGY_NOTE.sub(' ', allergy))
+        return self._phrase(key.split(), [self.allergy_aliases, self.aliases], self.avoid.keys() | self.known_drugs) or key
+
+    def check(self, prescribed, current_medications=None, allergies=None):
+        """Return warnings for prescribed medication names.
+
+        Pairs within the new prescriptions and between new and current
+        medications are looked up in the pair index; every new medication is
+        looked up against each recorded allergen.
+        """
+        new = {}
+        for medication in prescribed:
+            name = self.canonical(medication)
+            if name:
+                new.setdefault(name, medication)
+        current = {}
+        for medication in split_list(current_medications):
+            name = self.canonical(medication)
+            if name:
+                current.setdefault(name, medication)
+
+        warnings = []
+        checked = set()
+        pairs = list(combinations(new, 2)) + [(a, b) for a in new for b in current if a != b]
+        for first, second in pairs:
+            pair = frozenset((first, second))
+            if pair in checked:
+                continue
+            checked.add(pair)
+            found = self.pairs.get(pair)
+            if found:
+                warnings.append({
+                    'type': 'interaction',
+                    'severity': found[0],
+                    'medications': [new[first], new.get(second) or current[second]],
+                    'message': found[1]
+                })
+
+        for name in new:
+            if name in current:
+                warnings.append({
+                    'type': 'duplicate',
+                    'severity': 'moderate',
+                    'medications': [new[name], current[name]],
+                    'message': f'{new[name]} duplicates a current medication.'
+                })
+
+        for allergy in split_list(allergies):
+            allergen = self.allergen(allergy)
+            reactions = self.avoid.get(allergen, {})
+            for name, medication in new.items():
+                if name in reactions or name == allergen:
+                    severity, message = reactions.get(name, ('contraindicated', f'Patient is allergic to {allergy}.'))
+                    warnings.append({
+                        'type': 'allergy',
+                        'severity': severity,
+                        'medications': [medication],
+                        'allergy': allergy,
+                        'message': message
+                    })
+
+        warnings.sort(key=lambda w: SEVERITY_ORDER.get(w['severity'], len(SEVERITY_ORDER)))
+        return warnings
+
+def split_list(text):
+    """Split a free-text list ("Lisinopril 10mg daily, Metformin") into entries, ignoring "None" values"""
+    if not text:
+        return []
+    if isinstance(text, (list, tuple)):
+        items = [str(item) for item in text]
+    else:
+        items = re.split(r'[,;\n]+', str(text))
+    return [item.strip() for item in items if item.strip() and item.strip().lower() not in NONE_VALUES]
+
+# Global interaction index, built once at startup
+interaction_index = InteractionIndex()
+
+def check_prescriptions(prescription_lines, patient):
+    """Check parsed prescription lines against a patient's current medications and allergies"""
+    medications = [line['medication'] for line in prescription_lines]
+    if not medications:
+        return []
+    return interaction_index.check(medications,
+                                   patient.current_medications if patient else None,
+                                   patient.allergies if patient else None)
+
+if __name__ == '__main__':
+    failures = 0
+    for prescribed, allergy, expected in SELF_CHECK_CASES:
+        warnings = [w for w in interaction_index.check([prescribed], allergies=allergy) if w['type'] == 'allergy']
+        severity = warnings[0]['severity'] if warnings else None
+        if severity != expected:
+            failures += 1
+            print(f"FAIL {prescribed!r} with allergy {allergy!r}: expected {expected}, got {severity}")
+    print(f"{len(SELF_CHECK_CASES) - failures} of {len(SELF_CHECK_CASES)} allergy checks passed")
+    raise SystemExit(1 if failures else 0)
@@ -22,10 +22,25 @@ TicketTemplate = None
 Workflow = None
 WorkflowStep = None
 WorkflowExecution = None
+SystemSetting = None
+ScheduleTemplate = None
+AppointmentReminder = None
+WaitlistEntry = None
+AppointmentRollup = None
+LabObservation = None
+PrescriptionLine = None
+PatientSummary = None
+ExportJob = None
+RecordAccessLog = None
+DuplicateCandidate = None
+StoredBlob = None
+ActivityEvent = None
+SlaPolicy = None
+CalendarFeedVersion = None
 
 def init_models(db):
     """Initialize models after app creation"""
-    global User, Department, WorkOrder, Technician, WorkOrderComment, WorkOrderAttachment, Equipment, Ticket, TicketComment, TicketAttachment, Patient, Appointment, Doctor, Notification, Casual, MedicalRecord, TicketTemplate, Workflow, WorkflowStep, WorkflowExecution
+    global User, Department, WorkOrder, Technician, WorkOrderComment, WorkOrderAttachment, Equipment, Ticket, TicketComment, TicketAttachment, Patient, Appointment, Doctor, Notification, Casual, MedicalRecord, TicketTemplate, Workflow, WorkflowStep, WorkflowExecution, SystemSetting, ScheduleTemplate, AppointmentReminder, WaitlistEntry, AppointmentRollup, LabObservation, PrescriptionLine, PatientSummary, ExportJob, RecordAccessLog, DuplicateCandidate, StoredBlob, ActivityEvent, SlaPolicy, CalendarFeedVersion
 
     class User(db.Model, UserMixin):
         id = db.Column(db.Integer, primary_key=True)
@@ -92,6 +107,7 @@ def init_models(db):
         filepath = db.Column(db.String(500), nullable=False)
         file_type = db.Column(db.String(50), nullable=False)
         file_size = db.Column(db.Integer, nullable=False)  # in bytes
+        content_hash = db.Column(db.String(64), db.ForeignKey('stored_blob.content_hash'), nullable=True, index=True)
         uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
         uploaded_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
@@ -109,13 +125,13 @@ def init_models(db):
         department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
         doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=True)
         scheduled_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-        appointment_date = db.Column(db.Date, nullable=False)
+        appointment_date = db.Column(db.Date, nullable=False, index=True)
         appointment_time = db.Column(db.Time, nullable=False)
         duration_minutes = db.Column(db.Integer, default=30)
         appointment_type = db.Column(db.String(100), nullable=False)
         reason = db.Column(db.Text, nullable=False)
         notes = db.Column(db.Text, nullable=True)
-        status = db.Column(db.String(50), default='scheduled')  # scheduled, confirmed, completed, cancelled
+        status = db.Column(db.String(50), default='scheduled')  # scheduled, confirmed, completed, cancelled, no_show
         priority = db.Column(db.String(20), default='normal')  # low, normal, high, urgent
         created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
         updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
@@ -179,6 +195,11 @@ def init_models(db):
         created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
         updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
+        # Keyset pagination of the patient directory
+        __table_args__ = (
+            db.Index('ix_patient_name', 'name', 'id'),
+        )
+
     class Ticket(db.Model):
         id = db.Column(db.Integer, primary_key=True)
         title = db.Column(db.String(150), nullable=False)
@@ -199,6 +220,26 @@ def init_models(db):
         created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
         updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
         resolved_at = db.Column(db.DateTime, nullable=True)
+        duplicate_of_id = db.Column(db.Integer, db.ForeignKey('ticket.id'), nullable=True)  # Set when filed as a duplicate of an open ticket
+        # Resolution deadline from the matching SlaPolicy (see sla_engine.py)
+        sla_policy_id = db.Column(db.Integer, db.ForeignKey('sla_policy.id'), nullable=True)
+        sla_warning_at = db.Column(db.DateTime, nullable=True)
+        sla_due_at = db.Column(db.DateTime, nullable=True)
+        sla_status = db.Column(db.String(20), nullable=True)  # pending, warning, breached, met
+        # Queue order, lowest first: creation time minus the urgency bonus (see triage.py)
+        triage_rank = db.Column(db.Integer, nullable=True)
+
+        __table_args__ = (
+            # The breach scheduler loads the deadlines of active SLAs through these
+            db.Index('ix_ticket_sla_warning', 'sla_status', 'sla_warning_at'),
+            db.Index('ix_ticket_sla_due', 'sla_status', 'sla_due_at'),
+            # Triage queues, overall, per department and per category (skill)
+            db.Index('ix_ticket_triage', 'status', 'triage_rank'),
+            db.Index('ix_ticket_triage_department', 'status', 'department_id', 'triage_rank'),
+            db.Index('ix_ticket_triage_category', 'status', 'category', 'triage_rank'),
+            # The duplicate index catches up on tickets changed by other processes through this
+            db.Index('ix_ticket_updated', 'updated_at'),
+        )
 
     class TicketComment(db.Model):
         id = db.Column(db.Integer, primary_key=True)
@@ -214,6 +255,7 @@ def init_models(db):
         filepath = db.Column(db.String(500), nullable=False)
         file_type = db.Column(db.String(50), nullable=False)
         file_size = db.Column(db.Integer, nullable=False)  # in bytes
+        content_hash = db.Column(db.String(64), db.ForeignKey('stored_blob.content_hash'), nullable=True, index=True)
         uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
         uploaded_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     
@@ -278,6 +320,10 @@ def init_models(db):
         created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
         updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
+        __table_args__ = (
+            db.Index('ix_medical_record_patient_visit', 'patient_id', 'visit_date'),
+        )
+
         # Relationships
         patient = db.relationship('Patient', backref='medical_records')
         doctor = db.relationship('Doctor', backref='medical_records')
@@ -345,4 +391,258 @@ def init_models(db):
         # Relationships
         workflow = db.relationship('Workflow', backref='executions')
         ticket = db.relationship('Ticket', backref='workflow_executions')
-        current_step = db.relationship('WorkflowStep', backref='executions')
\ No newline at end of file
+        current_step = db.relationship('WorkflowStep', backref='executions')
+
+    class SystemSetting(db.Model):
+        key = db.Column(db.String(100), primary_key=True)
+        value = db.Column(db.Text, nullable=False)  # JSON encoded value
+        updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+
+    class ScheduleTemplate(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
+        doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=True)  # None = department-wide hours
+        weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday ... 6 = Sunday
+        start_time = db.Column(db.Time, nullable=False)
+        end_time = db.Column(db.Time, nullable=False)
+        break_start = db.Column(db.Time, nullable=True)
+        break_end = db.Column(db.Time, nullable=True)
+        slot_minutes = db.Column(db.Integer, default=30)
+        is_active = db.Column(db.Boolean, default=True)
+        created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+        updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+
+        __table_args__ = (
+            db.Index('ix_schedule_template_scope', 'department_id', 'doctor_id', 'weekday'),
+        )
+
+        # Relationships
+        department = db.relationship('Department', backref='schedule_templates')
+        doctor = db.relationship('Doctor', backref='schedule_templates')
+
+    class AppointmentReminder(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
+        user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        appointment_date = db.Column(db.Date, nullable=False)  # Date the reminder was sent for
+        created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+        # One reminder per recipient per appointment date; a rescheduled appointment gets a new one
+        __table_args__ = (
+            db.UniqueConstraint('appointment_id', 'user_id', 'appointment_date', name='uq_appointment_reminder'),
+        )
+
+    class WaitlistEntry(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+        department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
+        doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=True)  # None = any doctor in department
+        appointment_type = db.Column(db.String(100), nullable=False)
+        reason = db.Column(db.Text, nullable=False)
+        duration_minutes = db.Column(db.Integer, default=30)
+        priority = db.Column(db.String(20), default='normal')  # low, normal, high, urgent
+        priority_rank = db.Column(db.Integer, default=2)  # 0 = urgent ... 3 = low, for index ordering
+        earliest_date = db.Column(db.Date, nullable=True)
+        latest_date = db.Column(db.Date, nullable=True)
+        status = db.Column(db.String(20), default='waiting')  # waiting, booked, cancelled
+        appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True)  # Set once booked
+        requested_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+        booked_at = db.Column(db.DateTime, nullable=True)
+
+        # Best candidate for a freed slot = first row of this index
+        __table_args__ = (
+            db.Index('ix_waitlist_queue', 'department_id', 'status', 'priority_rank', 'created_at'),
+        )
+
+        # Relationships
+        patient = db.relationship('Patient', backref='waitlist_entries')
+        department = db.relationship('Department', backref='waitlist_entries')
+        doctor = db.relationship('Doctor', backref='waitlist_entries')
+        appointment = db.relationship('Appointment', backref='waitlist_entry')
+
+    class AppointmentRollup(db.Model):
+        """Per doctor per day appointment counters, maintained on every appointment write"""
+        id = db.Column(db.Integer, primary_key=True)
+        department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
+        doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=True)  # None = no doctor assigned
+        day = db.Column(db.Date, nullable=False)
+        total_count = db.Column(db.Integer, default=0, nullable=False)
+        booked_minutes = db.Column(db.Integer, default=0, nullable=False)  # scheduled, confirmed and completed
+        cancelled_count = db.Column(db.Integer, default=0, nullable=False)
+        completed_count = db.Column(db.Integer, default=0, nullable=False)
+        no_show_count = db.Column(db.Integer, default=0, nullable=False)
+
+        __table_args__ = (
+            db.Index('ix_appointment_rollup_scope', 'department_id', 'day', 'doctor_id'),
+        )
+
+    class CalendarFeedVersion(db.Model):
+        """Change counter per iCalendar feed, bumped in the transaction of every appointment write"""
+        scope = db.Column(db.String(20), primary_key=True)  # doctor, department
+        scope_id = db.Column(db.Integer, primary_key=True)
+        version = db.Column(db.Integer, default=0, nullable=False)
+
+    class LabObservation(db.Model):
+        """One analyte result from MedicalRecord.lab_results"""
+        id = db.Column(db.Integer, primary_key=True)
+        record_id = db.Column(db.Integer, db.ForeignKey('medical_record.id'), nullable=False, index=True)
+        patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+        analyte = db.Column(db.String(100), nullable=False)  # Normalized key, e.g. "hemoglobin"
+        analyte_name = db.Column(db.String(150), nullable=False)  # As entered, e.g. "Hemoglobin"
+        value = db.Column(db.Float, nullable=True)  # Numeric results
+        value_text = db.Column(db.String(200), nullable=True)  # Result as entered
+        unit = db.Column(db.String(50), nullable=True)
+        reference_range = db.Column(db.String(100), nullable=True)
+        reference_low = db.Column(db.Float, nullable=True)
+        reference_high = db.Column(db.Float, nullable=True)
+        visit_date = db.Column(db.Date, nullable=False)
+        department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=True)  # Department of the visit
+        flag = db.Column(db.String(20), nullable=True)  # normal, low, high, critical_low, critical_high
+        is_abnormal = db.Column(db.Boolean, default=False, nullable=False)
+
+        __table_args__ = (
+            db.Index('ix_lab_observation_trend', 'patient_id', 'analyte', 'visit_date'),
+            db.Index('ix_lab_observation_worklist', 'department_id', 'is_abnormal', 'visit_date'),
+        )
+
+    class PrescriptionLine(db.Model):
+        """One medication from MedicalRecord.prescriptions"""
+        id = db.Column(db.Integer, primary_key=True)
+        record_id = db.Column(db.Integer, db.ForeignKey('medical_record.id'), nullable=False, index=True)
+        patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+        medication = db.Column(db.String(150), nullable=False)
+        dosage = db.Column(db.String(100), nullable=True)
+        frequency = db.Column(db.String(100), nullable=True)
+        duration = db.Column(db.String(100), nullable=True)
+        visit_date = db.Column(db.Date, nullable=False)
+
+        __table_args__ = (
+            db.Index('ix_prescription_line_patient', 'patient_id', 'visit_date'),
+        )
+
+    class PatientSummary(db.Model):
+        """Denormalized patient header, refreshed by patient_summary.py on every related write"""
+        patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+        name = db.Column(db.String(150), nullable=True)
+        medical_record_number = db.Column(db.String(50), nullable=True)
+        age = db.Column(db.Integer, nullable=True)
+        gender = db.Column(db.String(20), nullable=True)
+        blood_type = db.Column(db.String(10), nullable=True)
+        allergies = db.Column(db.Text, nullable=True)
+        chronic_conditions = db.Column(db.Text, nullable=True)
+
+        # Last visit
+        last_visit_record_id = db.Column(db.Integer, nullable=True)
+        last_visit_date = db.Column(db.Date, nullable=True)
+        last_visit_type = db.Column(db.String(50), nullable=True)
+        last_visit_department_id = db.Column(db.Integer, nullable=True)
+        last_diagnosis = db.Column(db.Text, nullable=True)
+
+        # Latest vital signs
+        vitals_date = db.Column(db.Date, nullable=True)
+        blood_pressure_systolic = db.Column(db.Integer, nullable=True)
+        blood_pressure_diastolic = db.Column(db.Integer, nullable=True)
+        heart_rate = db.Column(db.Integer, nullable=True)
+        temperature = db.Column(db.Float, nullable=True)
+        weight = db.Column(db.Float, nullable=True)
+        height = db.Column(db.Float, nullable=True)
+        bmi = db.Column(db.Float, nullable=True)
+
+        active_prescriptions = db.Column(db.Text, nullable=True)  # JSON array of prescription lines
+        open_ticket_count = db.Column(db.Integer, default=0)
+        open_tickets = db.Column(db.Text, nullable=True)  # JSON array of the most recent open tickets
+
+        # Next appointment
+        upcoming_appointment_count = db.Column(db.Integer, default=0)
+        next_appointment_id = db.Column(db.Integer, nullable=True)
+        next_appointment_date = db.Column(db.Date, nullable=True)
+        next_appointment_time = db.Column(db.Time, nullable=True)
+        next_appointment_type = db.Column(db.String(100), nullable=True)
+
+        refreshed_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    class ExportJob(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        status = db.Column(db.String(20), default='queued')  # queued, running, completed, failed
+        resource_types = db.Column(db.Text, nullable=False)  # JSON array, e.g. ["Patient", "Encounter"]
+        since = db.Column(db.DateTime, nullable=True)  # Only rows updated at or after this time
+        output = db.Column(db.Text, nullable=True)  # JSON array of {"type", "count"} per written file
+        error_message = db.Column(db.Text, nullable=True)
+        requested_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+        started_at = db.Column(db.DateTime, nullable=True)  # Pass as _since to the next incremental export
+        completed_at = db.Column(db.DateTime, nullable=True)
+
+    class RecordAccessLog(db.Model):
+        """Append-only log of medical record reads, written in batches by access_audit.py"""
+        id = db.Column(db.Integer, primary_key=True)
+        user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        user_role = db.Column(db.String(50), nullable=False)
+        patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=True)
+        record_id = db.Column(db.Integer, nullable=True)  # No foreign key: entries outlive deleted records
+        action = db.Column(db.String(50), nullable=False)  # view_record, list_records, search, summary, lab_trend, vitals, lab_worklist
+        ip_address = db.Column(db.String(45), nullable=True)
+        accessed_at = db.Column(db.DateTime, nullable=False)
+
+        __table_args__ = (
+            db.Index('ix_record_access_patient', 'patient_id', 'accessed_at'),
+            db.Index('ix_record_access_user', 'user_id', 'accessed_at'),
+            db.Index('ix_record_access_record', 'record_id', 'accessed_at'),
+        )
+
+    class DuplicateCandidate(db.Model):
+        """A pair of patient rows that probably describe the same person, found by patient_dedup.py"""
+        id = db.Column(db.Integer, primary_key=True)
+        # No foreign keys: a merged pair is kept after the duplicate row is deleted
+        patient_id = db.Column(db.Integer, nullable=False)  # Lower id of the pair (the earlier registration)
+        duplicate_patient_id = db.Column(db.Integer, nullable=False)
+        score = db.Column(db.Float, nullable=False)  # 0-1
+        reasons = db.Column(db.Text, nullable=True)  # JSON array, e.g. ["same date of birth", "similar name"]
+        status = db.Column(db.String(20), default='pending')  # pending, merged, dismissed
+        detected_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+        reviewed_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+        reviewed_at = db.Column(db.DateTime, nullable=True)
+
+        __table_args__ = (
+            db.UniqueConstraint('patient_id', 'duplicate_patient_id', name='uq_duplicate_candidate_pair'),
+            db.Index('ix_duplicate_candidate_review', 'status', 'score'),
+        )
+
+    class StoredBlob(db.Model):
+        """One stored file per distinct content, shared by every attachment with that content"""
+        content_hash = db.Column(db.String(64), primary_key=True)  # SHA-256 hex digest
+        size = db.Column(db.Integer, nullable=False)  # in bytes
+        filepath = db.Column(db.String(500), nullable=False)  # uploads/blobs/ab/cd/<hash>
+        ref_count = db.Column(db.Integer, nullable=False, default=0)  # Attachments pointing at this blob
+        preview_status = db.Column(db.String(20), nullable=True)  # None (not an image), pending, ready, failed
+        created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    class ActivityEvent(db.Model):
+        """Append-only log of ticket and work order changes; the id is the cursor of the activity feed"""
+        id = db.Column(db.Integer, primary_key=True)
+        entity_type = db.Column(db.String(20), nullable=False)  # ticket, work_order
+        entity_id = db.Column(db.Integer, nullable=False)  # No foreign key: the id refers to either table
+        event_type = db.Column(db.String(30), nullable=False)  # created, assigned, status_changed, priority_changed, commented, sla_warning, sla_breached
+        actor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # None when no user is logged in (e.g. scheduled jobs)
+        old_value = db.Column(db.String(100), nullable=True)
+        new_value = db.Column(db.String(100), nullable=True)
+        summary = db.Column(db.String(255), nullable=True)  # Title for created, excerpt for commented
+        created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+        __table_args__ = (
+            db.Index('ix_activity_event_feed', 'entity_type', 'id'),
+            db.Index('ix_activity_event_entity', 'entity_type', 'entity_id', 'id'),
+        )
+
+    class SlaPolicy(db.Model):
+        """Resolution time for tickets matching a category, priority and/or time sensitivity (empty = any)"""
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.String(100), nullable=False)
+        category = db.Column(db.String(50), nullable=True)
+        priority = db.Column(db.String(20), nullable=True)
+        time_sensitivity = db.Column(db.String(20), nullable=True)
+        resolution_minutes = db.Column(db.Integer, nullable=False)
+        warning_percent = db.Column(db.Integer, default=75)  # Warn when this share of the time has passed
+        is_active = db.Column(db.Boolean, default=True)
+        created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
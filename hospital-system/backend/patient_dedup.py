@@ -0,0 +1,275 @@
+"""
+Duplicate Patient Detection
+Finds Patient rows that probably describe the same person and merges them.
+
+Comparing every pair of patients is quadratic, so patients are first put into
+blocks that share a phonetic name key together with a date of birth (or a
+phone number), and only pairs inside a block are scored. Patients registered
+without a date of birth are compared against everyone sharing their phonetic
+first and last name.
+
+Score the whole table with:
+    python patient_dedup.py
+"""
+
+import json
+import re
+from collections import defaultdict
+from datetime import datetime
+from difflib import SequenceMatcher
+from itertools import combinations
+from flask import current_app
+from calendar_feed import calendar_cache
+from interaction_checker import split_list
+from patient_summary import refresh_patient_summary
+
+MIN_SCORE = 0.8
+MIN_NAME_SIMILARITY = 0.6
+MAX_BLOCK_SIZE = 200  # Larger blocks (e.g. a shared switchboard number) are skipped
+
+# field -> weight; fields missing on either side are left out of the score
+WEIGHTS = {'name': 0.45, 'date_of_birth': 0.25, 'phone': 0.15, 'email': 0.1, 'gender': 0.05}
+
+# Copied from the duplicate when the surviving record has no value
+FILL_FIELDS = ['date_of_birth', 'age', 'gender', 'phone', 'email', 'address', 'city', 'state', 'zip_code',
+               'medical_record_number', 'emergency_contact_name', 'emergency_contact_phone',
+               'emergency_contact_relationship', 'blood_type', 'condition', 'insurance_provider',
+               'insurance_policy_number', 'insurance_group_number', 'admission_date', 'discharge_date']
+# Combined from both records so that nothing clinically relevant is dropped
+UNION_FIELDS = ['allergies', 'chronic_conditions', 'current_medications']
+
+SOUNDEX_CODES = {}
+for letters, digit in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'), ('l', '4'), ('mn', '5'), ('r', '6')):
+    for letter in letters:
+        SOUNDEX_CODES[letter] = digit
+
+def soundex(word):
+    """American Soundex code of a word, e.g. "Robert" and "Rupert" -> "R163" """
+    word = re.sub(r'[^a-z]', '', (word or '').lower())
+    if not word:
+        return ''
+    code = word[0].upper()
+    previous = SOUNDEX_CODES.get(word[0], '')
+    for letter in word[1:]:
+        digit = SOUNDEX_CODES.get(letter, '')
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        # h and w do not separate letters with the same code; vowels do
+        if letter not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+def normalize_name(name):
+    return re.sub(r'\s+', ' ', re.sub(r'[^a-z ]', ' ', (name or '').lower())).strip()
+
+def normalize_phone(phone):
+    # Compare the subscriber part so that "+254 712 345678" matches "0712345678"
+    digits = re.sub(r'\D', '', phone or '')
+    return digits[-9:] if len(digits) >= 7 else None
+
+def name_keys(name):
+    words = normalize_name(name).split()
+    if not words:
+        return None, None
+    return soundex(words[0]), soundex(words[-1])
+
+def blocking_keys(patient):
+    """Blocks a patient belongs to; patient is a row of (id, name, date_of_birth, gender, phone, email)"""
+    first, last = name_keys(patient.name)
+    keys = []
+    if patient.date_of_birth and first:
+        keys.append(('dob', patient.date_of_birth, first))
+        if last != first:
+            keys.append(('dob', patient.date_of_birth, last))
+    phone = normalize_phone(patient.phone)
+    if phone:
+        keys.append(('phone', phone))
+    return keys
+
+def name_similarity(first, second):
+    first, second = normalize_name(first), normalize_name(second)
+    if not first or not second:
+        return 0.0
+    if first == second:
+        return 1.0
+    matcher = SequenceMatcher(None, first, second)
+    # quick_ratio() is an upper bound of ratio() and much cheaper
+    if matcher.quick_ratio() < MIN_NAME_SIMILARITY:
+        return 0.0
+    # Word order is ignored so that "Smith John" matches "John Smith"
+    return max(matcher.ratio(),
+               SequenceMatcher(None, ' '.join(sorted(first.split())), ' '.join(sorted(second.split()))).ratio())
+
+def score_pair(first, second):
+    """Return (score, reasons) for two patient rows"""
+    scores = {}
+    reasons = []
+    if first.date_of_birth and second.date_of_birth:
+        if first.date_of_birth == second.date_of_birth:
+            scores['date_of_birth'] = 1.0
+            reasons.append('same date of birth')
+        elif first.date_of_birth.year == second.date_of_birth.year and \
+                (first.date_of_birth.month, first.date_of_birth.day) == (second.date_of_birth.day, second.date_of_birth.month):
+            scores['date_of_birth'] = 0.7
+            reasons.append('date of birth with day and month swapped')
+        else:
+            scores['date_of_birth'] = 0.0
+    first_phone, second_phone = normalize_phone(first.phone), normalize_phone(second.phone)
+    if first_phone and second_phone:
+        scores['phone'] = 1.0 if first_phone == second_phone else 0.0
+        if first_phone == second_phone:
+            reasons.append('same phone')
+    if first.email and second.email:
+        scores['email'] = 1.0 if first.email.strip().lower() == second.email.strip().lower() else 0.0
+        if scores['email']:
+            reasons.append('same email')
+    # A similar name alone is not evidence of the same person; this also skips
+    # the comparatively slow name comparison for most pairs
+    if not reasons:
+        return 0.0, []
+    if first.gender and second.gender:
+        scores['gender'] = 1.0 if first.gender.lower() == second.gender.lower() else 0.0
+
+    name = name_similarity(first.name, second.name)
+    if name < MIN_NAME_SIMILARITY:
+        return 0.0, []
+    scores['name'] = name
+    reasons.insert(0, 'same name' if name == 1 else 'similar name')
+
+    score = sum(WEIGHTS[field] * value for field, value in scores.items()) / sum(WEIGHTS[field] for field in scores)
+    return score, reasons
+
+def _block_pairs(patients, stats):
+    blocks = defaultdict(list)
+    by_name = defaultdict(list)
+    for patient in patients:
+        for key in blocking_keys(patient):
+            blocks[key].append(patient)
+        first, last = name_keys(patient.name)
+        if first:
+            by_name[(first, last)].append(patient)
+
+    for members in blocks.values():
+        if len(members) > MAX_BLOCK_SIZE:
+            stats['skipped_blocks'] += 1
+            continue
+        yield from combinations(members, 2)
+
+    # Without a date of birth a patient is only blocked by name
+    for members in by_name.values():
+        undated = [patient for patient in members if not patient.date_of_birth]
+        if not undated:
+            continue
+        if len(members) > MAX_BLOCK_SIZE:
+            stats['skipped_blocks'] += 1
+            continue
+        for patient in undated:
+            for other in members:
+                if other.id != patient.id:
+                    yield patient, other
+
+def candidate_pairs(patients, stats):
+    """Yield each pair of patients that share a block once, lower id first"""
+    seen = set()
+    for first, second in _block_pairs(patients, stats):
+        if first.id > second.id:
+            first, second = second, first
+        if (first.id, second.id) not in seen:
+            seen.add((first.id, second.id))
+            yield first, second
+
+def find_duplicate_candidates(min_score=MIN_SCORE):
+    """Score candidate pairs across the whole patient table and store the likely duplicates.
+
+    Pending candidates are rescored; dismissed and merged pairs are left alone.
+    Returns counts of compared pairs, new and updated candidates.
+    """
+    from models import Patient, DuplicateCandidate
+
+    db = current_app.db
+    patients = db.session.query(Patient.id, Patient.name, Patient.date_of_birth, Patient.gender,
+                                Patient.phone, Patient.email).all()
+    existing = {(c.patient_id, c.duplicate_patient_id): c for c in DuplicateCandidate.query.all()}
+
+    stats = {'patients': len(patients), 'compared': 0, 'created': 0, 'updated': 0, 'skipped_blocks': 0}
+    for first, second in candidate_pairs(patients, stats):
+        stats['compared'] += 1
+        score, reasons = score_pair(first, second)
+        if score < min_score:
+            continue
+        candidate = existing.get((first.id, second.id))
+        if candidate is None:
+            db.session.add(DuplicateCandidate(patient_id=first.id, duplicate_patient_id=second.id,
+                                              score=round(score, 3), reasons=json.dumps(reasons)))
+            stats['created'] += 1
+        elif candidate.status == 'pending':
+            candidate.score = round(score, 3)
+            candidate.reasons = json.dumps(reasons)
+            stats['updated'] += 1
+    db.session.commit()
+    return stats
+
+def merge_patients(survivor, duplicate, reviewer_id=None):
+    """Move everything recorded against duplicate onto survivor and delete duplicate, in one transaction.
+
+    The caller commits. The duplicate's login account is left in place.
+    """
+    from models import (Appointment, Ticket, MedicalRecord, WaitlistEntry, LabObservation, PrescriptionLine,
+                        RecordAccessLog, PatientSummary, DuplicateCandidate)
+
+    db = current_app.db
+    # Feeds showing the duplicate's appointments will show the survivor's name
+    feeds = db.session.query(Appointment.department_id, Appointment.doctor_id)\
+        .filter_by(patient_id=duplicate.id).distinct().all()
+    calendar_cache.bump(*{key for department_id, doctor_id in feeds
+                          for key in (('department', department_id), ('doctor', doctor_id))})
+    moved = {}
+    for model in (Ticket, Appointment, MedicalRecord, WaitlistEntry, LabObservation, PrescriptionLine, RecordAccessLog):
+        moved[model.__tablename__] = model.query.filter_by(patient_id=duplicate.id)\
+            .update({'patient_id': survivor.id}, synchronize_session=False)
+
+    fill = {field: getattr(duplicate, field) for field in FILL_FIELDS
+            if getattr(survivor, field) in (None, '') and getattr(duplicate, field) not in (None, '')}
+    for field in UNION_FIELDS:
+        entries = split_list(getattr(survivor, field))
+        known = {entry.lower() for entry in entries}
+        extra = [entry for entry in split_list(getattr(duplicate, field)) if entry.lower() not in known]
+        if extra:
+            fill[field] = ', '.join(entries + extra)
+
+    # Other pairs involving the duplicate are re-detected against the survivor on the next run
+    lower, higher = sorted((survivor.id, duplicate.id))
+    DuplicateCandidate.query.filter(
+        DuplicateCandidate.status == 'pending',
+        (DuplicateCandidate.patient_id == duplicate.id) | (DuplicateCandidate.duplicate_patient_id == duplicate.id),
+        ~((DuplicateCandidate.patient_id == lower) & (DuplicateCandidate.duplicate_patient_id == higher))
+    ).delete(synchronize_session=False)
+    PatientSummary.query.filter_by(patient_id=duplicate.id).delete(synchronize_session=False)
+
+    db.session.delete(duplicate)
+    db.session.flush()  # Frees the duplicate's medical record number before it is copied over
+
+    for field, value in fill.items():
+        setattr(survivor, field, value)
+    refresh_patient_summary(survivor.id)
+
+    candidate = DuplicateCandidate.query.filter_by(patient_id=lower, duplicate_patient_id=higher).first()
+    if candidate is None:
+        candidate = DuplicateCandidate(patient_id=lower, duplicate_patient_id=higher, score=1.0,
+                                       reasons=json.dumps(['merged manually']))
+        db.session.add(candidate)
+    candidate.status = 'merged'
+    candidate.reviewed_by = reviewer_id
+    candidate.reviewed_at = datetime.utcnow()
+    return {'moved': moved, 'filled_fields': sorted(fill)}
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        result = find_duplicate_candidates()
+        print(f"Compared {result['compared']} pairs across {result['patients']} patients: "
+              f"{result['created']} new and {result['updated']} updated duplicate candidates"
+              f" ({result['skipped_blocks']} oversized blocks skipped)")
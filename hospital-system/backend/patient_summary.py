@@ -0,0 +1,153 @@
+"""
+Materialized Patient Summary
+Keeps one PatientSummary row per patient with everything the patient header
+shows, refreshed section by section when the underlying rows change.
+
+Rebuild every summary with:
+    python patient_summary.py
+"""
+
+import json
+from datetime import date, datetime
+from flask import current_app
+
+SECTIONS = ('profile', 'records', 'tickets', 'appointments')
+OPEN_TICKET_STATUSES = ['open', 'in_progress']
+UPCOMING_APPOINTMENT_STATUSES = ['scheduled', 'confirmed']
+OPEN_TICKETS_SHOWN = 5
+VITAL_FIELDS = ['blood_pressure_systolic', 'blood_pressure_diastolic', 'heart_rate',
+                'temperature', 'weight', 'height', 'bmi']
+
+def _refresh_profile(summary, patient):
+    summary.name = patient.name
+    summary.medical_record_number = patient.medical_record_number
+    summary.age = patient.age
+    summary.gender = patient.gender
+    summary.blood_type = patient.blood_type
+    summary.allergies = patient.allergies
+    summary.chronic_conditions = patient.chronic_conditions
+
+def _refresh_records(summary, patient_id):
+    from models import MedicalRecord, PrescriptionLine
+
+    last_visit = MedicalRecord.query.filter_by(patient_id=patient_id)\
+        .order_by(MedicalRecord.visit_date.desc(), MedicalRecord.id.desc()).first()
+    summary.last_visit_record_id = last_visit.id if last_visit else None
+    summary.last_visit_date = last_visit.visit_date if last_visit else None
+    summary.last_visit_type = last_visit.visit_type if last_visit else None
+    summary.last_visit_department_id = last_visit.department_id if last_visit else None
+    summary.last_diagnosis = last_visit.diagnosis if last_visit else None
+
+    has_vitals = MedicalRecord.blood_pressure_systolic.isnot(None)
+    for field in VITAL_FIELDS[1:]:
+        has_vitals = has_vitals | getattr(MedicalRecord, field).isnot(None)
+    vitals = MedicalRecord.query.filter(MedicalRecord.patient_id == patient_id, has_vitals)\
+        .order_by(MedicalRecord.visit_date.desc(), MedicalRecord.id.desc()).first()
+    summary.vitals_date = vitals.visit_date if vitals else None
+    for field in VITAL_FIELDS:
+        setattr(summary, field, getattr(vitals, field) if vitals else None)
+
+    # Active prescriptions = the lines written at the most recent prescribing visit
+    latest = PrescriptionLine.query.filter_by(patient_id=patient_id)\
+        .order_by(PrescriptionLine.visit_date.desc(), PrescriptionLine.record_id.desc()).first()
+    lines = PrescriptionLine.query.filter_by(record_id=latest.record_id).order_by(PrescriptionLine.id).all() if latest else []
+    summary.active_prescriptions = json.dumps([{
+        'medication': line.medication,
+        'dosage': line.dosage,
+        'frequency': line.frequency,
+        'duration': line.duration,
+        'prescribed_on': line.visit_date.isoformat()
+    } for line in lines]) if lines else None
+
+def _refresh_tickets(summary, patient_id):
+    from models import Ticket
+
+    query = Ticket.query.filter(Ticket.patient_id == patient_id, Ticket.status.in_(OPEN_TICKET_STATUSES))
+    summary.open_ticket_count = query.count()
+    tickets = query.order_by(Ticket.created_at.desc()).limit(OPEN_TICKETS_SHOWN).all()
+    summary.open_tickets = json.dumps([{
+        'id': t.id,
+        'title': t.title,
+        'status': t.status,
+        'priority': t.priority
+    } for t in tickets]) if tickets else None
+
+def _refresh_appointments(summary, patient_id):
+    from models import Appointment
+
+    upcoming = Appointment.query.filter(
+        Appointment.patient_id == patient_id,
+        Appointment.status.in_(UPCOMING_APPOINTMENT_STATUSES),
+        Appointment.appointment_date >= date.today()
+    )
+    summary.upcoming_appointment_count = upcoming.count()
+    next_appt = upcoming.order_by(Appointment.appointment_date, Appointment.appointment_time).first()
+    summary.next_appointment_id = next_appt.id if next_appt else None
+    summary.next_appointment_date = next_appt.appointment_date if next_appt else None
+    summary.next_appointment_time = next_appt.appointment_time if next_appt else None
+    summary.next_appointment_type = next_appt.appointment_type if next_appt else None
+
+def refresh_patient_summary(patient_id, *sections):
+    """Recompute the given sections (all if none) of a patient's summary in the caller's transaction.
+
+    Each section reads only the latest rows of one source table through its
+    patient index, so writers pay a few indexed lookups and readers get the
+    whole header from one row. A missing summary is built in full.
+    """
+    from models import Patient, PatientSummary
+
+    if not patient_id:
+        return None
+    db = current_app.db
+    patient = db.session.get(Patient, patient_id)
+    if not patient:
+        return None
+
+    summary = db.session.get(PatientSummary, patient_id)
+    if not summary:
+        summary = PatientSummary(patient_id=patient_id)
+        db.session.add(summary)
+        sections = SECTIONS
+    sections = sections or SECTIONS
+
+    if 'profile' in sections:
+        _refresh_profile(summary, patient)
+    if 'records' in sections:
+        _refresh_records(summary, patient_id)
+    if 'tickets' in sections:
+        _refresh_tickets(summary, patient_id)
+    if 'appointments' in sections:
+        _refresh_appointments(summary, patient_id)
+    summary.refreshed_at = datetime.utcnow()
+    return summary
+
+def get_patient_summary(patient_id):
+    """Return the summary row, building it on first use and rolling the next appointment forward"""
+    from models import PatientSummary
+
+    db = current_app.db
+    summary = db.session.get(PatientSummary, patient_id)
+    stale = summary and summary.next_appointment_date and summary.next_appointment_date < date.today()
+    if not summary or stale:
+        summary = refresh_patient_summary(patient_id, *([] if not summary else ['appointments']))
+        if summary:
+            db.session.commit()
+    return summary
+
+def rebuild_patient_summaries(batch_size=200):
+    from models import Patient
+
+    db = current_app.db
+    patient_ids = [row[0] for row in db.session.query(Patient.id).order_by(Patient.id)]
+    for i in range(0, len(patient_ids), batch_size):
+        for patient_id in patient_ids[i:i + batch_size]:
+            refresh_patient_summary(patient_id)
+        db.session.commit()
+    return len(patient_ids)
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        count = rebuild_patient_summaries()
+        print(f"Patient summaries rebuilt for {count} patients")
@@ -0,0 +1,102 @@
+"""
+Appointment Reminder Job
+Emits reminder notifications for a day's appointments in one batched pass.
+
+Run nightly, e.g. from cron:
+    python reminders.py            # reminders for tomorrow
+    python reminders.py 2025-11-03 # reminders for a specific date
+"""
+
+from datetime import date, datetime, timedelta
+from flask import current_app
+
+REMINDER_STATUSES = ['scheduled', 'confirmed']
+CHUNK_SIZE = 500
+
+def _chunks(items, size=CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def generate_appointment_reminders(target_date=None):
+    """Create reminder notifications for all active appointments on target_date.
+
+    Appointments are selected in one joined query and notifications are
+    inserted in bulk. Each (appointment, recipient, date) is recorded in
+    AppointmentReminder, so re-running the job for the same date is a no-op.
+    """
+    from models import Appointment, AppointmentReminder, Department, Doctor, Notification, Patient
+
+    db = current_app.db
+    target_date = target_date or date.today() + timedelta(days=1)
+
+    rows = db.session.query(
+        Appointment.id,
+        Appointment.appointment_time,
+        Appointment.appointment_type,
+        Patient.user_id,
+        Patient.name,
+        Doctor.user_id,
+        Doctor.name,
+        Department.name
+    ).join(Patient, Appointment.patient_id == Patient.id)\
+        .join(Department, Appointment.department_id == Department.id)\
+        .outerjoin(Doctor, Appointment.doctor_id == Doctor.id)\
+        .filter(Appointment.appointment_date == target_date, Appointment.status.in_(REMINDER_STATUSES))\
+        .all()
+
+    appointment_ids = [row[0] for row in rows]
+    already_sent = set()
+    for chunk in _chunks(appointment_ids):
+        already_sent.update(db.session.query(AppointmentReminder.appointment_id, AppointmentReminder.user_id).filter(
+            AppointmentReminder.appointment_date == target_date,
+            AppointmentReminder.appointment_id.in_(chunk)
+        ).all())
+
+    notifications = []
+    ledger = []
+    for appt_id, appt_time, appt_type, patient_user_id, patient_name, doctor_user_id, doctor_name, department_name in rows:
+        when = f"{target_date.isoformat()} at {appt_time.strftime('%H:%M')}"
+        recipients = [(patient_user_id, f"Reminder: your {appt_type} appointment with "
+                                        f"{doctor_name or department_name} is on {when}.")]
+        if doctor_user_id:
+            recipients.append((doctor_user_id, f"Reminder: {appt_type} appointment with {patient_name} on {when}."))
+
+        for user_id, message in recipients:
+            if (appt_id, user_id) in already_sent:
+                continue
+            already_sent.add((appt_id, user_id))
+            notifications.append({
+                'user_id': user_id,
+                'title': f"Appointment Reminder: {target_date.isoformat()}",
+                'message': message,
+                'type': 'reminder',
+                'is_read': False,
+                'created_at': datetime.utcnow()
+            })
+            ledger.append({
+                'appointment_id': appt_id,
+                'user_id': user_id,
+                'appointment_date': target_date,
+                'created_at': datetime.utcnow()
+            })
+
+    if notifications:
+        db.session.bulk_insert_mappings(AppointmentReminder, ledger)
+        db.session.bulk_insert_mappings(Notification, notifications)
+        db.session.commit()
+
+    return {
+        'target_date': target_date.isoformat(),
+        'appointments': len(rows),
+        'reminders_created': len(notifications)
+    }
+
+if __name__ == '__main__':
+    import sys
+    from app import app
+
+    with app.app_context():
+        target = datetime.strptime(sys.argv[1], '%Y-%m-%d').date() if len(sys.argv) > 1 else None
+        result = generate_appointment_reminders(target)
+        print(f"Reminders for {result['target_date']}: {result['reminders_created']} created "
+              f"across {result['appointments']} appointments")
@@ -11,6 +11,7 @@ from .appointment_routes import appointment_bp
 from .medical_records_routes import medical_records_bp
 from .workflow_routes import workflow_bp
 from .electrician_routes import electrician_bp
+from .export_routes import export_bp
 
 def register_blueprints(app):
     app.register_blueprint(auth_bp, url_prefix='/auth')
@@ -25,4 +26,5 @@ def register_blueprints(app):
     app.register_blueprint(appointment_bp, url_prefix='/appointment')
     app.register_blueprint(medical_records_bp, url_prefix='/medical-records')
     app.register_blueprint(workflow_bp, url_prefix='/workflow')
-    app.register_blueprint(electrician_bp, url_prefix='/electrician')
\ No newline at end of file
+    app.register_blueprint(electrician_bp, url_prefix='/electrician')
+    app.register_blueprint(export_bp, url_prefix='/export')
\ No newline at end of file
@@ -1,13 +1,27 @@
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
-from models import User, WorkOrder, Department, Technician, Equipment, Ticket, Casual
+from models import User, WorkOrder, Department, Technician, Equipment, Ticket, Casual, SystemSetting, SlaPolicy
 from werkzeug.security import generate_password_hash
+from scheduling import schedule_cache, parse_time, DEFAULT_WORKING_HOURS
+from patient_summary import refresh_patient_summary
+from sla_engine import recompute_open_slas
+from activity_log import record_changes, snapshot, recent_events, events_since, serialize_events, ENTITY_TYPES, DEFAULT_FEED_LIMIT
+import json
 
 def get_db():
     return current_app.db
 
 admin_bp = Blueprint('admin', __name__)
 
+DEFAULT_SETTINGS = {
+    'systemName': 'SOLU-HMS',
+    'emailNotifications': True,
+    'autoAssignment': False,
+    'maintenanceMode': False,
+    'maxTicketsPerDay': 50,
+    'workingHours': DEFAULT_WORKING_HOURS
+}
+
 @admin_bp.route('/users', methods=['GET'])
 @login_required
 def get_users():
@@ -170,8 +184,11 @@ def auto_assign_ticket(ticket_id):
         return jsonify({'message': 'No suitable technician available'}), 404
 
     # Assign the ticket
+    before = snapshot(ticket)
     ticket.assigned_to = best_match.user_id
     ticket.status = 'in_progress'
+    record_changes('ticket', ticket, before)
+    refresh_patient_summary(ticket.patient_id, 'tickets')
 
     db = get_db()
     db.session.commit()
@@ -208,30 +225,98 @@ def get_reports():
         'pendingTickets': pending_tickets,
         'avgResolutionTime': '24h',  # This would need actual calculation
         'departmentStats': [],  # This would need department-based queries
-        'recentActivity': []  # This would need activity logging
+        'recentActivity': serialize_events(recent_events())
     }
 
     return jsonify(reports_data), 200
 
+@admin_bp.route('/activity', methods=['GET'])
+@login_required
+def get_activity():
+    """Ticket and work order events after the ?since= cursor, oldest first"""
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', DEFAULT_FEED_LIMIT, type=int)
+    entity_type = request.args.get('entity_type')
+    if entity_type and entity_type not in ENTITY_TYPES:
+        return jsonify({'message': f"entity_type must be one of: {', '.join(ENTITY_TYPES)}"}), 400
+
+    events = events_since(since, max(limit, 1), entity_type)
+    return jsonify({
+        'events': serialize_events(events),
+        # Pass back as ?since= to get the next events
+        'cursor': events[-1].id if events else since
+    }), 200
+
+def _sla_policy_data(policy):
+    return {
+        'id': policy.id,
+        'name': policy.name,
+        'category': policy.category,
+        'priority': policy.priority,
+        'time_sensitivity': policy.time_sensitivity,
+        'resolution_minutes': policy.resolution_minutes,
+        'warning_percent': policy.warning_percent,
+        'is_active': policy.is_active
+    }
+
+@admin_bp.route('/sla-policies', methods=['GET'])
+@login_required
+def get_sla_policies():
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    policies = SlaPolicy.query.order_by(SlaPolicy.resolution_minutes).all()
+    return jsonify([_sla_policy_data(p) for p in policies]), 200
+
+@admin_bp.route('/sla-policies', methods=['POST'])
+@admin_bp.route('/sla-policies/<int:policy_id>', methods=['PUT'])
+@login_required
+def save_sla_policy(policy_id=None):
+    """Create or update a policy; deadlines of open tickets are recomputed"""
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    policy = SlaPolicy() if policy_id is None else SlaPolicy.query.get(policy_id)
+    if not policy:
+        return jsonify({'message': 'SLA policy not found'}), 404
+
+    data = request.get_json()
+    for field in ['name', 'category', 'priority', 'time_sensitivity', 'resolution_minutes', 'warning_percent', 'is_active']:
+        if field in data:
+            setattr(policy, field, data[field] if data[field] != '' else None)
+
+    if not policy.name or not isinstance(policy.resolution_minutes, int) or policy.resolution_minutes <= 0:
+        return jsonify({'message': 'name and a positive resolution_minutes are required'}), 400
+    if policy.priority not in [None, 'low', 'medium', 'high', 'critical']:
+        return jsonify({'message': 'Invalid priority level'}), 400
+    if policy.time_sensitivity not in [None, 'immediate', 'within_hour', 'within_shift', 'within_day']:
+        return jsonify({'message': 'Invalid time sensitivity'}), 400
+    if policy.warning_percent is not None and not (isinstance(policy.warning_percent, int) and 0 < policy.warning_percent < 100):
+        return jsonify({'message': 'warning_percent must be between 1 and 99'}), 400
+
+    db = get_db()
+    db.session.add(policy)
+    db.session.commit()
+    updated = recompute_open_slas()
+
+    return jsonify({
+        'message': 'SLA policy saved successfully',
+        'policy': _sla_policy_data(policy),
+        'tickets_updated': updated
+    }), 201 if policy_id is None else 200
+
 @admin_bp.route('/settings', methods=['GET'])
 @login_required
 def get_settings():
     if current_user.role not in ['admin', 'manager']:
         return jsonify({'message': 'Unauthorized'}), 403
 
-    # For now, return default settings
-    # In a real implementation, you'd store settings in the database
-    settings_data = {
-        'systemName': 'SOLU-HMS',
-        'emailNotifications': True,
-        'autoAssignment': False,
-        'maintenanceMode': False,
-        'maxTicketsPerDay': 50,
-        'workingHours': {
-            'start': '08:00',
-            'end': '18:00'
-        }
-    }
+    settings_data = dict(DEFAULT_SETTINGS)
+    for setting in SystemSetting.query.filter(SystemSetting.key.in_(DEFAULT_SETTINGS.keys())).all():
+        settings_data[setting.key] = json.loads(setting.value)
 
     return jsonify(settings_data), 200
 
@@ -243,8 +328,6 @@ def update_settings():
 
     data = request.get_json()
 
-    # For now, just validate the data and return success
-    # In a real implementation, you'd save settings to the database
     required_fields = ['systemName', 'emailNotifications', 'autoAssignment', 'maintenanceMode', 'maxTicketsPerDay', 'workingHours']
 
     for field in required_fields:
@@ -254,6 +337,23 @@ def update_settings():
     # Validate working hours format
     if 'start' not in data.get('workingHours', {}) or 'end' not in data.get('workingHours', {}):
         return jsonify({'message': 'Invalid working hours format'}), 400
+    try:
+        if parse_time(data['workingHours']['start']) >= parse_time(data['workingHours']['end']):
+            return jsonify({'message': 'Working hours must start before they end'}), 400
+    except ValueError:
+        return jsonify({'message': 'Working hours must use HH:MM format'}), 400
+
+    db = get_db()
+    for field in required_fields:
+        setting = SystemSetting.query.get(field)
+        if setting:
+            setting.value = json.dumps(data[field])
+        else:
+            db.session.add(SystemSetting(key=field, value=json.dumps(data[field])))
+    db.session.commit()
+
+    # Clinic hours feed the default appointment slot grid
+    schedule_cache.invalidate()
 
     return jsonify({'message': 'Settings updated successfully'}), 200
 
@@ -336,9 +436,11 @@ def update_work_order_status(work_order_id):
     data = request.get_json()
     work_order = WorkOrder.query.get(work_order_id)
     if work_order:
+        before = snapshot(work_order)
         work_order.status = data['status']
         if 'actual_hours' in data:
             work_order.actual_hours = data['actual_hours']
+        record_changes('work_order', work_order, before)
         db = get_db()
         db.session.commit()
         return jsonify({'message': 'Work order status updated'}), 200
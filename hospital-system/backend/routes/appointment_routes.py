@@ -1,7 +1,12 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, url_for, make_response
 from flask_login import login_required, current_user
-from datetime import datetime, time, timedelta
-from sqlalchemy import and_, or_
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from scheduling import schedule_cache, to_minutes, from_minutes, parse_time, intervals_overlap
+from calendar_feed import calendar_cache, render_calendar, FEED_PAST_DAYS, FEED_STATUSES
+from itsdangerous import URLSafeSerializer, BadSignature
+from utilization import rollup_snapshot, apply_appointment_change, rebuild_rollup, utilization_report
+from patient_summary import refresh_patient_summary
 
 def get_db():
     return current_app.db
@@ -11,14 +16,194 @@ Appointment = None
 Patient = None
 Department = None
 User = None
+Doctor = None
+ScheduleTemplate = None
+WaitlistEntry = None
+Notification = None
 
 def init_appointment_models(db):
-    global Appointment, Patient, Department, User
+    global Appointment, Patient, Department, User, Doctor, ScheduleTemplate, WaitlistEntry, Notification
     from models import Appointment as ApptModel, Patient as PatientModel, Department as DeptModel, User as UserModel
+    from models import Doctor as DoctorModel, ScheduleTemplate as TemplateModel
+    from models import WaitlistEntry as WaitlistModel, Notification as NotificationModel
     Appointment = ApptModel
     Patient = PatientModel
     Department = DeptModel
     User = UserModel
+    Doctor = DoctorModel
+    ScheduleTemplate = TemplateModel
+    WaitlistEntry = WaitlistModel
+    Notification = NotificationModel
+
+ACTIVE_STATUSES = ['scheduled', 'confirmed']
+PRIORITY_RANKS = {'urgent': 0, 'high': 1, 'normal': 2, 'low': 3}
+
+def _booked_intervals(appointment_date, doctor_id=None, department_id=None, exclude_id=None):
+    """Load (start, end) minute intervals of active appointments for a day"""
+    query = Appointment.query.with_entities(Appointment.appointment_time, Appointment.duration_minutes).filter(
+        Appointment.appointment_date == appointment_date,
+        Appointment.status.in_(ACTIVE_STATUSES)
+    )
+    if doctor_id:
+        query = query.filter(Appointment.doctor_id == int(doctor_id))
+    elif department_id:
+        query = query.filter(Appointment.department_id == int(department_id))
+    if exclude_id:
+        query = query.filter(Appointment.id != exclude_id)
+
+    intervals = []
+    for appt_time, duration in query.all():
+        start = to_minutes(appt_time)
+        intervals.append((start, start + (duration or 30)))
+    return intervals
+
+def _check_slot(doctor_id, department_id, appointment_date, appointment_time, duration, exclude_id=None):
+    """Return an error message if the slot is outside working hours or double-booked"""
+    start = to_minutes(appointment_time)
+    end = start + duration
+
+    grid = schedule_cache.get_grid(appointment_date.weekday(), doctor_id, department_id)
+    # Only explicit templates restrict booking hours; clinic-wide defaults stay advisory
+    if grid.source != 'default' and not any(w_start <= start and end <= w_end for w_start, w_end in grid.windows):
+        return 'Requested time is outside scheduled working hours'
+
+    if doctor_id:
+        for booked_start, booked_end in _booked_intervals(appointment_date, doctor_id=doctor_id, exclude_id=exclude_id):
+            if intervals_overlap(start, end, booked_start, booked_end):
+                return 'Time slot conflicts with existing appointment'
+
+    return None
+
+def _calendar_keys(*slots):
+    """Calendar feeds affected by the given slots"""
+    keys = set()
+    for slot in slots:
+        if slot:
+            keys.add(('department', slot[0]))
+            keys.add(('doctor', slot[1]))
+    return keys
+
+def _slot_of(appointment):
+    """Snapshot the slot an appointment occupies, or None if it holds no slot"""
+    if appointment.status not in ACTIVE_STATUSES:
+        return None
+    return (appointment.department_id, appointment.doctor_id, appointment.appointment_date,
+            appointment.appointment_time, appointment.duration_minutes or 30)
+
+def _free_gaps(slot):
+    """Minute ranges of a released slot that no remaining booking covers and that have not passed"""
+    department_id, doctor_id, appointment_date, appointment_time, duration = slot
+    start = to_minutes(appointment_time)
+    end = start + duration
+    now = datetime.utcnow()
+    if appointment_date == now.date():
+        start = max(start, now.hour * 60 + now.minute + 1)
+
+    # The session autoflushes, so a moved appointment is counted at its new time
+    if doctor_id:
+        booked = _booked_intervals(appointment_date, doctor_id=doctor_id)
+    else:
+        # Without a doctor the slot only competes with the department's other unassigned bookings
+        booked = [(to_minutes(t), to_minutes(t) + (d or 30)) for t, d in Appointment.query.with_entities(
+            Appointment.appointment_time, Appointment.duration_minutes).filter(
+            Appointment.department_id == department_id,
+            Appointment.doctor_id.is_(None),
+            Appointment.appointment_date == appointment_date,
+            Appointment.status.in_(ACTIVE_STATUSES)
+        )]
+    gaps = []
+    for booked_start, booked_end in sorted(booked):
+        if booked_start >= end:
+            break
+        if booked_end > start:
+            if booked_start > start:
+                gaps.append((start, booked_start))
+            start = max(start, booked_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+def _backfill_freed_slot(slot):
+    """Book the best waitlisted patient into the time a released slot actually freed, within the caller's transaction.
+
+    Only the minutes of the old slot that no remaining booking of the doctor
+    covers (and that are still ahead) are offered. Candidates come from the
+    waitlist queue index ordered by priority then request time; the first one
+    whose date window fits, whose duration fits a free gap and who is not
+    already booked at that time gets the start of that gap.
+    """
+    if not slot:
+        return None
+    department_id, doctor_id, appointment_date, appointment_time, duration = slot
+    if appointment_date < datetime.utcnow().date():
+        return None
+    gaps = _free_gaps(slot)
+    if not gaps:
+        return None
+    longest = max(gap_end - gap_start for gap_start, gap_end in gaps)
+
+    db = get_db()
+    query = WaitlistEntry.query.filter(
+        WaitlistEntry.department_id == department_id,
+        WaitlistEntry.status == 'waiting',
+        WaitlistEntry.duration_minutes <= longest,
+        or_(WaitlistEntry.earliest_date.is_(None), WaitlistEntry.earliest_date <= appointment_date),
+        or_(WaitlistEntry.latest_date.is_(None), WaitlistEntry.latest_date >= appointment_date)
+    )
+    if doctor_id:
+        query = query.filter(or_(WaitlistEntry.doctor_id.is_(None), WaitlistEntry.doctor_id == doctor_id))
+    else:
+        query = query.filter(WaitlistEntry.doctor_id.is_(None))
+
+    for entry in query.order_by(WaitlistEntry.priority_rank, WaitlistEntry.created_at).limit(20):
+        start = next((gap_start for gap_start, gap_end in gaps if gap_end - gap_start >= entry.duration_minutes), None)
+        if start is None:
+            continue
+        start_time = from_minutes(start)
+        if _check_slot(doctor_id, department_id, appointment_date, start_time, entry.duration_minutes):
+            continue
+        patient_booked = Appointment.query.with_entities(Appointment.appointment_time, Appointment.duration_minutes).filter(
+            Appointment.patient_id == entry.patient_id,
+            Appointment.appointment_date == appointment_date,
+            Appointment.status.in_(ACTIVE_STATUSES)
+        ).all()
+        if any(intervals_overlap(start, start + entry.duration_minutes, to_minutes(t), to_minutes(t) + (d or 30))
+               for t, d in patient_booked):
+            continue
+
+        appointment = Appointment(
+            patient_id=entry.patient_id,
+            department_id=department_id,
+            doctor_id=doctor_id,
+            scheduled_by=current_user.id,
+            appointment_date=appointment_date,
+            appointment_time=start_time,
+            duration_minutes=entry.duration_minutes,
+            appointment_type=entry.appointment_type,
+            reason=entry.reason,
+            notes='Booked automatically from the waitlist',
+            priority=entry.priority
+        )
+        db.session.add(appointment)
+        db.session.flush()
+        apply_appointment_change(None, rollup_snapshot(appointment))
+        refresh_patient_summary(entry.patient_id, 'appointments')
+
+        entry.status = 'booked'
+        entry.appointment_id = appointment.id
+        entry.booked_at = datetime.utcnow()
+
+        patient = Patient.query.get(entry.patient_id)
+        db.session.add(Notification(
+            user_id=patient.user_id,
+            title='Appointment Slot Available',
+            message=f"You have been booked from the waitlist for {appointment_date.isoformat()} "
+                    f"at {start_time.strftime('%H:%M')}.",
+            type='success'
+        ))
+        return appointment
+
+    return None
 
 appointment_bp = Blueprint('appointment', __name__)
 
@@ -119,27 +304,11 @@ def create_appointment():
         appointment_date = datetime.strptime(data['appointment_date'], '%Y-%m-%d').date()
         appointment_time = datetime.strptime(data['appointment_time'], '%H:%M').time()
 
-        # Check for scheduling conflicts (same doctor, date, and overlapping time)
-        if 'doctor_id' in data and data['doctor_id']:
-            duration = data.get('duration_minutes', 30)
-            end_time = datetime.combine(appointment_date, appointment_time) + timedelta(minutes=duration)
-
-            conflict = Appointment.query.filter(
-                and_(
-                    Appointment.doctor_id == data['doctor_id'],
-                    Appointment.appointment_date == appointment_date,
-                    Appointment.status.in_(['scheduled', 'confirmed']),
-                    or_(
-                        and_(Appointment.appointment_time <= appointment_time,
-                             Appointment.appointment_time + timedelta(minutes=Appointment.duration_minutes) > appointment_time),
-                        and_(appointment_time <= Appointment.appointment_time,
-                             end_time > Appointment.appointment_time)
-                    )
-                )
-            ).first()
-
-            if conflict:
-                return jsonify({'error': 'Time slot conflicts with existing appointment'}), 409
+        # Check working hours and scheduling conflicts (same doctor, date, and overlapping time)
+        slot_error = _check_slot(data.get('doctor_id'), data['department_id'], appointment_date,
+                                 appointment_time, data.get('duration_minutes', 30))
+        if slot_error:
+            return jsonify({'error': slot_error}), 409
 
         # Create appointment
         appointment = Appointment(
@@ -158,7 +327,10 @@ def create_appointment():
 
         db = get_db()
         db.session.add(appointment)
-        db = get_db()
+        db.session.flush()
+        apply_appointment_change(None, rollup_snapshot(appointment))
+        refresh_patient_summary(appointment.patient_id, 'appointments')
+        calendar_cache.bump(*_calendar_keys(_slot_of(appointment)))
         db.session.commit()
 
         return jsonify({
@@ -236,6 +408,9 @@ def update_appointment(appointment_id):
             if not department or department.id != appointment.department_id:
                 return jsonify({'error': 'Unauthorized to update this appointment'}), 403
 
+        previous_slot = _slot_of(appointment)
+        previous_rollup = rollup_snapshot(appointment)
+
         # Update fields
         updatable_fields = ['doctor_id', 'appointment_date', 'appointment_time', 'duration_minutes',
                           'appointment_type', 'reason', 'notes', 'status', 'priority']
@@ -249,6 +424,17 @@ def update_appointment(appointment_id):
                 else:
                     setattr(appointment, field, data[field])
 
+        # Re-check the slot when an active appointment is moved
+        scheduling_fields = ['doctor_id', 'appointment_date', 'appointment_time', 'duration_minutes']
+        if any(field in data for field in scheduling_fields) and appointment.status in ACTIVE_STATUSES:
+            slot_error = _check_slot(appointment.doctor_id, appointment.department_id, appointment.appointment_date,
+                                     appointment.appointment_time, appointment.duration_minutes or 30,
+                                     exclude_id=appointment.id)
+            if slot_error:
+                db = get_db()
+                db.session.rollback()
+                return jsonify({'error': slot_error}), 409
+
         # Update timestamp
         appointment.updated_at = datetime.utcnow()
 
@@ -261,9 +447,23 @@ def update_appointment(appointment_id):
             elif data['status'] == 'cancelled' and not appointment.cancelled_at:
                 appointment.cancelled_at = datetime.utcnow()
 
+        apply_appointment_change(previous_rollup, rollup_snapshot(appointment))
+        refresh_patient_summary(appointment.patient_id, 'appointments')
+
+        # Offer a slot released by a cancellation or reschedule to the waitlist
+        backfilled = None
+        if previous_slot and previous_slot != _slot_of(appointment):
+            backfilled = _backfill_freed_slot(previous_slot)
+
+        # Any status or detail change can alter the rendered feeds
+        calendar_cache.bump(*_calendar_keys(previous_slot, (appointment.department_id, appointment.doctor_id)))
+        db = get_db()
         db.session.commit()
 
-        return jsonify({'message': 'Appointment updated successfully'})
+        return jsonify({
+            'message': 'Appointment updated successfully',
+            'backfilled_appointment_id': backfilled.id if backfilled else None
+        })
 
     except ValueError as e:
         return jsonify({'error': 'Invalid date/time format'}), 400
@@ -282,11 +482,21 @@ def delete_appointment(appointment_id):
         if current_user.role != 'admin':
             return jsonify({'error': 'Only administrators can delete appointments'}), 403
 
+        freed_slot = _slot_of(appointment)
+        feed_keys = _calendar_keys((appointment.department_id, appointment.doctor_id))
+
         db = get_db()
+        apply_appointment_change(rollup_snapshot(appointment), None)
         db.session.delete(appointment)
+        refresh_patient_summary(appointment.patient_id, 'appointments')
+        backfilled = _backfill_freed_slot(freed_slot)
+        calendar_cache.bump(*feed_keys)
         db.session.commit()
 
-        return jsonify({'message': 'Appointment deleted successfully'})
+        return jsonify({
+            'message': 'Appointment deleted successfully',
+            'backfilled_appointment_id': backfilled.id if backfilled else None
+        })
 
     except Exception as e:
         db.session.rollback()
@@ -330,55 +540,469 @@ def get_availability():
 
         appointment_date = datetime.strptime(date, '%Y-%m-%d').date()
 
-        # Get existing appointments for the date
-        query = Appointment.query.filter(
-            and_(
-                Appointment.appointment_date == appointment_date,
-                Appointment.status.in_(['scheduled', 'confirmed'])
-            )
-        )
+        # Booked intervals for the date, checked against the cached slot grid
+        booked = _booked_intervals(appointment_date, doctor_id=doctor_id, department_id=department_id)
+        grid = schedule_cache.get_grid(appointment_date.weekday(), doctor_id, department_id)
 
+        available_slots = []
+        for slot_start, slot_end in grid.slots:
+            if not any(intervals_overlap(slot_start, slot_end, booked_start, booked_end)
+                       for booked_start, booked_end in booked):
+                available_slots.append(from_minutes(slot_start).isoformat())
+
+        return jsonify({
+            'date': date,
+            'slot_minutes': grid.slot_minutes,
+            'available_slots': available_slots
+        })
+
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _serialize_template(template):
+    return {
+        'id': template.id,
+        'department_id': template.department_id,
+        'doctor_id': template.doctor_id,
+        'weekday': template.weekday,
+        'start_time': template.start_time.strftime('%H:%M'),
+        'end_time': template.end_time.strftime('%H:%M'),
+        'break_start': template.break_start.strftime('%H:%M') if template.break_start else None,
+        'break_end': template.break_end.strftime('%H:%M') if template.break_end else None,
+        'slot_minutes': template.slot_minutes,
+        'is_active': template.is_active
+    }
+
+def _can_manage_schedule(department_id):
+    if current_user.role == 'admin':
+        return True
+    if current_user.role == 'department':
+        department = Department.query.filter_by(user_id=current_user.id).first()
+        return department is not None and department.id == department_id
+    return False
+
+def _apply_template_fields(template, data):
+    for field in ['start_time', 'end_time', 'break_start', 'break_end']:
+        if field in data:
+            setattr(template, field, parse_time(data[field]) if data[field] else None)
+    if 'slot_minutes' in data:
+        template.slot_minutes = int(data['slot_minutes'])
+    if 'is_active' in data:
+        template.is_active = bool(data['is_active'])
+
+    if template.start_time >= template.end_time:
+        raise ValueError('start_time must be before end_time')
+    if bool(template.break_start) != bool(template.break_end):
+        raise ValueError('break_start and break_end must be set together')
+    if not template.slot_minutes or template.slot_minutes <= 0:
+        raise ValueError('slot_minutes must be positive')
+
+@appointment_bp.route('/schedule-templates', methods=['GET'])
+@login_required
+def get_schedule_templates():
+    """Get weekly schedule templates for departments and doctors"""
+    try:
+        department_id = request.args.get('department_id', type=int)
+        doctor_id = request.args.get('doctor_id', type=int)
+
+        query = ScheduleTemplate.query
+        if current_user.role == 'department':
+            department = Department.query.filter_by(user_id=current_user.id).first()
+            if not department:
+                return jsonify({'error': 'Department not found'}), 404
+            query = query.filter_by(department_id=department.id)
+        if department_id:
+            query = query.filter_by(department_id=department_id)
         if doctor_id:
-            query = query.filter_by(doctor_id=int(doctor_id))
-        elif department_id:
-            query = query.filter_by(department_id=int(department_id))
+            query = query.filter_by(doctor_id=doctor_id)
 
-        existing_appointments = query.all()
+        templates = query.order_by(ScheduleTemplate.department_id, ScheduleTemplate.doctor_id,
+                                   ScheduleTemplate.weekday).all()
+        return jsonify([_serialize_template(t) for t in templates])
 
-        # Generate available time slots (assuming 9 AM to 5 PM, 30-minute slots)
-        available_slots = []
-        current_time = time(9, 0)  # 9:00 AM
-        end_time = time(17, 0)     # 5:00 PM
-        slot_duration = 30  # minutes
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@appointment_bp.route('/schedule-templates', methods=['POST'])
+@login_required
+def save_schedule_template():
+    """Create or replace the template for a department/doctor weekday"""
+    db = get_db()
+    try:
+        data = request.get_json()
+
+        required_fields = ['department_id', 'weekday', 'start_time', 'end_time']
+        for field in required_fields:
+            if field not in data:
+                return jsonify({'error': f'Missing required field: {field}'}), 400
 
-        while current_time < end_time:
-            slot_end = datetime.combine(appointment_date, current_time) + timedelta(minutes=slot_duration)
-            slot_end_time = slot_end.time()
+        department_id = int(data['department_id'])
+        doctor_id = data.get('doctor_id')
+        weekday = int(data['weekday'])
 
-            # Check if this slot conflicts with existing appointments
-            conflict = False
-            for appt in existing_appointments:
-                appt_end = datetime.combine(appointment_date, appt.appointment_time) + timedelta(minutes=appt.duration_minutes)
-                appt_end_time = appt_end.time()
+        if not _can_manage_schedule(department_id):
+            return jsonify({'error': 'Unauthorized to manage schedules for this department'}), 403
+        if weekday not in range(7):
+            return jsonify({'error': 'weekday must be between 0 (Monday) and 6 (Sunday)'}), 400
+        if doctor_id:
+            doctor = Doctor.query.get(doctor_id)
+            if not doctor or doctor.department_id != department_id:
+                return jsonify({'error': 'Doctor not found in this department'}), 404
+
+        template = ScheduleTemplate.query.filter_by(
+            department_id=department_id, doctor_id=doctor_id, weekday=weekday
+        ).first()
+        created = template is None
+        if created:
+            template = ScheduleTemplate(department_id=department_id, doctor_id=doctor_id, weekday=weekday,
+                                        slot_minutes=30, is_active=True)
+            db.session.add(template)
+
+        _apply_template_fields(template, data)
+        db.session.commit()
+        schedule_cache.invalidate()
 
-                # Check for overlap
-                if (current_time < appt_end_time and slot_end_time > appt.appointment_time):
-                    conflict = True
-                    break
+        return jsonify({
+            'message': 'Schedule template saved successfully',
+            'template': _serialize_template(template)
+        }), 201 if created else 200
 
-            if not conflict:
-                available_slots.append(current_time.isoformat())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
 
-            # Move to next slot
-            next_slot = datetime.combine(appointment_date, current_time) + timedelta(minutes=slot_duration)
-            current_time = next_slot.time()
+@appointment_bp.route('/schedule-templates/<int:template_id>', methods=['PUT'])
+@login_required
+def update_schedule_template(template_id):
+    """Update hours, breaks or slot length of a schedule template"""
+    db = get_db()
+    try:
+        template = ScheduleTemplate.query.get_or_404(template_id)
+        if not _can_manage_schedule(template.department_id):
+            return jsonify({'error': 'Unauthorized to manage schedules for this department'}), 403
+
+        _apply_template_fields(template, request.get_json())
+        db.session.commit()
+        schedule_cache.invalidate()
 
         return jsonify({
-            'date': date,
-            'available_slots': available_slots
+            'message': 'Schedule template updated successfully',
+            'template': _serialize_template(template)
+        })
+
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@appointment_bp.route('/schedule-templates/<int:template_id>', methods=['DELETE'])
+@login_required
+def delete_schedule_template(template_id):
+    """Delete a schedule template"""
+    db = get_db()
+    try:
+        template = ScheduleTemplate.query.get_or_404(template_id)
+        if not _can_manage_schedule(template.department_id):
+            return jsonify({'error': 'Unauthorized to manage schedules for this department'}), 403
+
+        db.session.delete(template)
+        db.session.commit()
+        schedule_cache.invalidate()
+
+        return jsonify({'message': 'Schedule template deleted successfully'})
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@appointment_bp.route('/reminders/run', methods=['POST'])
+@login_required
+def run_appointment_reminders():
+    """Generate reminder notifications for a day's appointments (defaults to tomorrow)"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only administrators can run reminder jobs'}), 403
+
+    try:
+        from reminders import generate_appointment_reminders
+
+        data = request.get_json(silent=True) or {}
+        target_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if data.get('date') else None
+
+        return jsonify(generate_appointment_reminders(target_date))
+
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
+    except Exception as e:
+        get_db().session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+def _serialize_waitlist_entry(entry):
+    return {
+        'id': entry.id,
+        'patient_id': entry.patient_id,
+        'patient_name': entry.patient.name if entry.patient else 'Unknown',
+        'department_id': entry.department_id,
+        'doctor_id': entry.doctor_id,
+        'doctor_name': entry.doctor.name if entry.doctor else None,
+        'appointment_type': entry.appointment_type,
+        'reason': entry.reason,
+        'duration_minutes': entry.duration_minutes,
+        'priority': entry.priority,
+        'earliest_date': entry.earliest_date.isoformat() if entry.earliest_date else None,
+        'latest_date': entry.latest_date.isoformat() if entry.latest_date else None,
+        'status': entry.status,
+        'appointment_id': entry.appointment_id,
+        'created_at': entry.created_at.isoformat() if entry.created_at else None,
+        'booked_at': entry.booked_at.isoformat() if entry.booked_at else None
+    }
+
+@appointment_bp.route('/waitlist', methods=['GET'])
+@login_required
+def get_waitlist():
+    """Get waitlist entries in offer order (priority, then request time)"""
+    try:
+        status = request.args.get('status', 'waiting')
+        department_id = request.args.get('department_id', type=int)
+        doctor_id = request.args.get('doctor_id', type=int)
+
+        query = WaitlistEntry.query
+        if current_user.role == 'patient':
+            patient = Patient.query.filter_by(user_id=current_user.id).first()
+            if not patient:
+                return jsonify({'error': 'Patient profile not found'}), 404
+            query = query.filter_by(patient_id=patient.id)
+        elif current_user.role == 'department':
+            department = Department.query.filter_by(user_id=current_user.id).first()
+            if not department:
+                return jsonify({'error': 'Department not found'}), 404
+            query = query.filter_by(department_id=department.id)
+
+        if status:
+            query = query.filter_by(status=status)
+        if department_id:
+            query = query.filter_by(department_id=department_id)
+        if doctor_id:
+            query = query.filter_by(doctor_id=doctor_id)
+
+        entries = query.order_by(WaitlistEntry.priority_rank, WaitlistEntry.created_at).all()
+        return jsonify([_serialize_waitlist_entry(e) for e in entries])
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@appointment_bp.route('/waitlist', methods=['POST'])
+@login_required
+def join_waitlist():
+    """Add a patient to the waitlist for a department or doctor"""
+    db = get_db()
+    try:
+        data = request.get_json()
+
+        required_fields = ['patient_id', 'department_id', 'appointment_type', 'reason']
+        for field in required_fields:
+            if field not in data:
+                return jsonify({'error': f'Missing required field: {field}'}), 400
+
+        # Same ownership rules as booking an appointment
+        if current_user.role == 'patient':
+            patient = Patient.query.filter_by(user_id=current_user.id).first()
+            if not patient or patient.id != data['patient_id']:
+                return jsonify({'error': 'Unauthorized to join the waitlist for this patient'}), 403
+        elif current_user.role == 'department':
+            department = Department.query.filter_by(user_id=current_user.id).first()
+            if not department or department.id != data['department_id']:
+                return jsonify({'error': 'Unauthorized to manage the waitlist for this department'}), 403
+
+        priority = data.get('priority', 'normal')
+        if priority not in PRIORITY_RANKS:
+            return jsonify({'error': 'Invalid priority'}), 400
+
+        entry = WaitlistEntry(
+            patient_id=data['patient_id'],
+            department_id=data['department_id'],
+            doctor_id=data.get('doctor_id'),
+            appointment_type=data['appointment_type'],
+            reason=data['reason'],
+            duration_minutes=data.get('duration_minutes', 30),
+            priority=priority,
+            priority_rank=PRIORITY_RANKS[priority],
+            earliest_date=datetime.strptime(data['earliest_date'], '%Y-%m-%d').date() if data.get('earliest_date') else None,
+            latest_date=datetime.strptime(data['latest_date'], '%Y-%m-%d').date() if data.get('latest_date') else None,
+            requested_by=current_user.id
+        )
+        db.session.add(entry)
+        db.session.commit()
+
+        return jsonify({
+            'message': 'Added to waitlist successfully',
+            'waitlist_id': entry.id
+        }), 201
+
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@appointment_bp.route('/waitlist/<int:entry_id>', methods=['DELETE'])
+@login_required
+def leave_waitlist(entry_id):
+    """Cancel a waitlist entry"""
+    db = get_db()
+    try:
+        entry = WaitlistEntry.query.get_or_404(entry_id)
+
+        if current_user.role == 'patient':
+            patient = Patient.query.filter_by(user_id=current_user.id).first()
+            if not patient or patient.id != entry.patient_id:
+                return jsonify({'error': 'Unauthorized to cancel this waitlist entry'}), 403
+        elif current_user.role == 'department':
+            department = Department.query.filter_by(user_id=current_user.id).first()
+            if not department or department.id != entry.department_id:
+                return jsonify({'error': 'Unauthorized to cancel this waitlist entry'}), 403
+
+        if entry.status != 'waiting':
+            return jsonify({'error': f'Waitlist entry is already {entry.status}'}), 400
+
+        entry.status = 'cancelled'
+        db.session.commit()
+
+        return jsonify({'message': 'Waitlist entry cancelled successfully'})
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+def _calendar_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='calendar-feed')
+
+@appointment_bp.route('/calendar/<scope>/<int:scope_id>/subscribe', methods=['GET'])
+@login_required
+def get_calendar_subscription(scope, scope_id):
+    """Get the tokenized iCalendar URL for a doctor or department schedule"""
+    if scope not in ['doctor', 'department']:
+        return jsonify({'error': 'Calendar scope must be doctor or department'}), 404
+
+    if scope == 'doctor':
+        doctor = Doctor.query.get(scope_id)
+        if not doctor:
+            return jsonify({'error': 'Doctor not found'}), 404
+        department_id = doctor.department_id
+        allowed = current_user.role == 'admin' or doctor.user_id == current_user.id
+    else:
+        department_id = scope_id
+        allowed = current_user.role == 'admin'
+
+    if not allowed and current_user.role == 'department':
+        department = Department.query.filter_by(user_id=current_user.id).first()
+        allowed = department is not None and department.id == department_id
+    if not allowed:
+        return jsonify({'error': 'Unauthorized to subscribe to this calendar'}), 403
+
+    token = _calendar_serializer().dumps([scope, scope_id])
+    return jsonify({
+        'url': url_for('appointment.get_calendar_feed', scope=scope, scope_id=scope_id, token=token, _external=True)
+    })
+
+@appointment_bp.route('/calendar/<scope>/<int:scope_id>.ics', methods=['GET'])
+def get_calendar_feed(scope, scope_id):
+    """Serve an iCalendar feed; calendar apps authenticate with the subscription token"""
+    try:
+        if _calendar_serializer().loads(request.args.get('token', '')) != [scope, scope_id]:
+            raise BadSignature('Token does not match calendar')
+    except BadSignature:
+        return jsonify({'error': 'Invalid calendar token'}), 403
+
+    key = (scope, scope_id)
+    etag = calendar_cache.etag(key)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    def build():
+        if scope == 'doctor':
+            owner = Doctor.query.get(scope_id)
+            query = Appointment.query.filter(Appointment.doctor_id == scope_id)
+        else:
+            owner = Department.query.get(scope_id)
+            query = Appointment.query.filter(Appointment.department_id == scope_id)
+
+        since = datetime.utcnow().date() - timedelta(days=FEED_PAST_DAYS)
+        rows = query.join(Patient, Appointment.patient_id == Patient.id)\
+            .with_entities(Appointment, Patient.name)\
+            .filter(Appointment.appointment_date >= since, Appointment.status.in_(FEED_STATUSES))\
+            .order_by(Appointment.appointment_date, Appointment.appointment_time).all()
+        return render_calendar(owner.name if owner else 'Appointments', rows)
+
+    etag, body = calendar_cache.get(key, build, etag)
+    response = make_response(body)
+    response.headers['Content-Type'] = 'text/calendar; charset=utf-8'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.set_etag(etag)
+    return response
+
+@appointment_bp.route('/analytics/utilization', methods=['GET'])
+@login_required
+def get_utilization():
+    """Get booked vs available minutes and outcome rates per doctor or department"""
+    try:
+        if current_user.role not in ['admin', 'department']:
+            return jsonify({'error': 'Unauthorized to view utilization analytics'}), 403
+
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
+        if not date_from or not date_to:
+            return jsonify({'error': 'date_from and date_to parameters are required'}), 400
+        date_from = datetime.strptime(date_from, '%Y-%m-%d').date()
+        date_to = datetime.strptime(date_to, '%Y-%m-%d').date()
+        if date_to < date_from or (date_to - date_from).days > 366:
+            return jsonify({'error': 'Date range must be between 1 and 367 days'}), 400
+
+        group_by = request.args.get('group_by', 'day')
+        level = request.args.get('level', 'doctor')
+        if group_by not in ['day', 'week'] or level not in ['doctor', 'department']:
+            return jsonify({'error': 'group_by must be day or week and level must be doctor or department'}), 400
+
+        department_id = request.args.get('department_id', type=int)
+        if current_user.role == 'department':
+            department = Department.query.filter_by(user_id=current_user.id).first()
+            if not department:
+                return jsonify({'error': 'Department not found'}), 404
+            department_id = department.id
+
+        return jsonify({
+            'date_from': date_from.isoformat(),
+            'date_to': date_to.isoformat(),
+            'group_by': group_by,
+            'level': level,
+            'rows': utilization_report(date_from, date_to, group_by, level, department_id,
+                                       request.args.get('doctor_id', type=int))
         })
 
     except ValueError as e:
         return jsonify({'error': 'Invalid date format'}), 400
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@appointment_bp.route('/analytics/utilization/rebuild', methods=['POST'])
+@login_required
+def rebuild_utilization():
+    """Recompute the utilization rollup from all appointments"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only administrators can rebuild analytics'}), 403
+
+    try:
+        rows = rebuild_rollup()
+        return jsonify({'message': 'Utilization rollup rebuilt', 'rows': rows})
+
+    except Exception as e:
+        get_db().session.rollback()
+        return jsonify({'error': str(e)}), 500
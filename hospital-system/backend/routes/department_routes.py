@@ -1,6 +1,11 @@
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
 from models import Department, WorkOrder, User, Ticket
+from patient_summary import refresh_patient_summary
+from ticket_dedup import open_ticket_index, check_duplicates
+from activity_log import record_created, record_comment, record_changes, snapshot
+from sla_engine import update_sla
+from triage import update_triage_rank
 
 def get_db():
     return current_app.db
@@ -43,9 +48,11 @@ def update_work_order_status(work_order_id):
     data = request.get_json()
     work_order = WorkOrder.query.get(work_order_id)
     if work_order:
+        before = snapshot(work_order)
         work_order.status = data['status']
         if 'actual_hours' in data:
             work_order.actual_hours = data['actual_hours']
+        record_changes('work_order', work_order, before)
         db = get_db()
         db.session.commit()
         return jsonify({'message': 'Work order status updated'}), 200
@@ -140,8 +147,14 @@ def create_ticket():
         time_sensitivity=data.get('time_sensitivity')
     )
 
+    update_triage_rank(ticket)
     db = get_db()
     db.session.add(ticket)
+    db.session.flush()
+    possible_duplicates = check_duplicates(ticket, link=data.get('link_duplicates', False))
+    record_created('ticket', ticket)
+    update_sla(ticket)
+    refresh_patient_summary(ticket.patient_id, 'tickets')
     db.session.commit()
 
     # TODO: Add emergency notification logic for critical tickets
@@ -152,8 +165,10 @@ def create_ticket():
             'id': ticket.id,
             'title': ticket.title,
             'priority': ticket.priority,
-            'category': ticket.category
-        }
+            'category': ticket.category,
+            'duplicate_of_id': ticket.duplicate_of_id
+        },
+        'possible_duplicates': possible_duplicates
     }), 201
 
 @department_bp.route('/ticket-templates', methods=['GET'])
@@ -247,6 +262,7 @@ def add_ticket_comment(ticket_id):
 
     db = get_db()
     db.session.add(ticket_comment)
+    record_comment('ticket', ticket_id, comment)
     db.session.commit()
 
     return jsonify({
@@ -295,11 +311,16 @@ def update_ticket_status(ticket_id):
     data = request.get_json()
     ticket = Ticket.query.get(ticket_id)
     if ticket:
+        before = snapshot(ticket)
         ticket.status = data['status']
         if data['status'] == 'closed':
             from datetime import datetime
             ticket.resolved_at = datetime.utcnow()
+        record_changes('ticket', ticket, before)
+        update_sla(ticket)
+        refresh_patient_summary(ticket.patient_id, 'tickets')
         db = get_db()
         db.session.commit()
+        open_ticket_index.update(ticket)
         return jsonify({'message': 'Ticket status updated'}), 200
     return jsonify({'message': 'Ticket not found'}), 404
\ No newline at end of file
@@ -0,0 +1,131 @@
+from flask import Blueprint, request, jsonify, current_app, url_for, send_file
+from flask_login import login_required, current_user
+from models import ExportJob
+from bulk_export import RESOURCE_TYPES, start_export, job_folder, delete_export_files, format_instant
+from datetime import datetime
+import json
+import os
+
+def get_db():
+    return current_app.db
+
+export_bp = Blueprint('export', __name__)
+
+def _manifest(job):
+    output = json.loads(job.output) if job.output else []
+    return {
+        'id': job.id,
+        'status': job.status,
+        'transactionTime': format_instant(job.started_at),
+        'since': format_instant(job.since),
+        'request': json.loads(job.resource_types),
+        'output': [{
+            'type': item['type'],
+            'count': item['count'],
+            'url': url_for('export.download_export_file', job_id=job.id, resource_type=item['type'], _external=True)
+        } for item in output],
+        'error': [{'message': job.error_message}] if job.error_message else [],
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'completed_at': job.completed_at.isoformat() if job.completed_at else None
+    }
+
+# Kick off a bulk export
+@export_bp.route('/', methods=['POST'])
+@login_required
+def create_export():
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+    resource_types = data.get('_type') or request.args.get('_type') or RESOURCE_TYPES
+    if isinstance(resource_types, str):
+        resource_types = [t.strip() for t in resource_types.split(',') if t.strip()]
+    unknown = [t for t in resource_types if t not in RESOURCE_TYPES]
+    if unknown:
+        return jsonify({'message': f"Unsupported resource types: {', '.join(unknown)}"}), 400
+
+    since = data.get('_since') or request.args.get('_since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since.replace('Z', '+00:00')).replace(tzinfo=None)
+        except ValueError:
+            return jsonify({'message': 'Invalid _since, expected an ISO 8601 timestamp'}), 400
+
+    job = ExportJob(resource_types=json.dumps(resource_types), since=since or None, requested_by=current_user.id)
+    db = get_db()
+    db.session.add(job)
+    db.session.commit()
+
+    start_export(job.id)
+
+    response = jsonify({'message': 'Export started', 'job_id': job.id})
+    response.status_code = 202
+    response.headers['Content-Location'] = url_for('export.get_export_status', job_id=job.id, _external=True)
+    return response
+
+@export_bp.route('/', methods=['GET'])
+@login_required
+def list_exports():
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    jobs = ExportJob.query.order_by(ExportJob.created_at.desc()).limit(50).all()
+    return jsonify([_manifest(job) for job in jobs]), 200
+
+# Poll an export: 202 while running, 200 with the manifest once complete
+@export_bp.route('/<int:job_id>', methods=['GET'])
+@login_required
+def get_export_status(job_id):
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    job = ExportJob.query.get(job_id)
+    if not job:
+        return jsonify({'message': 'Export not found'}), 404
+
+    if job.status in ['queued', 'running']:
+        done = len(json.loads(job.output)) if job.output else 0
+        response = jsonify(_manifest(job))
+        response.status_code = 202
+        response.headers['X-Progress'] = f'{done} of {len(json.loads(job.resource_types))} resource types written'
+        response.headers['Retry-After'] = '5'
+        return response
+    if job.status == 'failed':
+        return jsonify(_manifest(job)), 500
+    return jsonify(_manifest(job)), 200
+
+@export_bp.route('/<int:job_id>/<resource_type>.ndjson', methods=['GET'])
+@login_required
+def download_export_file(job_id, resource_type):
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    job = ExportJob.query.get(job_id)
+    if not job or resource_type not in RESOURCE_TYPES:
+        return jsonify({'message': 'Export not found'}), 404
+
+    path = os.path.join(job_folder(job.id), f'{resource_type}.ndjson')
+    if not os.path.exists(path):
+        return jsonify({'message': 'Export file not available'}), 404
+
+    return send_file(path, mimetype='application/fhir+ndjson', as_attachment=True,
+                     download_name=f'export-{job.id}-{resource_type}.ndjson', conditional=True)
+
+@export_bp.route('/<int:job_id>', methods=['DELETE'])
+@login_required
+def delete_export(job_id):
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    job = ExportJob.query.get(job_id)
+    if not job:
+        return jsonify({'message': 'Export not found'}), 404
+    if job.status in ['queued', 'running']:
+        return jsonify({'message': 'Export is still running'}), 409
+
+    delete_export_files(job.id)
+    db = get_db()
+    db.session.delete(job)
+    db.session.commit()
+
+    return jsonify({'message': 'Export deleted successfully'}), 200
@@ -1,7 +1,13 @@
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import func, cast, Integer, text
+from search_index import search_available, build_match_query
 import json
+from structured_records import sync_record_lines, delete_record_lines, normalize_analyte, CRITICAL_FLAGS
+from patient_summary import refresh_patient_summary, get_patient_summary
+from access_audit import access_audit
+from interaction_checker import check_prescriptions
 
 def get_db():
     return current_app.db
@@ -12,15 +18,37 @@ Patient = None
 Doctor = None
 Department = None
 User = None
+LabObservation = None
+RecordAccessLog = None
 
 def init_medical_records_models(db):
-    global MedicalRecord, Patient, Doctor, Department, User
+    global MedicalRecord, Patient, Doctor, Department, User, LabObservation, RecordAccessLog
     from models import MedicalRecord as MRModel, Patient as PatientModel, Doctor as DoctorModel, Department as DeptModel, User as UserModel
+    from models import LabObservation as LabModel, RecordAccessLog as AccessLogModel
     MedicalRecord = MRModel
     Patient = PatientModel
     Doctor = DoctorModel
     Department = DeptModel
     User = UserModel
+    LabObservation = LabModel
+    RecordAccessLog = AccessLogModel
+
+def _check_patient_access(patient_id):
+    """Return an error response if the current user may not read this patient's records"""
+    if current_user.role == 'patient':
+        patient = Patient.query.filter_by(user_id=current_user.id).first()
+        if not patient or patient.id != patient_id:
+            return jsonify({'error': 'Unauthorized to view these records'}), 403
+    elif current_user.role == 'department':
+        # Department users can view records for patients in their department
+        department = Department.query.filter_by(user_id=current_user.id).first()
+        if not department:
+            return jsonify({'error': 'Department not found'}), 404
+        # Check if patient has records in this department
+        has_records = MedicalRecord.query.filter_by(patient_id=patient_id, department_id=department.id).first()
+        if not has_records:
+            return jsonify({'error': 'No records found for this patient in your department'}), 404
+    return None
 
 medical_records_bp = Blueprint('medical_records', __name__)
 
@@ -30,19 +58,9 @@ def get_patient_records(patient_id):
     """Get medical records for a specific patient"""
     try:
         # Check permissions
-        if current_user.role == 'patient':
-            patient = Patient.query.filter_by(user_id=current_user.id).first()
-            if not patient or patient.id != patient_id:
-                return jsonify({'error': 'Unauthorized to view these records'}), 403
-        elif current_user.role == 'department':
-            # Department users can view records for patients in their department
-            department = Department.query.filter_by(user_id=current_user.id).first()
-            if not department:
-                return jsonify({'error': 'Department not found'}), 404
-            # Check if patient has records in this department
-            has_records = MedicalRecord.query.filter_by(patient_id=patient_id, department_id=department.id).first()
-            if not has_records:
-                return jsonify({'error': 'No records found for this patient in your department'}), 404
+        access_error = _check_patient_access(patient_id)
+        if access_error:
+            return access_error
 
         # Get query parameters
         limit = request.args.get('limit', 50, type=int)
@@ -61,6 +79,7 @@ def get_patient_records(patient_id):
             query = query.filter(MedicalRecord.visit_date <= datetime.strptime(date_to, '%Y-%m-%d').date())
 
         records = query.order_by(MedicalRecord.visit_date.desc()).limit(limit).offset(offset).all()
+        access_audit.record('list_records', patient_id, [record.id for record in records])
 
         result = []
         for record in records:
@@ -146,11 +165,15 @@ def create_medical_record():
 
         db = get_db()
         db.session.add(record)
+        db.session.flush()
+        _, prescription_lines = sync_record_lines(record)
+        refresh_patient_summary(record.patient_id, 'records')
         db.session.commit()
 
         return jsonify({
             'message': 'Medical record created successfully',
-            'record_id': record.id
+            'record_id': record.id,
+            'warnings': check_prescriptions(prescription_lines, Patient.query.get(record.patient_id))
         }), 201
 
     except ValueError as e:
@@ -176,6 +199,8 @@ def get_medical_record(record_id):
             if not department or department.id != record.department_id:
                 return jsonify({'error': 'Unauthorized to view this record'}), 403
 
+        access_audit.record('view_record', record.patient_id, [record.id])
+
         return jsonify({
             'id': record.id,
             'patient_id': record.patient_id,
@@ -236,9 +261,17 @@ def update_medical_record(record_id):
 
         record.updated_at = datetime.utcnow()
 
+        warnings = []
+        if any(field in data for field in ['lab_results', 'prescriptions', 'visit_date']):
+            _, prescription_lines = sync_record_lines(record)
+            if 'prescriptions' in data:
+                warnings = check_prescriptions(prescription_lines, Patient.query.get(record.patient_id))
+        refresh_patient_summary(record.patient_id, 'records')
+
+        db = get_db()
         db.session.commit()
 
-        return jsonify({'message': 'Medical record updated successfully'})
+        return jsonify({'message': 'Medical record updated successfully', 'warnings': warnings})
 
     except ValueError as e:
         return jsonify({'error': 'Invalid date format'}), 400
@@ -258,11 +291,388 @@ def delete_medical_record(record_id):
             return jsonify({'error': 'Only administrators can delete medical records'}), 403
 
         db = get_db()
+        delete_record_lines(record.id)
         db.session.delete(record)
+        refresh_patient_summary(record.patient_id, 'records')
         db.session.commit()
 
         return jsonify({'message': 'Medical record deleted successfully'})
 
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@medical_records_bp.route('/patient/<int:patient_id>/summary', methods=['GET'])
+@login_required
+def get_patient_header(patient_id):
+    """Get the patient header (latest vitals, last visit, prescriptions, open tickets) from its summary row"""
+    try:
+        access_error = _check_patient_access(patient_id)
+        if access_error:
+            return access_error
+
+        summary = get_patient_summary(patient_id)
+        if not summary:
+            return jsonify({'error': 'Patient not found'}), 404
+        access_audit.record('summary', patient_id)
+
+        return jsonify({
+            'patient_id': summary.patient_id,
+            'name': summary.name,
+            'medical_record_number': summary.medical_record_number,
+            'age': summary.age,
+            'gender': summary.gender,
+            'blood_type': summary.blood_type,
+            'allergies': summary.allergies,
+            'chronic_conditions': summary.chronic_conditions,
+            'last_visit': {
+                'record_id': summary.last_visit_record_id,
+                'visit_date': summary.last_visit_date.isoformat(),
+                'visit_type': summary.last_visit_type,
+                'department_id': summary.last_visit_department_id,
+                'diagnosis': summary.last_diagnosis
+            } if summary.last_visit_date else None,
+            'latest_vitals': {
+                'visit_date': summary.vitals_date.isoformat(),
+                'blood_pressure': f"{summary.blood_pressure_systolic}/{summary.blood_pressure_diastolic}" if summary.blood_pressure_systolic and summary.blood_pressure_diastolic else None,
+                'heart_rate': summary.heart_rate,
+                'temperature': summary.temperature,
+                'weight': summary.weight,
+                'height': summary.height,
+                'bmi': summary.bmi
+            } if summary.vitals_date else None,
+            'active_prescriptions': json.loads(summary.active_prescriptions) if summary.active_prescriptions else [],
+            'open_ticket_count': summary.open_ticket_count or 0,
+            'open_tickets': json.loads(summary.open_tickets) if summary.open_tickets else [],
+            'upcoming_appointment_count': summary.upcoming_appointment_count or 0,
+            'next_appointment': {
+                'id': summary.next_appointment_id,
+                'date': summary.next_appointment_date.isoformat(),
+                'time': summary.next_appointment_time.strftime('%H:%M'),
+                'type': summary.next_appointment_type
+            } if summary.next_appointment_date else None,
+            'refreshed_at': summary.refreshed_at.isoformat() if summary.refreshed_at else None
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@medical_records_bp.route('/patient/<int:patient_id>/labs/<analyte>/trend', methods=['GET'])
+@login_required
+def get_lab_trend(patient_id, analyte):
+    """Get one analyte's results over time for a patient"""
+    try:
+        access_error = _check_patient_access(patient_id)
+        if access_error:
+            return access_error
+
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
+
+        query = LabObservation.query.filter_by(patient_id=patient_id, analyte=normalize_analyte(analyte))
+        if date_from:
+            query = query.filter(LabObservation.visit_date >= datetime.strptime(date_from, '%Y-%m-%d').date())
+        if date_to:
+            query = query.filter(LabObservation.visit_date <= datetime.strptime(date_to, '%Y-%m-%d').date())
+
+        observations = query.order_by(LabObservation.visit_date, LabObservation.id).all()
+        access_audit.record('lab_trend', patient_id, sorted({o.record_id for o in observations}))
+
+        return jsonify({
+            'patient_id': patient_id,
+            'analyte': normalize_analyte(analyte),
+            'points': [{
+                'record_id': o.record_id,
+                'visit_date': o.visit_date.isoformat(),
+                'value': o.value,
+                'value_text': o.value_text,
+                'unit': o.unit,
+                'reference_range': o.reference_range,
+                'reference_low': o.reference_low,
+                'reference_high': o.reference_high,
+                'flag': o.flag
+            } for o in observations]
+        })
+
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@medical_records_bp.route('/labs/abnormal', methods=['GET'])
+@login_required
+def get_abnormal_results():
+    """Worklist of abnormal lab results for a department, newest first"""
+    try:
+        if current_user.role == 'department':
+            department = Department.query.filter_by(user_id=current_user.id).first()
+            if not department:
+                return jsonify({'error': 'Department not found'}), 404
+            department_id = department.id
+        elif current_user.role == 'admin':
+            department_id = request.args.get('department_id', type=int)
+        else:
+            return jsonify({'error': 'Unauthorized to view lab worklists'}), 403
+
+        # Served by ix_lab_observation_worklist (department_id, is_abnormal, visit_date)
+        query = LabObservation.query.filter(LabObservation.is_abnormal.is_(True))
+        if department_id:
+            query = query.filter(LabObservation.department_id == department_id)
+        if request.args.get('date_from'):
+            query = query.filter(LabObservation.visit_date >= datetime.strptime(request.args['date_from'], '%Y-%m-%d').date())
+        if request.args.get('date_to'):
+            query = query.filter(LabObservation.visit_date <= datetime.strptime(request.args['date_to'], '%Y-%m-%d').date())
+        if request.args.get('severity') == 'critical':
+            query = query.filter(LabObservation.flag.in_(CRITICAL_FLAGS))
+
+        page = request.args.get('page', 1, type=int)
+        per_page = min(request.args.get('per_page', 50, type=int), 200)
+        results = query.order_by(LabObservation.visit_date.desc(), LabObservation.id.desc())\
+            .paginate(page=page, per_page=per_page, error_out=False)
+
+        patients = {p.id: p.name for p in Patient.query.filter(Patient.id.in_({o.patient_id for o in results.items}))}
+        access_audit.record('lab_worklist', None, sorted({o.record_id for o in results.items}))
+
+        return jsonify({
+            'results': [{
+                'id': o.id,
+                'record_id': o.record_id,
+                'patient_id': o.patient_id,
+                'patient_name': patients.get(o.patient_id),
+                'department_id': o.department_id,
+                'visit_date': o.visit_date.isoformat(),
+                'analyte': o.analyte,
+                'analyte_name': o.analyte_name,
+                'value': o.value,
+                'unit': o.unit,
+                'reference_range': o.reference_range,
+                'flag': o.flag
+            } for o in results.items],
+            'total': results.total,
+            'pages': results.pages,
+            'current_page': page
+        })
+
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@medical_records_bp.route('/structured/backfill', methods=['POST'])
+@login_required
+def backfill_structured_records():
+    """Rebuild lab observations and prescription lines from existing records"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only administrators can run backfills'}), 403
+
+    try:
+        from structured_records import backfill_record_lines
+        count = backfill_record_lines()
+        return jsonify({'message': 'Structured records backfilled', 'records': count})
+
+    except Exception as e:
+        get_db().session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+VITAL_COLUMNS = ['blood_pressure_systolic', 'blood_pressure_diastolic', 'heart_rate', 'temperature', 'weight', 'bmi']
+MAX_VITAL_BUCKETS = 1000
+
+@medical_records_bp.route('/patient/<int:patient_id>/vitals', methods=['GET'])
+@login_required
+def get_patient_vitals(patient_id):
+    """Get a patient's vital signs over time, optionally downsampled into buckets"""
+    try:
+        access_error = _check_patient_access(patient_id)
+        if access_error:
+            return access_error
+
+        date_from = request.args.get('date_from')
+        date_to = request.args.get('date_to')
+        buckets = request.args.get('buckets', type=int)
+        if buckets is not None and not 0 < buckets <= MAX_VITAL_BUCKETS:
+            return jsonify({'error': f'buckets must be between 1 and {MAX_VITAL_BUCKETS}'}), 400
+
+        db = get_db()
+        filters = [MedicalRecord.patient_id == patient_id]
+        if date_from:
+            filters.append(MedicalRecord.visit_date >= datetime.strptime(date_from, '%Y-%m-%d').date())
+        if date_to:
+            filters.append(MedicalRecord.visit_date <= datetime.strptime(date_to, '%Y-%m-%d').date())
+
+        count, first_visit, last_visit = db.session.query(
+            func.count(MedicalRecord.id), func.min(MedicalRecord.visit_date), func.max(MedicalRecord.visit_date)
+        ).filter(*filters).one()
+        access_audit.record('vitals', patient_id)
+
+        columns = [getattr(MedicalRecord, name) for name in VITAL_COLUMNS]
+
+        if not buckets or count <= buckets:
+            rows = db.session.query(MedicalRecord.id, MedicalRecord.visit_date, *columns)\
+                .filter(*filters).order_by(MedicalRecord.visit_date, MedicalRecord.id).all()
+            return jsonify({
+                'patient_id': patient_id,
+                'downsampled': False,
+                'points': [dict(zip(['record_id', 'visit_date'] + VITAL_COLUMNS,
+                                    [row[0], row[1].isoformat()] + list(row[2:]))) for row in rows]
+            })
+
+        # Aggregate in the database: each visit falls into one of `buckets`
+        # equal-width date buckets and min/max/mean are computed per bucket
+        first_day = func.julianday(first_visit.isoformat())
+        span = (last_visit - first_visit).days + 1
+        bucket = cast((func.julianday(MedicalRecord.visit_date) - first_day) * buckets / span, Integer).label('bucket')
+
+        aggregates = []
+        for column in columns:
+            aggregates.extend([func.min(column), func.max(column), func.avg(column)])
+
+        rows = db.session.query(
+            bucket, func.min(MedicalRecord.visit_date), func.max(MedicalRecord.visit_date),
+            func.count(MedicalRecord.id), *aggregates
+        ).filter(*filters).group_by(bucket).order_by(bucket).all()
+
+        points = []
+        for row in rows:
+            point = {
+                'date_from': row[1].isoformat() if hasattr(row[1], 'isoformat') else row[1],
+                'date_to': row[2].isoformat() if hasattr(row[2], 'isoformat') else row[2],
+                'count': row[3]
+            }
+            for i, name in enumerate(VITAL_COLUMNS):
+                low, high, mean = row[4 + i * 3:7 + i * 3]
+                point[name] = {'min': low, 'max': high, 'mean': round(mean, 2) if mean is not None else None}
+            points.append(point)
+
+        return jsonify({
+            'patient_id': patient_id,
+            'downsampled': True,
+            'source_points': count,
+            'points': points
+        })
+
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@medical_records_bp.route('/search', methods=['GET'])
+@login_required
+def search_medical_records():
+    """Full-text search over complaint, diagnosis, treatment and notes, ranked by relevance"""
+    try:
+        db = get_db()
+        if not search_available(db):
+            return jsonify({'error': 'Full-text search is not available on this database'}), 501
+
+        match = build_match_query(request.args.get('q'))
+        if not match:
+            return jsonify({'error': 'Search query is required'}), 400
+
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        offset = request.args.get('offset', 0, type=int)
+        patient_id = request.args.get('patient_id', type=int)
+
+        conditions = ['medical_record_fts MATCH :match']
+        params = {'match': match, 'limit': limit, 'offset': offset}
+
+        # Same visibility as get_patient_records
+        if current_user.role == 'patient':
+            patient = Patient.query.filter_by(user_id=current_user.id).first()
+            if not patient:
+                return jsonify({'error': 'Patient profile not found'}), 404
+            conditions.append('m.patient_id = :own_patient_id')
+            params['own_patient_id'] = patient.id
+        elif current_user.role == 'department':
+            department = Department.query.filter_by(user_id=current_user.id).first()
+            if not department:
+                return jsonify({'error': 'Department not found'}), 404
+            conditions.append('m.patient_id IN (SELECT patient_id FROM medical_record WHERE department_id = :department_id)')
+            params['department_id'] = department.id
+
+        if patient_id:
+            conditions.append('m.patient_id = :patient_id')
+            params['patient_id'] = patient_id
+
+        # Column weights follow the index order: complaint, diagnosis, treatment, notes
+        rows = db.session.execute(text(f"""
+            SELECT m.id, m.patient_id, p.name, m.visit_date, m.visit_type, d.name, m.chief_complaint, m.diagnosis,
+                   snippet(medical_record_fts, -1, '[', ']', '...', 12),
+                   bm25(medical_record_fts, 4.0, 3.0, 2.0, 1.0) AS rank
+            FROM medical_record_fts
+            JOIN medical_record m ON m.id = medical_record_fts.rowid
+            LEFT JOIN patient p ON p.id = m.patient_id
+            LEFT JOIN department d ON d.id = m.department_id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY rank
+            LIMIT :limit OFFSET :offset
+        """), params).fetchall()
+        for row in rows:
+            access_audit.record('search', row[1], [row[0]])
+
+        return jsonify([{
+            'id': row[0],
+            'patient_id': row[1],
+            'patient_name': row[2],
+            'visit_date': row[3],
+            'visit_type': row[4],
+            'department_name': row[5],
+            'chief_complaint': row[6],
+            'diagnosis': row[7],
+            'snippet': row[8],
+            'score': -row[9]
+        } for row in rows])
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@medical_records_bp.route('/audit', methods=['GET'])
+@login_required
+def get_access_audit():
+    """Get medical record access entries for compliance review"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only administrators can view the access audit'}), 403
+
+    try:
+        # Make reads from the last few seconds visible before querying
+        access_audit.flush()
+
+        query = RecordAccessLog.query
+        for field in ['patient_id', 'user_id', 'record_id']:
+            value = request.args.get(field, type=int)
+            if value:
+                query = query.filter(getattr(RecordAccessLog, field) == value)
+        if request.args.get('action'):
+            query = query.filter(RecordAccessLog.action == request.args['action'])
+        if request.args.get('date_from'):
+            query = query.filter(RecordAccessLog.accessed_at >= datetime.strptime(request.args['date_from'], '%Y-%m-%d'))
+        if request.args.get('date_to'):
+            query = query.filter(RecordAccessLog.accessed_at < datetime.strptime(request.args['date_to'], '%Y-%m-%d') + timedelta(days=1))
+
+        page = request.args.get('page', 1, type=int)
+        per_page = min(request.args.get('per_page', 50, type=int), 500)
+        entries = query.order_by(RecordAccessLog.accessed_at.desc(), RecordAccessLog.id.desc())\
+            .paginate(page=page, per_page=per_page, error_out=False)
+
+        users = {u.id: u.username for u in User.query.filter(User.id.in_({e.user_id for e in entries.items}))}
+
+        return jsonify({
+            'entries': [{
+                'id': e.id,
+                'user_id': e.user_id,
+                'username': users.get(e.user_id),
+                'user_role': e.user_role,
+                'patient_id': e.patient_id,
+                'record_id': e.record_id,
+                'action': e.action,
+                'ip_address': e.ip_address,
+                'accessed_at': e.accessed_at.isoformat()
+            } for e in entries.items],
+            'total': entries.total,
+            'pages': entries.pages,
+            'current_page': page
+        })
+
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date format'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
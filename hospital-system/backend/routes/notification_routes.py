@@ -65,8 +65,8 @@ def mark_all_as_read():
 
     return jsonify({'message': 'All notifications marked as read'}), 200
 
-def create_notification(user_id, title, message, notification_type='info', ticket_id=None):
-    """Helper function to create notifications"""
+def create_notification(user_id, title, message, notification_type='info', ticket_id=None, commit=True):
+    """Helper function to create notifications; with commit=False it joins the caller's transaction"""
     notification = Notification(
         user_id=user_id,
         title=title,
@@ -77,11 +77,12 @@ def create_notification(user_id, title, message, notification_type='info', ticke
 
     db = get_db()
     db.session.add(notification)
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
     return notification
 
-def notify_ticket_assignment(ticket, assigned_user):
+def notify_ticket_assignment(ticket, assigned_user, commit=True):
     """Notify technician when ticket is assigned"""
     if assigned_user:
         create_notification(
@@ -89,10 +90,11 @@ def notify_ticket_assignment(ticket, assigned_user):
             title=f"New Ticket Assigned: #{ticket.id}",
             message=f"You have been assigned to ticket '{ticket.title}'. Priority: {ticket.priority}",
             notification_type='info',
-            ticket_id=ticket.id
+            ticket_id=ticket.id,
+            commit=commit
         )
 
-def notify_ticket_resolved(ticket, resolver_user):
+def notify_ticket_resolved(ticket, resolver_user, commit=True):
     """Notify relevant users when ticket is resolved"""
     # Notify the patient
     patient = User.query.get(ticket.patient_id)
@@ -102,7 +104,8 @@ def notify_ticket_resolved(ticket, resolver_user):
             title=f"Ticket Resolved: #{ticket.id}",
             message=f"Your ticket '{ticket.title}' has been resolved.",
             notification_type='success',
-            ticket_id=ticket.id
+            ticket_id=ticket.id,
+            commit=commit
         )
 
     # Notify the assigned technician (if different from resolver)
@@ -114,7 +117,8 @@ def notify_ticket_resolved(ticket, resolver_user):
                 title=f"Ticket Resolved: #{ticket.id}",
                 message=f"Ticket '{ticket.title}' has been marked as resolved.",
                 notification_type='success',
-                ticket_id=ticket.id
+                ticket_id=ticket.id,
+                commit=commit
             )
 
 def notify_ticket_comment(ticket, commenter_user, comment_text):
@@ -1,6 +1,17 @@
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
-from models import Patient, Ticket
+from models import Patient, Ticket, DuplicateCandidate
+from patient_summary import refresh_patient_summary
+from patient_dedup import merge_patients
+from ticket_dedup import check_duplicates
+from activity_log import record_created
+from sla_engine import update_sla
+from triage import update_triage_rank
+from search_index import search_available, build_substring_query, build_fuzzy_query, trigram_similarity
+from sqlalchemy import text, or_, and_
+import base64
+import json
+from datetime import datetime
 
 def get_db():
     return current_app.db
@@ -108,6 +119,7 @@ def update_profile():
     if 'insurance_group_number' in data:
         patient.insurance_group_number = data['insurance_group_number']
 
+    refresh_patient_summary(patient.id, 'profile')
     db = get_db()
     db.session.commit()
 
@@ -148,10 +160,237 @@ def create_ticket():
         priority=data.get('priority', 'medium'),
         category=data.get('category', 'general')
     )
+    update_triage_rank(ticket)
     db = get_db()
     db.session.add(ticket)
+    db.session.flush()
+    # Patients only see, and never link to, their own tickets
+    possible_duplicates = check_duplicates(ticket, patient_id=patient.id)
+    record_created('ticket', ticket)
+    update_sla(ticket)
+    refresh_patient_summary(patient.id, 'tickets')
     db.session.commit()
     return jsonify({
         'message': 'Ticket created successfully',
-        'ticket_id': ticket.id
-    }), 201
\ No newline at end of file
+        'ticket_id': ticket.id,
+        'duplicate_of_id': ticket.duplicate_of_id,
+        'possible_duplicates': possible_duplicates
+    }), 201
+
+DIRECTORY_PAGE_SIZE = 25
+FUZZY_CANDIDATES = 200
+FUZZY_MIN_SIMILARITY = 0.5
+
+def _encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode().rstrip('=')
+
+# Cursor mode -> keys and types it must carry
+CURSOR_FIELDS = {
+    'browse': {'name': (str,), 'id': (int,)},
+    'exact': {'name': (str,), 'id': (int,)},
+    'fuzzy': {'score': (int, float), 'id': (int,)}
+}
+
+def _decode_cursor(cursor):
+    """Return the cursor dict, or None if it is malformed or was not issued for a known mode"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or data.get('mode') not in CURSOR_FIELDS:
+        return None
+    for key, types in CURSOR_FIELDS[data['mode']].items():
+        # bool is an int subclass but never a valid name, id or score
+        if not isinstance(data.get(key), types) or isinstance(data[key], bool):
+            return None
+    return data
+
+def _directory_entry(patient, score=None):
+    entry = {
+        'id': patient.id,
+        'name': patient.name,
+        'medical_record_number': patient.medical_record_number,
+        'phone': patient.phone,
+        'email': patient.email,
+        'gender': patient.gender,
+        'age': patient.age,
+        'city': patient.city
+    }
+    if score is not None:
+        entry['score'] = round(score, 3)
+    return entry
+
+# Search and page through patients by name, phone, email or MRN
+@patient_bp.route('/directory', methods=['GET'])
+@login_required
+def get_patient_directory():
+    if current_user.role not in ['admin', 'manager', 'department']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    search = (request.args.get('q') or '').strip()
+    limit = min(max(request.args.get('limit', DIRECTORY_PAGE_SIZE, type=int), 1), 100)
+    cursor = _decode_cursor(request.args['cursor']) if request.args.get('cursor') else {}
+    # Search cursors are only valid together with the search they came from
+    if cursor is None or (cursor and (cursor['mode'] != 'browse') != bool(search)):
+        return jsonify({'message': 'Invalid cursor'}), 400
+
+    query = Patient.query
+    if request.args.get('gender'):
+        query = query.filter(Patient.gender == request.args['gender'])
+    if request.args.get('city'):
+        query = query.filter(Patient.city == request.args['city'])
+
+    mode = cursor.get('mode') or ('exact' if search else 'browse')
+    if search:
+        db = get_db()
+        if not search_available(db):
+            return jsonify({'message': 'Patient search is not available on this database'}), 501
+        match = build_substring_query(search)
+        if not match:
+            return jsonify({'message': 'Search term must be at least 3 characters'}), 400
+
+    if mode in ['browse', 'exact']:
+        page_query = query
+        if mode == 'exact':
+            page_query = page_query.filter(text('patient.id IN (SELECT rowid FROM patient_fts WHERE patient_fts MATCH :match)'))\
+                .params(match=match)
+        if cursor:
+            page_query = page_query.filter(or_(Patient.name > cursor['name'],
+                                               and_(Patient.name == cursor['name'], Patient.id > cursor['id'])))
+        # Keyset pagination over ix_patient_name (name, id)
+        patients = page_query.order_by(Patient.name, Patient.id).limit(limit + 1).all()
+
+        if mode == 'browse' or patients or cursor:
+            next_cursor = None
+            if len(patients) > limit:
+                last = patients[limit - 1]
+                next_cursor = _encode_cursor({'mode': mode, 'name': last.name, 'id': last.id})
+            return jsonify({
+                'patients': [_directory_entry(p) for p in patients[:limit]],
+                'match': mode,
+                'next_cursor': next_cursor
+            }), 200
+        mode = 'fuzzy'
+
+    # No substring match: rank the best trigram candidates by similarity to tolerate typos
+    db = get_db()
+    fuzzy_match = build_fuzzy_query(db, 'patient_fts_vocab', search, Patient.query.count())
+    candidate_ids = [row[0] for row in db.session.execute(text(
+        'SELECT rowid FROM patient_fts WHERE patient_fts MATCH :match ORDER BY bm25(patient_fts) LIMIT :limit'
+    ), {'match': fuzzy_match, 'limit': FUZZY_CANDIDATES})] if fuzzy_match else []
+
+    scored = []
+    for patient in query.filter(Patient.id.in_(candidate_ids)).all() if candidate_ids else []:
+        score = max(trigram_similarity(search, value or '') for value in
+                    [patient.name, patient.phone, patient.email, patient.medical_record_number])
+        if score >= FUZZY_MIN_SIMILARITY:
+            scored.append((-score, patient.id, patient))
+    scored.sort(key=lambda item: item[:2])
+    if cursor.get('mode') == 'fuzzy':
+        scored = [item for item in scored if item[:2] > (-cursor['score'], cursor['id'])]
+
+    page = scored[:limit]
+    next_cursor = None
+    if len(scored) > limit:
+        next_cursor = _encode_cursor({'mode': 'fuzzy', 'score': -page[-1][0], 'id': page[-1][1]})
+    return jsonify({
+        'patients': [_directory_entry(patient, -score) for score, _, patient in page],
+        'match': 'fuzzy',
+        'next_cursor': next_cursor
+    }), 200
+
+def _duplicate_side(patient):
+    if not patient:
+        return None
+    entry = _directory_entry(patient)
+    entry['date_of_birth'] = patient.date_of_birth.isoformat() if patient.date_of_birth else None
+    entry['created_at'] = patient.created_at.isoformat() if patient.created_at else None
+    return entry
+
+# Review queue of likely duplicate registrations found by patient_dedup.py
+@patient_bp.route('/duplicates', methods=['GET'])
+@login_required
+def get_duplicate_candidates():
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    page = int(request.args.get('page', 1))
+    per_page = min(int(request.args.get('per_page', 20)), 100)
+    status = request.args.get('status', 'pending')
+
+    candidates = DuplicateCandidate.query.filter_by(status=status)\
+        .order_by(DuplicateCandidate.score.desc(), DuplicateCandidate.id)\
+        .paginate(page=page, per_page=per_page, error_out=False)
+    patient_ids = {c.patient_id for c in candidates.items} | {c.duplicate_patient_id for c in candidates.items}
+    patients = {p.id: p for p in Patient.query.filter(Patient.id.in_(patient_ids))} if patient_ids else {}
+
+    return jsonify({
+        'candidates': [{
+            'id': c.id,
+            'score': c.score,
+            'reasons': json.loads(c.reasons) if c.reasons else [],
+            'status': c.status,
+            'patient': _duplicate_side(patients.get(c.patient_id)) or {'id': c.patient_id},
+            'duplicate': _duplicate_side(patients.get(c.duplicate_patient_id)) or {'id': c.duplicate_patient_id},
+            'detected_at': c.detected_at.isoformat() if c.detected_at else None,
+            'reviewed_by': c.reviewed_by,
+            'reviewed_at': c.reviewed_at.isoformat() if c.reviewed_at else None
+        } for c in candidates.items],
+        'total': candidates.total,
+        'pages': candidates.pages,
+        'current_page': page
+    }), 200
+
+@patient_bp.route('/duplicates/<int:candidate_id>/dismiss', methods=['POST'])
+@login_required
+def dismiss_duplicate_candidate(candidate_id):
+    if current_user.role not in ['admin', 'manager']:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    candidate = DuplicateCandidate.query.get_or_404(candidate_id)
+    if candidate.status != 'pending':
+        return jsonify({'message': f'Candidate is already {candidate.status}'}), 400
+
+    candidate.status = 'dismissed'
+    candidate.reviewed_by = current_user.id
+    candidate.reviewed_at = datetime.utcnow()
+    get_db().session.commit()
+    return jsonify({'message': 'Duplicate candidate dismissed'}), 200
+
+@patient_bp.route('/duplicates/<int:candidate_id>/merge', methods=['POST'])
+@login_required
+def merge_duplicate_candidate(candidate_id):
+    """Merge the pair into one patient; keeps the earlier registration unless "keep" names the other one"""
+    if current_user.role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    candidate = DuplicateCandidate.query.get_or_404(candidate_id)
+    if candidate.status != 'pending':
+        return jsonify({'message': f'Candidate is already {candidate.status}'}), 400
+
+    data = request.get_json(silent=True) or {}
+    keep = data.get('keep', candidate.patient_id)
+    if keep not in [candidate.patient_id, candidate.duplicate_patient_id]:
+        return jsonify({'message': 'keep must be one of the two patients'}), 400
+    remove = candidate.duplicate_patient_id if keep == candidate.patient_id else candidate.patient_id
+
+    db = get_db()
+    survivor = db.session.get(Patient, keep)
+    duplicate = db.session.get(Patient, remove)
+    if not survivor or not duplicate:
+        return jsonify({'message': 'Patient not found'}), 404
+
+    try:
+        result = merge_patients(survivor, duplicate, current_user.id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Merge failed: {str(e)}'}), 500
+
+    return jsonify({
+        'message': 'Patients merged successfully',
+        'patient_id': survivor.id,
+        'removed_patient_id': remove,
+        'moved': result['moved'],
+        'filled_fields': result['filled_fields']
+    }), 200
@@ -1,10 +1,18 @@
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
-from models import Ticket, TicketComment, TicketAttachment, User, Department, Patient
+from models import Ticket, TicketComment, TicketAttachment, User, Department, Patient, Technician
 from routes.notification_routes import notify_ticket_assignment, notify_ticket_resolved, notify_ticket_comment
+from patient_summary import refresh_patient_summary
+from ticket_dedup import open_ticket_index
+from search_index import search_available, build_ticket_match_query
+from sqlalchemy import text, select, union_all
 from datetime import datetime
-import os
 from werkzeug.utils import secure_filename
+from attachment_storage import store_upload, release_attachment, remove_blob_file, send_attachment, FileTooLarge, VARIANTS
+from image_previews import mark_for_previews, preview_worker, ready_previews
+from activity_log import record_comment, record_changes, snapshot
+from sla_engine import update_sla, active_policies
+from triage import update_triage_rank, current_score
 
 def get_db():
     return current_app.db
@@ -12,10 +20,16 @@ def get_db():
 ticket_bp = Blueprint('ticket', __name__)
 
 # Configuration for file uploads
-UPLOAD_FOLDER = 'uploads/tickets'
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'txt'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
+# A search matching more tickets than this ranks only the newest ones, so that
+# common words cost the same as rare ones; the response then says truncated
+SEARCH_RANK_WINDOW = 2000
+MAX_BULK_TICKETS = 200
+QUEUE_DEFAULT_SIZE = 20
+QUEUE_MAX_SIZE = 200
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -38,13 +52,18 @@ def get_ticket_details(ticket_id):
     
     # Get attachments
     attachments = TicketAttachment.query.filter_by(ticket_id=ticket_id).all()
+    previews = ready_previews([a.content_hash for a in attachments])
     attachments_data = [{
         'id': a.id,
         'filename': a.filename,
         'file_type': a.file_type,
         'file_size': a.file_size,
         'uploaded_by': User.query.get(a.uploaded_by).username if User.query.get(a.uploaded_by) else 'Unknown',
-        'uploaded_at': a.uploaded_at.isoformat() if a.uploaded_at else None
+        'uploaded_at': a.uploaded_at.isoformat() if a.uploaded_at else None,
+        'download_url': f'/ticket/{ticket_id}/attachment/{a.id}',
+        # Downscaled JPEGs for image attachments, once generated
+        'thumbnail_url': f'/ticket/{ticket_id}/attachment/{a.id}?variant=thumbnail' if a.content_hash in previews else None,
+        'preview_url': f'/ticket/{ticket_id}/attachment/{a.id}?variant=preview' if a.content_hash in previews else None
     } for a in attachments]
     
     # Get assigned user
@@ -67,6 +86,10 @@ def get_ticket_details(ticket_id):
         'created_at': ticket.created_at.isoformat() if ticket.created_at else None,
         'updated_at': ticket.updated_at.isoformat() if ticket.updated_at else None,
         'resolved_at': ticket.resolved_at.isoformat() if ticket.resolved_at else None,
+        'duplicate_of_id': ticket.duplicate_of_id,
+        'sla_status': ticket.sla_status,
+        'sla_warning_at': ticket.sla_warning_at.isoformat() if ticket.sla_warning_at else None,
+        'sla_due_at': ticket.sla_due_at.isoformat() if ticket.sla_due_at else None,
         'comments': comments_data,
         'attachments': attachments_data
     }), 200
@@ -97,6 +120,7 @@ def add_comment(ticket_id):
 
     db = get_db()
     db.session.add(comment)
+    record_comment('ticket', ticket_id, comment.comment)
     db.session.commit()
 
     # Send notification for new comment
@@ -138,39 +162,36 @@ def upload_attachment(ticket_id):
     if not allowed_file(file.filename):
         return jsonify({'message': 'File type not allowed'}), 400
 
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    file_size = file.tell()
-    file.seek(0)
-
-    if file_size > MAX_FILE_SIZE:
-        return jsonify({'message': 'File size exceeds 10MB limit'}), 400
-
-    # Save file
+    # Stream to content-addressed storage, hashing as it goes
     filename = secure_filename(file.filename)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    unique_filename = f"{timestamp}_{filename}"
-
-    # Create upload directory if it doesn't exist
-    upload_path = os.path.join(current_app.root_path, UPLOAD_FOLDER)
-    os.makedirs(upload_path, exist_ok=True)
-
-    filepath = os.path.join(upload_path, unique_filename)
-    file.save(filepath)
-
-    # Save attachment record
-    attachment = TicketAttachment(
-        ticket_id=ticket_id,
-        filename=filename,
-        filepath=filepath,
-        file_type=filename.rsplit('.', 1)[1].lower(),
-        file_size=file_size,
-        uploaded_by=current_user.id
-    )
+    try:
+        blob = store_upload(file.stream, MAX_FILE_SIZE)
+    except FileTooLarge:
+        return jsonify({'message': 'File size exceeds 10MB limit'}), 400
+    blob_file = blob.filepath
 
     db = get_db()
-    db.session.add(attachment)
-    db.session.commit()
+    try:
+        # Save attachment record
+        attachment = TicketAttachment(
+            ticket_id=ticket_id,
+            filename=filename,
+            filepath=blob.filepath,
+            file_type=filename.rsplit('.', 1)[1].lower(),
+            file_size=blob.size,
+            content_hash=blob.content_hash,
+            uploaded_by=current_user.id
+        )
+        mark_for_previews(blob, attachment.file_type)
+        db.session.add(attachment)
+        db.session.commit()
+    except Exception:
+        # The blob file is already in place; drop it unless another upload's row refers to it
+        db.session.rollback()
+        remove_blob_file(blob_file)
+        raise
+    if blob.preview_status == 'pending':
+        preview_worker.submit(blob.content_hash)
 
     return jsonify({
         'message': 'File uploaded successfully',
@@ -183,6 +204,56 @@ def upload_attachment(ticket_id):
         }
     }), 201
 
+# Download attachment, or its thumbnail/preview with ?variant= (supports Range and conditional requests)
+@ticket_bp.route('/<int:ticket_id>/attachment/<int:attachment_id>', methods=['GET'])
+@login_required
+def download_attachment(ticket_id, attachment_id):
+    ticket = Ticket.query.get(ticket_id)
+    if not ticket:
+        return jsonify({'message': 'Ticket not found'}), 404
+
+    # Role-based access: same as comments
+    if current_user.role == 'technician' and ticket.assigned_to != current_user.id:
+        return jsonify({'message': 'Unauthorized: Can only download from assigned tickets'}), 403
+    elif current_user.role == 'patient':
+        patient = Patient.query.filter_by(user_id=current_user.id).first()
+        if not patient or ticket.patient_id != patient.id:
+            return jsonify({'message': 'Unauthorized: Can only download from own tickets'}), 403
+
+    attachment = TicketAttachment.query.filter_by(id=attachment_id, ticket_id=ticket_id).first()
+    if not attachment:
+        return jsonify({'message': 'Attachment not found'}), 404
+
+    variant = request.args.get('variant')
+    if variant and variant not in VARIANTS:
+        return jsonify({'message': f"variant must be one of: {', '.join(VARIANTS)}"}), 400
+
+    response = send_attachment(attachment, variant)
+    if response is None:
+        if variant:
+            return jsonify({'message': 'Preview not available'}), 404
+        return jsonify({'message': 'Attachment file is missing'}), 410
+    return response
+
+# Delete attachment; the stored file is removed once no attachment uses it
+@ticket_bp.route('/<int:ticket_id>/attachment/<int:attachment_id>', methods=['DELETE'])
+@login_required
+def delete_attachment(ticket_id, attachment_id):
+    attachment = TicketAttachment.query.filter_by(id=attachment_id, ticket_id=ticket_id).first()
+    if not attachment:
+        return jsonify({'message': 'Attachment not found'}), 404
+
+    if current_user.role not in ['admin', 'manager'] and attachment.uploaded_by != current_user.id:
+        return jsonify({'message': 'Unauthorized: Can only delete own attachments'}), 403
+
+    db = get_db()
+    orphaned = release_attachment(attachment)
+    db.session.delete(attachment)
+    db.session.commit()
+    remove_blob_file(orphaned)
+
+    return jsonify({'message': 'Attachment deleted successfully'}), 200
+
 # Update ticket priority
 @ticket_bp.route('/<int:ticket_id>/priority', methods=['PUT'])
 @login_required
@@ -201,7 +272,12 @@ def update_priority(ticket_id):
     if priority not in ['low', 'medium', 'high', 'critical']:
         return jsonify({'message': 'Invalid priority level'}), 400
 
+    before = snapshot(ticket)
     ticket.priority = priority
+    record_changes('ticket', ticket, before)
+    update_sla(ticket)
+    update_triage_rank(ticket)
+    refresh_patient_summary(ticket.patient_id, 'tickets')
     db = get_db()
     db.session.commit()
 
@@ -230,10 +306,13 @@ def assign_ticket(ticket_id):
         if user.role not in ['technician', 'admin', 'manager']:
             return jsonify({'message': 'Can only assign to technicians or managers'}), 400
 
+    before = snapshot(ticket)
     ticket.assigned_to = user_id
     # Auto-set status to in_progress when assigned
     if user_id and ticket.status == 'open':
         ticket.status = 'in_progress'
+    record_changes('ticket', ticket, before)
+    refresh_patient_summary(ticket.patient_id, 'tickets')
 
     db = get_db()
     db.session.commit()
@@ -268,21 +347,215 @@ def update_ticket_status(ticket_id):
             return jsonify({'message': 'Technicians can only set status to in_progress or closed'}), 400
     # Admins and managers have full access
 
+    before = snapshot(ticket)
     ticket.status = status
 
     # Set resolved_at when ticket is closed
     if status == 'closed' and not ticket.resolved_at:
         ticket.resolved_at = datetime.utcnow()
-        # Send notification when ticket is resolved
-        notify_ticket_resolved(ticket, current_user)
+        # Send notification when ticket is resolved, in the same transaction as the change
+        notify_ticket_resolved(ticket, current_user, commit=False)
     elif status != 'closed':
         ticket.resolved_at = None
+    record_changes('ticket', ticket, before)
+    update_sla(ticket)
+    refresh_patient_summary(ticket.patient_id, 'tickets')
 
     db = get_db()
     db.session.commit()
+    open_ticket_index.update(ticket)
 
     return jsonify({'message': 'Status updated successfully'}), 200
 
+def _bulk_changes(ticket, data, now):
+    """Return (changes, error) for one ticket; the rules match the single-ticket routes"""
+    is_manager = current_user.role in ['admin', 'manager']
+    changes = {}
+    if ('priority' in data or 'assigned_to' in data) and not is_manager:
+        return None, 'Only managers can change priority or assignment'
+    if 'status' in data:
+        if current_user.role == 'technician':
+            if ticket.assigned_to != current_user.id:
+                return None, 'Can only update assigned tickets'
+            if data['status'] not in ['in_progress', 'closed']:
+                return None, 'Technicians can only set status to in_progress or closed'
+        elif not is_manager:
+            return None, 'Only maintenance staff can update ticket status'
+
+    if 'assigned_to' in data:
+        changes['assigned_to'] = data['assigned_to']
+        # Auto-set status to in_progress when assigned
+        if data['assigned_to'] and ticket.status == 'open':
+            changes['status'] = 'in_progress'
+    if 'priority' in data:
+        changes['priority'] = data['priority']
+    if 'status' in data:
+        changes['status'] = data['status']
+    if changes.get('status') == 'closed' and not ticket.resolved_at:
+        changes['resolved_at'] = now
+    elif changes.get('status', 'closed') != 'closed':
+        changes['resolved_at'] = None
+    return {field: value for field, value in changes.items() if getattr(ticket, field) != value}, None
+
+# Apply the same status, priority and/or assignment change to many tickets at once
+@ticket_bp.route('/bulk', methods=['POST'])
+@login_required
+def bulk_update_tickets():
+    """Update up to MAX_BULK_TICKETS tickets in one transaction; returns a result per ticket"""
+    data = request.get_json() or {}
+    ticket_ids = data.get('ticket_ids')
+    if not isinstance(ticket_ids, list) or not ticket_ids or not all(isinstance(i, int) for i in ticket_ids):
+        return jsonify({'message': 'ticket_ids must be a non-empty list of ticket ids'}), 400
+    if len(ticket_ids) > MAX_BULK_TICKETS:
+        return jsonify({'message': f'At most {MAX_BULK_TICKETS} tickets can be updated at once'}), 400
+
+    requested = {field: data[field] for field in ['status', 'priority', 'assigned_to'] if field in data}
+    if not requested:
+        return jsonify({'message': 'Provide at least one of status, priority or assigned_to'}), 400
+    if 'status' in requested and requested['status'] not in ['open', 'in_progress', 'closed']:
+        return jsonify({'message': 'Invalid status'}), 400
+    if 'priority' in requested and requested['priority'] not in ['low', 'medium', 'high', 'critical']:
+        return jsonify({'message': 'Invalid priority level'}), 400
+    assigned_user = None
+    if requested.get('assigned_to'):
+        assigned_user = User.query.get(requested['assigned_to'])
+        if not assigned_user:
+            return jsonify({'message': 'User not found'}), 404
+        if assigned_user.role not in ['technician', 'admin', 'manager']:
+            return jsonify({'message': 'Can only assign to technicians or managers'}), 400
+
+    db = get_db()
+    tickets = {t.id: t for t in Ticket.query.filter(Ticket.id.in_(ticket_ids)).all()}
+    now = datetime.utcnow()
+    results = []
+    updated = []
+    groups = {}  # identical change sets -> ticket ids, so each set is one UPDATE
+    for ticket_id in dict.fromkeys(ticket_ids):
+        ticket = tickets.get(ticket_id)
+        if not ticket:
+            results.append({'ticket_id': ticket_id, 'result': 'not_found'})
+            continue
+        changes, error = _bulk_changes(ticket, requested, now)
+        if error:
+            results.append({'ticket_id': ticket_id, 'result': 'forbidden', 'message': error})
+        elif not changes:
+            results.append({'ticket_id': ticket_id, 'result': 'unchanged'})
+        else:
+            results.append({'ticket_id': ticket_id, 'result': 'updated',
+                            'changes': {field: value for field, value in changes.items() if field != 'resolved_at'}})
+            groups.setdefault(tuple(sorted(changes.items())), []).append(ticket_id)
+            updated.append((ticket, snapshot(ticket)))
+
+    for changes, ids in groups.items():
+        # 'evaluate' applies the values to the loaded tickets as well
+        Ticket.query.filter(Ticket.id.in_(ids)).update(dict(changes), synchronize_session='evaluate')
+
+    # Users are loaded once here so the notification helpers find them in the session
+    user_ids = {t.patient_id for t, _ in updated} | {t.assigned_to for t, _ in updated if t.assigned_to}
+    if user_ids:
+        User.query.filter(User.id.in_(user_ids)).all()
+    policies = active_policies()
+    for ticket, before in updated:
+        record_changes('ticket', ticket, before)
+        if (ticket.status, ticket.priority) != (before['status'], before['priority']):
+            update_sla(ticket, policies, now)
+        if ticket.priority != before['priority']:
+            update_triage_rank(ticket)
+        if assigned_user and before['assigned_to'] != ticket.assigned_to:
+            notify_ticket_assignment(ticket, assigned_user, commit=False)
+        if ticket.status == 'closed' and before['status'] != 'closed':
+            notify_ticket_resolved(ticket, current_user, commit=False)
+    for patient_id in {ticket.patient_id for ticket, _ in updated}:
+        refresh_patient_summary(patient_id, 'tickets')
+    status_changed = [ticket.id for ticket, before in updated if ticket.status != before['status']]
+    db.session.commit()
+
+    if status_changed:
+        # Reload the committed tickets in one query rather than one per ticket
+        for ticket in Ticket.query.filter(Ticket.id.in_(status_changed)).all():
+            open_ticket_index.update(ticket)
+
+    return jsonify({
+        'message': f'{len(updated)} of {len(results)} tickets updated',
+        'updated': len(updated),
+        'results': results
+    }), 200
+
+# Search ticket text and comments, combined with the /list filters
+@ticket_bp.route('/search', methods=['GET'])
+@login_required
+def search_tickets():
+    """Full-text search over title, description, location and comments, ranked by relevance"""
+    db = get_db()
+    if not search_available(db):
+        return jsonify({'message': 'Full-text search is not available on this database'}), 501
+
+    filters = {field: request.args.get(field) for field in ['status', 'priority', 'category', 'department_id', 'assigned_to']}
+    for field in ['department_id', 'assigned_to']:
+        if filters[field] and filters[field] != 'none' and not filters[field].isdigit():
+            return jsonify({'message': f'Invalid {field}'}), 400
+    if current_user.role == 'patient':
+        # Patients can only find their own tickets
+        patient = Patient.query.filter_by(user_id=current_user.id).first()
+        if not patient:
+            return jsonify({'message': 'Patient not found'}), 404
+        filters['patient_id'] = patient.id
+
+    match = build_ticket_match_query(request.args.get('q'), filters)
+    if not match:
+        return jsonify({'message': 'Search query is required'}), 400
+
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    offset = request.args.get('offset', 0, type=int)
+    window = max(SEARCH_RANK_WINDOW, offset + limit)
+
+    # Walking the doclist newest-first is cheap; scoring every match of a common word is not.
+    # A second row past the window means older matches are left out of the ranking
+    beyond = [row[0] for row in db.session.execute(text(
+        'SELECT rowid FROM ticket_fts WHERE ticket_fts MATCH :match ORDER BY rowid DESC LIMIT 2 OFFSET :window'
+    ), {'match': match, 'window': window - 1})]
+    floor = beyond[0] if beyond else 0
+    truncated = len(beyond) > 1
+
+    # Column weights follow the index order: title, description, location, comments, facets.
+    # snippet(-1) could pick the facets column, so each text column is snippeted and the best one kept
+    rows = db.session.execute(text("""
+        SELECT t.id, t.title, t.status, t.priority, t.category, t.patient_id, t.department_id, t.assigned_to,
+               t.created_at, t.updated_at,
+               bm25(ticket_fts, 4.0, 2.0, 2.0, 1.0, 0.0) AS rank,
+               snippet(ticket_fts, 0, '[', ']', '...', 12), snippet(ticket_fts, 1, '[', ']', '...', 12),
+               snippet(ticket_fts, 2, '[', ']', '...', 12), snippet(ticket_fts, 3, '[', ']', '...', 12)
+        FROM ticket_fts
+        JOIN ticket t ON t.id = ticket_fts.rowid
+        WHERE ticket_fts MATCH :match AND ticket_fts.rowid >= :floor
+        ORDER BY rank
+        LIMIT :limit OFFSET :offset
+    """), {'match': match, 'floor': floor, 'limit': limit, 'offset': offset}).fetchall()
+
+    patient_ids = {row[5] for row in rows}
+    department_ids = {row[6] for row in rows}
+    user_ids = {row[7] for row in rows if row[7]}
+    patients = dict(db.session.query(Patient.id, Patient.name).filter(Patient.id.in_(patient_ids))) if patient_ids else {}
+    departments = dict(db.session.query(Department.id, Department.name).filter(Department.id.in_(department_ids))) if department_ids else {}
+    users = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids))) if user_ids else {}
+
+    tickets = [{
+        'id': row[0],
+        'title': row[1],
+        'status': row[2],
+        'priority': row[3],
+        'category': row[4],
+        'patient': patients.get(row[5], 'Unknown'),
+        'department': departments.get(row[6], 'Unknown'),
+        'assigned_to': users.get(row[7]),
+        'created_at': row[8].replace(' ', 'T') if row[8] else None,
+        'updated_at': row[9].replace(' ', 'T') if row[9] else None,
+        'snippet': max(row[11:15], key=lambda snippet: (snippet or '').count('[')),
+        'score': -row[10]
+    } for row in rows]
+    # truncated: only the newest SEARCH_RANK_WINDOW matches were ranked; the client should ask for a narrower query
+    return jsonify({'tickets': tickets, 'truncated': truncated}), 200
+
 # Get tickets with filters
 @ticket_bp.route('/list', methods=['GET'])
 @login_required
@@ -330,4 +603,71 @@ def get_tickets_filtered():
             'updated_at': t.updated_at.isoformat() if t.updated_at else None
         })
     
-    return jsonify(tickets_data), 200
\ No newline at end of file
+    return jsonify(tickets_data), 200
+
+# Most urgent tickets first, per department or per skill, read in order from the triage indexes
+@ticket_bp.route('/queue', methods=['GET'])
+@login_required
+def get_ticket_queue():
+    """Top tickets by triage score; filter by department_id, category (comma-separated) or technician_id (their skills)"""
+    if current_user.role == 'patient':
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    status = request.args.get('status', 'open')
+    if status not in ['open', 'in_progress']:
+        return jsonify({'message': 'status must be open or in_progress'}), 400
+    limit = min(max(request.args.get('limit', QUEUE_DEFAULT_SIZE, type=int), 1), QUEUE_MAX_SIZE)
+    department_id = request.args.get('department_id', type=int)
+    categories = [c.strip() for c in request.args.get('category', '').split(',') if c.strip()]
+
+    technician_id = request.args.get('technician_id', type=int)
+    technician = None
+    if technician_id:
+        technician = Technician.query.get(technician_id)
+        if not technician:
+            return jsonify({'message': 'Technician not found'}), 404
+    elif current_user.role == 'technician' and not (department_id or categories):
+        # A technician's default queue is the one for their own skills
+        technician = Technician.query.filter_by(user_id=current_user.id).first()
+    if technician:
+        categories = technician.get_skills_list()
+        if not categories:
+            return jsonify([]), 200
+
+    filters = [Ticket.status == status, Ticket.triage_rank.isnot(None)]
+    if department_id:
+        filters.append(Ticket.department_id == department_id)
+    if len(categories) > 1:
+        # Each category is one index range already in rank order; only their first rows are merged
+        parts = [select(Ticket.id, Ticket.triage_rank).where(*filters, Ticket.category == category)
+                 .order_by(Ticket.triage_rank).limit(limit).subquery() for category in categories]
+        top = union_all(*[select(part) for part in parts]).subquery()
+        query = Ticket.query.join(top, Ticket.id == top.c.id).order_by(top.c.triage_rank)
+    else:
+        if categories:
+            filters.append(Ticket.category == categories[0])
+        query = Ticket.query.filter(*filters).order_by(Ticket.triage_rank)
+    tickets = query.limit(limit).all()
+
+    department_ids = {t.department_id for t in tickets}
+    user_ids = {t.assigned_to for t in tickets if t.assigned_to}
+    departments = dict(get_db().session.query(Department.id, Department.name)
+                       .filter(Department.id.in_(department_ids))) if department_ids else {}
+    users = dict(get_db().session.query(User.id, User.username).filter(User.id.in_(user_ids))) if user_ids else {}
+    now = datetime.utcnow()
+
+    return jsonify([{
+        'id': t.id,
+        'title': t.title,
+        'status': t.status,
+        'priority': t.priority,
+        'category': t.category,
+        'time_sensitivity': t.time_sensitivity,
+        'patient_impact': t.patient_impact,
+        'patients_affected': t.patients_affected,
+        'department': departments.get(t.department_id, 'Unknown'),
+        'assigned_to': users.get(t.assigned_to),
+        'sla_due_at': t.sla_due_at.isoformat() if t.sla_due_at else None,
+        'created_at': t.created_at.isoformat() if t.created_at else None,
+        'triage_score': current_score(t.triage_rank, now)
+    } for t in tickets]), 200
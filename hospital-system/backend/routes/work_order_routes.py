@@ -2,8 +2,10 @@ from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
 from models import WorkOrder, WorkOrderComment, WorkOrderAttachment, User, Technician
 from datetime import datetime
-import os
 from werkzeug.utils import secure_filename
+from attachment_storage import store_upload, release_attachment, remove_blob_file, send_attachment, FileTooLarge, VARIANTS
+from image_previews import mark_for_previews, preview_worker, ready_previews
+from activity_log import record_created, record_comment, record_changes, snapshot
 
 def get_db():
     return current_app.db
@@ -11,7 +13,6 @@ def get_db():
 work_order_bp = Blueprint('work_order', __name__)
 
 # Configuration for file uploads
-UPLOAD_FOLDER = 'uploads/work_orders'
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'txt'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
@@ -37,13 +38,18 @@ def get_work_order_details(work_order_id):
 
     # Get attachments
     attachments = WorkOrderAttachment.query.filter_by(work_order_id=work_order_id).all()
+    previews = ready_previews([a.content_hash for a in attachments])
     attachments_data = [{
         'id': a.id,
         'filename': a.filename,
         'file_type': a.file_type,
         'file_size': a.file_size,
         'uploaded_by': User.query.get(a.uploaded_by).username if User.query.get(a.uploaded_by) else 'Unknown',
-        'uploaded_at': a.uploaded_at.isoformat() if a.uploaded_at else None
+        'uploaded_at': a.uploaded_at.isoformat() if a.uploaded_at else None,
+        'download_url': f'/work-order/{work_order_id}/attachment/{a.id}',
+        # Downscaled JPEGs for image attachments, once generated
+        'thumbnail_url': f'/work-order/{work_order_id}/attachment/{a.id}?variant=thumbnail' if a.content_hash in previews else None,
+        'preview_url': f'/work-order/{work_order_id}/attachment/{a.id}?variant=preview' if a.content_hash in previews else None
     } for a in attachments]
 
     # Get assigned user and requester
@@ -88,6 +94,8 @@ def create_work_order():
 
     db = get_db()
     db.session.add(work_order)
+    db.session.flush()
+    record_created('work_order', work_order)
     db.session.commit()
 
     return jsonify({
@@ -112,6 +120,7 @@ def add_comment(work_order_id):
 
     db = get_db()
     db.session.add(comment)
+    record_comment('work_order', work_order_id, comment.comment)
     db.session.commit()
 
     return jsonify({
@@ -142,39 +151,36 @@ def upload_attachment(work_order_id):
     if not allowed_file(file.filename):
         return jsonify({'message': 'File type not allowed'}), 400
 
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    file_size = file.tell()
-    file.seek(0)
-
-    if file_size > MAX_FILE_SIZE:
-        return jsonify({'message': 'File size exceeds 10MB limit'}), 400
-
-    # Save file
+    # Stream to content-addressed storage, hashing as it goes
     filename = secure_filename(file.filename)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    unique_filename = f"{timestamp}_{filename}"
-
-    # Create upload directory if it doesn't exist
-    upload_path = os.path.join(current_app.root_path, UPLOAD_FOLDER)
-    os.makedirs(upload_path, exist_ok=True)
-
-    filepath = os.path.join(upload_path, unique_filename)
-    file.save(filepath)
-
-    # Save attachment record
-    attachment = WorkOrderAttachment(
-        work_order_id=work_order_id,
-        filename=filename,
-        filepath=filepath,
-        file_type=filename.rsplit('.', 1)[1].lower(),
-        file_size=file_size,
-        uploaded_by=current_user.id
-    )
+    try:
+        blob = store_upload(file.stream, MAX_FILE_SIZE)
+    except FileTooLarge:
+        return jsonify({'message': 'File size exceeds 10MB limit'}), 400
+    blob_file = blob.filepath
 
     db = get_db()
-    db.session.add(attachment)
-    db.session.commit()
+    try:
+        # Save attachment record
+        attachment = WorkOrderAttachment(
+            work_order_id=work_order_id,
+            filename=filename,
+            filepath=blob.filepath,
+            file_type=filename.rsplit('.', 1)[1].lower(),
+            file_size=blob.size,
+            content_hash=blob.content_hash,
+            uploaded_by=current_user.id
+        )
+        mark_for_previews(blob, attachment.file_type)
+        db.session.add(attachment)
+        db.session.commit()
+    except Exception:
+        # The blob file is already in place; drop it unless another upload's row refers to it
+        db.session.rollback()
+        remove_blob_file(blob_file)
+        raise
+    if blob.preview_status == 'pending':
+        preview_worker.submit(blob.content_hash)
 
     return jsonify({
         'message': 'File uploaded successfully',
@@ -187,6 +193,51 @@ def upload_attachment(work_order_id):
         }
     }), 201
 
+# Download attachment, or its thumbnail/preview with ?variant= (supports Range and conditional requests)
+@work_order_bp.route('/<int:work_order_id>/attachment/<int:attachment_id>', methods=['GET'])
+@login_required
+def download_attachment(work_order_id, attachment_id):
+    work_order = WorkOrder.query.get(work_order_id)
+    if not work_order:
+        return jsonify({'message': 'Work order not found'}), 404
+
+    if current_user.role == 'patient':
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    attachment = WorkOrderAttachment.query.filter_by(id=attachment_id, work_order_id=work_order_id).first()
+    if not attachment:
+        return jsonify({'message': 'Attachment not found'}), 404
+
+    variant = request.args.get('variant')
+    if variant and variant not in VARIANTS:
+        return jsonify({'message': f"variant must be one of: {', '.join(VARIANTS)}"}), 400
+
+    response = send_attachment(attachment, variant)
+    if response is None:
+        if variant:
+            return jsonify({'message': 'Preview not available'}), 404
+        return jsonify({'message': 'Attachment file is missing'}), 410
+    return response
+
+# Delete attachment; the stored file is removed once no attachment uses it
+@work_order_bp.route('/<int:work_order_id>/attachment/<int:attachment_id>', methods=['DELETE'])
+@login_required
+def delete_attachment(work_order_id, attachment_id):
+    attachment = WorkOrderAttachment.query.filter_by(id=attachment_id, work_order_id=work_order_id).first()
+    if not attachment:
+        return jsonify({'message': 'Attachment not found'}), 404
+
+    if current_user.role not in ['admin', 'manager'] and attachment.uploaded_by != current_user.id:
+        return jsonify({'message': 'Unauthorized: Can only delete own attachments'}), 403
+
+    db = get_db()
+    orphaned = release_attachment(attachment)
+    db.session.delete(attachment)
+    db.session.commit()
+    remove_blob_file(orphaned)
+
+    return jsonify({'message': 'Attachment deleted successfully'}), 200
+
 # Update work order priority
 @work_order_bp.route('/<int:work_order_id>/priority', methods=['PUT'])
 @login_required
@@ -201,7 +252,9 @@ def update_priority(work_order_id):
     if priority not in ['low', 'medium', 'high', 'emergency']:
         return jsonify({'message': 'Invalid priority level'}), 400
 
+    before = snapshot(work_order)
     work_order.priority = priority
+    record_changes('work_order', work_order, before)
     db = get_db()
     db.session.commit()
 
@@ -223,8 +276,10 @@ def assign_work_order(work_order_id):
         if not user:
             return jsonify({'message': 'User not found'}), 404
 
+    before = snapshot(work_order)
     work_order.assigned_to = user_id
     work_order.status = 'assigned' if user_id else 'open'
+    record_changes('work_order', work_order, before)
     db = get_db()
     db.session.commit()
 
@@ -245,6 +300,7 @@ def update_work_order_status(work_order_id):
     if status not in ['open', 'assigned', 'in_progress', 'completed', 'closed']:
         return jsonify({'message': 'Invalid status'}), 400
 
+    before = snapshot(work_order)
     work_order.status = status
 
     if actual_hours is not None:
@@ -256,6 +312,7 @@ def update_work_order_status(work_order_id):
     elif status != 'completed':
         work_order.completed_at = None
 
+    record_changes('work_order', work_order, before)
     db = get_db()
     db.session.commit()
 
@@ -2,6 +2,11 @@ from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
 from models import Workflow, WorkflowStep, WorkflowExecution, TicketTemplate, Ticket, Department, User
 from workflow_engine import workflow_engine
+from patient_summary import refresh_patient_summary
+from ticket_dedup import check_duplicates
+from activity_log import record_created
+from sla_engine import update_sla
+from triage import update_triage_rank
 import json
 from datetime import datetime
 
@@ -198,8 +203,14 @@ def use_ticket_template(template_id):
         patient_id=data['patient_id']
     )
 
+    update_triage_rank(ticket)
     db = get_db()
     db.session.add(ticket)
+    db.session.flush()
+    possible_duplicates = check_duplicates(ticket, link=data.get('link_duplicates', False))
+    record_created('ticket', ticket)
+    update_sla(ticket)
+    refresh_patient_summary(ticket.patient_id, 'tickets')
     db.session.commit()
 
     # Trigger workflow if associated
@@ -211,7 +222,9 @@ def use_ticket_template(template_id):
 
     return jsonify({
         'message': 'Ticket created from template',
-        'ticket_id': ticket.id
+        'ticket_id': ticket.id,
+        'duplicate_of_id': ticket.duplicate_of_id,
+        'possible_duplicates': possible_duplicates
     }), 201
 
 # Workflow Execution Routes
@@ -0,0 +1,152 @@
+"""
+Schedule Template Cache for Appointment Scheduling
+Precomputes per-doctor and per-department slot grids from ScheduleTemplate rows
+"""
+
+import json
+import threading
+from collections import namedtuple
+from datetime import datetime, time
+
+DEFAULT_WORKING_HOURS = {'start': '08:00', 'end': '18:00'}
+DEFAULT_SLOT_MINUTES = 30
+
+# windows: ((start_minute, end_minute), ...) bookable ranges for the day
+# slots: ((start_minute, end_minute), ...) slot starts offered by availability
+# source: 'doctor', 'department' or 'default'
+SlotGrid = namedtuple('SlotGrid', ['windows', 'slots', 'slot_minutes', 'source'])
+
+def to_minutes(value):
+    """Convert a time to minutes since midnight"""
+    return value.hour * 60 + value.minute
+
+def from_minutes(minutes):
+    """Convert minutes since midnight back to a time"""
+    return time(minutes // 60, minutes % 60)
+
+def parse_time(value):
+    """Parse an HH:MM string into a time"""
+    return datetime.strptime(value, '%H:%M').time()
+
+def intervals_overlap(start_a, end_a, start_b, end_b):
+    """Check whether two half-open minute intervals overlap"""
+    return start_a < end_b and start_b < end_a
+
+def build_grid(start, end, slot_minutes, break_start=None, break_end=None, source='default'):
+    """Build the bookable windows and slot starts for one day"""
+    start_min, end_min = to_minutes(start), to_minutes(end)
+    windows = [(start_min, end_min)]
+
+    if break_start and break_end:
+        break_start_min, break_end_min = to_minutes(break_start), to_minutes(break_end)
+        if intervals_overlap(start_min, end_min, break_start_min, break_end_min):
+            windows = [(s, e) for s, e in ((start_min, break_start_min), (break_end_min, end_min)) if s < e]
+
+    slot_minutes = slot_minutes or DEFAULT_SLOT_MINUTES
+    slots = []
+    for window_start, window_end in windows:
+        current = window_start
+        while current + slot_minutes <= window_end:
+            slots.append((current, current + slot_minutes))
+            current += slot_minutes
+
+    return SlotGrid(tuple(windows), tuple(slots), slot_minutes, source)
+
+class ScheduleCache:
+    """In-memory slot grids keyed by (scope, id) and weekday.
+
+    Grids are built once from the database and reused by every availability
+    lookup and conflict check until a template, the clinic hours or a doctor
+    change. The cache is per process: invalidate() only clears the grids of
+    the process that made the change, so with several workers the others keep
+    serving their old grids until they restart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grids = None
+        self._doctor_departments = None
+        self._default = None
+
+    def invalidate(self):
+        """Drop the cached grids; they are rebuilt on next use"""
+        with self._lock:
+            self._grids = None
+            self._doctor_departments = None
+            self._default = None
+
+    def watch_doctors(self):
+        """Invalidate after any transaction that inserted, updated or deleted a Doctor commits"""
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+        from models import Doctor
+
+        def mark(mapper, connection, doctor):
+            Session.object_session(doctor).info['doctor_written'] = True
+
+        def after_commit(session):
+            if session.info.pop('doctor_written', False):
+                self.invalidate()
+
+        def after_rollback(session, previous_transaction):
+            session.info.pop('doctor_written', None)
+
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(Doctor, name, mark)
+        event.listen(Session, 'after_commit', after_commit)
+        event.listen(Session, 'after_soft_rollback', after_rollback)
+
+    def _load(self):
+        from models import ScheduleTemplate, SystemSetting, Doctor
+
+        grids = {}
+        templates = ScheduleTemplate.query.filter_by(is_active=True).all()
+        for template in templates:
+            if template.doctor_id:
+                key = ('doctor', template.doctor_id)
+            else:
+                key = ('department', template.department_id)
+            grids.setdefault(key, {})[template.weekday] = build_grid(
+                template.start_time,
+                template.end_time,
+                template.slot_minutes,
+                template.break_start,
+                template.break_end,
+                source=key[0]
+            )
+
+        doctor_departments = dict(Doctor.query.with_entities(Doctor.id, Doctor.department_id).all())
+
+        working_hours = DEFAULT_WORKING_HOURS
+        setting = SystemSetting.query.get('workingHours')
+        if setting:
+            working_hours = json.loads(setting.value)
+        default = build_grid(parse_time(working_hours['start']), parse_time(working_hours['end']), DEFAULT_SLOT_MINUTES)
+
+        self._grids = grids
+        self._doctor_departments = doctor_departments
+        self._default = default
+
+    def get_grid(self, weekday, doctor_id=None, department_id=None):
+        """Resolve the grid for a weekday: doctor template, then department, then clinic hours"""
+        with self._lock:
+            if self._grids is None:
+                self._load()
+            grids, doctor_departments, default = self._grids, self._doctor_departments, self._default
+
+        # A scope with any template is closed on weekdays it has no template for
+        if doctor_id:
+            doctor_id = int(doctor_id)
+            if ('doctor', doctor_id) in grids:
+                return grids[('doctor', doctor_id)].get(weekday) or SlotGrid((), (), default.slot_minutes, 'doctor')
+            department_id = department_id or doctor_departments.get(doctor_id)
+
+        if department_id:
+            department_id = int(department_id)
+            if ('department', department_id) in grids:
+                return grids[('department', department_id)].get(weekday) or SlotGrid((), (), default.slot_minutes, 'department')
+
+        return default
+
+# Global schedule cache instance
+schedule_cache = ScheduleCache()
@@ -0,0 +1,40 @@
+"""
+Schema Upgrade
+Brings a database created by an older version up to the current models.
+
+db.create_all() only creates missing tables, so columns and indexes added to
+existing tables never reach a database that already holds data. On startup
+this adds each missing column with ALTER TABLE ADD COLUMN and creates each
+missing index. Every step checks first, so running it again does nothing.
+Columns can only be added this way when they are nullable or have a server
+default; anything else needs the database to be recreated with init_db.py.
+"""
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+def _missing_columns(inspector, table):
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    return [column for column in table.columns if column.name not in existing]
+
+def upgrade_schema(db):
+    """Add missing columns and indexes to existing tables; returns the names of what was added"""
+    added = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            for column in _missing_columns(inspector, table):
+                if not column.nullable and column.server_default is None:
+                    raise RuntimeError(f'Cannot add required column {table.name}.{column.name} to an existing '
+                                       f'database; recreate it with init_db.py')
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+                added.append(f'{table.name}.{column.name}')
+            for index in table.indexes:
+                if not inspector.has_index(table.name, index.name):
+                    index.create(conn)
+                    added.append(index.name)
+    return added
@@ -0,0 +1,208 @@
+"""
+SQLite FTS5 Search Indexes
+Creates full-text indexes over application tables together with the triggers
+that keep them in sync, so every insert, update and delete is indexed in the
+same transaction as the write itself.
+
+The ticket index is different: it stores its own copy of the text so that a
+ticket and all of its comments are one document, and it also indexes the
+ticket's filter values as facet tokens (e.g. "status_open"), so that text and
+filters are answered together from the index's posting lists.
+"""
+
+import re
+from sqlalchemy import text
+
+# name -> (source table, indexed columns, tokenizer)
+EXTERNAL_CONTENT_INDEXES = {
+    'medical_record_fts': ('medical_record', ['chief_complaint', 'diagnosis', 'treatment', 'notes'], 'porter unicode61'),
+    'patient_fts': ('patient', ['name', 'phone', 'email', 'medical_record_number'], 'trigram'),
+}
+
+# vocabulary table -> index, for per-term document counts
+VOCABULARY_TABLES = {
+    'patient_fts_vocab': 'patient_fts',
+}
+
+# Filterable ticket columns -> facet token prefix in ticket_fts.facets
+TICKET_FACETS = {
+    'status': 'status',
+    'priority': 'priority',
+    'category': 'category',
+    'department_id': 'department',
+    'assigned_to': 'assignee',
+    'patient_id': 'patient',
+}
+TICKET_TEXT_COLUMNS = ['title', 'description', 'location_details', 'comments']
+
+FUZZY_MIN_TERMS = 3
+FUZZY_MAX_TERMS = 6
+FUZZY_MAX_TERM_SHARE = 0.05  # Trigrams in more than 5% of rows barely narrow a search
+
+def _external_content_statements(name, table, columns, tokenize):
+    cols = ', '.join(columns)
+    new_values = ', '.join(f'new.{c}' for c in columns)
+    old_values = ', '.join(f'old.{c}' for c in columns)
+    create = (f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({cols}, content='{table}', "
+              f"content_rowid='id', tokenize='{tokenize}')")
+    triggers = {
+        f'{name}_ai': f"""CREATE TRIGGER IF NOT EXISTS {name}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {name}(rowid, {cols}) VALUES (new.id, {new_values});
+        END""",
+        f'{name}_ad': f"""CREATE TRIGGER IF NOT EXISTS {name}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {name}({name}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+        END""",
+        f'{name}_au': f"""CREATE TRIGGER IF NOT EXISTS {name}_au AFTER UPDATE OF {cols} ON {table} BEGIN
+            INSERT INTO {name}({name}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {name}(rowid, {cols}) VALUES (new.id, {new_values});
+        END""",
+    }
+    return create, triggers
+
+def _ticket_facets_sql(row):
+    return " || ' ' || ".join(f"'{prefix}_' || coalesce({row}.{column}, 'none')" for column, prefix in TICKET_FACETS.items())
+
+def _ticket_comments_sql(ticket_id):
+    # Ordered so the document is rebuilt identically whatever the query plan
+    return (f"(SELECT group_concat(comment, char(10)) FROM "
+            f"(SELECT comment FROM ticket_comment WHERE ticket_id = {ticket_id} ORDER BY id))")
+
+def _ticket_index_statements():
+    """ticket_fts: one row per ticket (rowid = ticket id) holding its text, comments and facets"""
+    create = ("CREATE VIRTUAL TABLE IF NOT EXISTS ticket_fts USING fts5(title, description, location_details, "
+              "comments, facets, tokenize=\"porter unicode61 tokenchars '_'\")")
+    refresh_comments = "UPDATE ticket_fts SET comments = {comments} WHERE rowid = {ticket_id};"
+    triggers = {
+        'ticket_fts_ai': f"""CREATE TRIGGER IF NOT EXISTS ticket_fts_ai AFTER INSERT ON ticket BEGIN
+            INSERT INTO ticket_fts(rowid, title, description, location_details, comments, facets)
+            VALUES (new.id, new.title, new.description, new.location_details, {_ticket_comments_sql('new.id')},
+                    {_ticket_facets_sql('new')});
+        END""",
+        'ticket_fts_ad': """CREATE TRIGGER IF NOT EXISTS ticket_fts_ad AFTER DELETE ON ticket BEGIN
+            DELETE FROM ticket_fts WHERE rowid = old.id;
+        END""",
+        'ticket_fts_au': f"""CREATE TRIGGER IF NOT EXISTS ticket_fts_au AFTER UPDATE OF title, description,
+                location_details, {', '.join(TICKET_FACETS)} ON ticket BEGIN
+            UPDATE ticket_fts SET title = new.title, description = new.description,
+                location_details = new.location_details, facets = {_ticket_facets_sql('new')}
+            WHERE rowid = new.id;
+        END""",
+        'ticket_comment_fts_ai': f"""CREATE TRIGGER IF NOT EXISTS ticket_comment_fts_ai AFTER INSERT ON ticket_comment BEGIN
+            {refresh_comments.format(comments=_ticket_comments_sql('new.ticket_id'), ticket_id='new.ticket_id')}
+        END""",
+        'ticket_comment_fts_ad': f"""CREATE TRIGGER IF NOT EXISTS ticket_comment_fts_ad AFTER DELETE ON ticket_comment BEGIN
+            {refresh_comments.format(comments=_ticket_comments_sql('old.ticket_id'), ticket_id='old.ticket_id')}
+        END""",
+        'ticket_comment_fts_au': f"""CREATE TRIGGER IF NOT EXISTS ticket_comment_fts_au AFTER UPDATE OF comment, ticket_id ON ticket_comment BEGIN
+            {refresh_comments.format(comments=_ticket_comments_sql('old.ticket_id'), ticket_id='old.ticket_id')}
+            {refresh_comments.format(comments=_ticket_comments_sql('new.ticket_id'), ticket_id='new.ticket_id')}
+        END""",
+    }
+    rebuild = [
+        "DELETE FROM ticket_fts",
+        f"""INSERT INTO ticket_fts(rowid, title, description, location_details, comments, facets)
+            SELECT t.id, t.title, t.description, t.location_details, {_ticket_comments_sql('t.id')},
+                   {_ticket_facets_sql('t')}
+            FROM ticket t""",
+    ]
+    return create, triggers, rebuild
+
+# name -> statements for indexes that store their own content
+STORED_INDEXES = {
+    'ticket_fts': _ticket_index_statements,
+}
+
+def search_available(db):
+    return db.engine.dialect.name == 'sqlite'
+
+def init_search_indexes(db):
+    """Create missing FTS tables and triggers; rebuild an index whose triggers were missing.
+
+    Triggers disappear when their source table is dropped (init_db.py drops
+    and recreates everything), so a missing trigger means the index may be
+    stale and is rebuilt from the source table.
+    """
+    if not search_available(db):
+        return
+
+    with db.engine.begin() as conn:
+        existing = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'"))}
+        for name, (table, columns, tokenize) in EXTERNAL_CONTENT_INDEXES.items():
+            create, triggers = _external_content_statements(name, table, columns, tokenize)
+            conn.execute(text(create))
+            for trigger_name, statement in triggers.items():
+                conn.execute(text(statement))
+            if not set(triggers) <= existing:
+                conn.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+        for name, statements in STORED_INDEXES.items():
+            create, triggers, rebuild = statements()
+            conn.execute(text(create))
+            for trigger_name, statement in triggers.items():
+                conn.execute(text(statement))
+            if not set(triggers) <= existing:
+                for statement in rebuild:
+                    conn.execute(text(statement))
+        for vocab, index in VOCABULARY_TABLES.items():
+            conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {vocab} USING fts5vocab({index}, 'row')"))
+
+def build_match_query(user_query):
+    """Turn free text into a safe FTS5 query: every word must match, the last as a prefix"""
+    terms = re.findall(r'\w+', user_query or '', re.UNICODE)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+def build_substring_query(user_query):
+    """Match the whole input as a case-insensitive substring (trigram indexes, 3+ characters)"""
+    user_query = (user_query or '').strip()
+    if len(user_query) < 3:
+        return None
+    return '"' + user_query.replace('"', '""') + '"'
+
+def build_ticket_match_query(user_query, filters):
+    """Restrict the text terms to the ticket's text columns and AND in one facet token per filter"""
+    match = build_match_query(user_query)
+    if not match:
+        return None
+    parts = [f"{{{' '.join(TICKET_TEXT_COLUMNS)}}} : ({match})"]
+    for column, value in filters.items():
+        if value is not None and value != '':
+            token = f'{TICKET_FACETS[column]}_{value}'.replace('"', '""')
+            parts.append(f'facets : "{token}"')
+    return ' AND '.join(parts)
+
+def trigrams(value):
+    value = (value or '').lower()
+    return [value[i:i + 3] for i in range(len(value) - 2) if ' ' not in value[i:i + 3]]
+
+def trigram_similarity(query, value):
+    """Share of the query's trigrams found in value (0-1), so a short query can match a long field"""
+    grams_query, grams_value = set(trigrams(query)), set(trigrams(value))
+    if not grams_query or not grams_value:
+        return 0.0
+    return len(grams_query & grams_value) / len(grams_query)
+
+def build_fuzzy_query(db, vocab, user_query, total_rows):
+    """OR together the most selective trigrams of the input that exist in the index.
+
+    A typo only breaks the (at most three) trigrams that overlap it, so rows
+    sharing the remaining trigrams are still found. Trigrams that occur in a
+    large share of rows are skipped because they match almost everything.
+    """
+    grams = list(dict.fromkeys(trigrams(user_query)))
+    if not grams:
+        return None
+    params = {f't{i}': gram for i, gram in enumerate(grams)}
+    placeholders = ', '.join(f':{key}' for key in params)
+    counts = dict(db.session.execute(text(f"SELECT term, doc FROM {vocab} WHERE term IN ({placeholders})"), params).fetchall())
+
+    limit = max(int(total_rows * FUZZY_MAX_TERM_SHARE), 1)
+    present = sorted((g for g in grams if g in counts), key=counts.get)
+    chosen = [g for g in present if counts[g] <= limit][:FUZZY_MAX_TERMS]
+    if len(chosen) < FUZZY_MIN_TERMS:
+        chosen = present[:FUZZY_MIN_TERMS]
+    if not chosen:
+        return None
+    return ' OR '.join('"' + gram.replace('"', '""') + '"' for gram in chosen)
@@ -0,0 +1,281 @@
+"""
+Ticket SLA Engine
+Gives every open ticket a resolution deadline from the most specific matching
+SlaPolicy and raises a warning and a breach event when its deadlines pass.
+
+Deadlines are stored on the ticket (sla_warning_at, sla_due_at) and
+recomputed whenever a ticket is created or its priority or status changes.
+Instead of polling the open tickets, each process keeps the deadlines in a
+min-heap and one thread sleeps until the earliest of them. The heap is built
+from the deadline indexes on the first request and topped up every
+RESYNC_INTERVAL with deadlines that other processes set. Firing is a
+conditional UPDATE of sla_status, so each warning and breach is raised once
+no matter how many processes have it scheduled.
+
+Recompute the deadlines of all open tickets (e.g. for tickets created before
+SLAs existed) with:
+    python sla_engine.py
+"""
+
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import update
+from activity_log import record_event
+
+OPEN_STATUSES = ['open', 'in_progress']
+ACTIVE_SLA_STATUSES = ['pending', 'warning']
+RESYNC_INTERVAL = 60  # seconds
+DEFAULT_WARNING_PERCENT = 75
+
+# Used when no policy matches; the shorter of the two applies
+DEFAULT_PRIORITY_MINUTES = {'critical': 4 * 60, 'high': 24 * 60, 'medium': 3 * 24 * 60, 'low': 7 * 24 * 60}
+DEFAULT_SENSITIVITY_MINUTES = {'immediate': 30, 'within_hour': 60, 'within_shift': 8 * 60, 'within_day': 24 * 60}
+
+def active_policies():
+    from models import SlaPolicy
+
+    return SlaPolicy.query.filter_by(is_active=True).all()
+
+def match_policy(ticket, policies):
+    """The policy whose set fields all match the ticket, most specific first, then shortest time"""
+    best = None
+    for policy in policies:
+        fields = [(policy.category, ticket.category), (policy.priority, ticket.priority),
+                  (policy.time_sensitivity, ticket.time_sensitivity)]
+        if any(wanted is not None and wanted != actual for wanted, actual in fields):
+            continue
+        key = (-sum(1 for wanted, _ in fields if wanted is not None), policy.resolution_minutes, policy.id)
+        if best is None or key < best[0]:
+            best = (key, policy)
+    return best[1] if best else None
+
+def _set_deadlines(ticket, policy_id, minutes, warning_percent, now):
+    start = ticket.created_at or now
+    due = start + timedelta(minutes=minutes)
+    warning = start + timedelta(minutes=minutes * warning_percent / 100)
+    ticket.sla_policy_id = policy_id
+    ticket.sla_warning_at = warning
+    ticket.sla_due_at = due
+    # Keep a warning or breach that was already raised and still holds; otherwise re-arm
+    if not ((ticket.sla_status == 'breached' and due <= now) or (ticket.sla_status == 'warning' and warning <= now)):
+        ticket.sla_status = 'pending'
+    if ticket.id:
+        sla_scheduler.schedule(ticket.id, warning, due)
+
+def update_sla(ticket, policies=None, now=None):
+    """Recompute a ticket's deadlines after it was created (and flushed) or its priority or status changed.
+
+    Call in the transaction of the change. Deadlines count from ticket creation.
+    """
+    now = now or datetime.utcnow()
+    if ticket.status not in OPEN_STATUSES:
+        if ticket.sla_status in ACTIVE_SLA_STATUSES:
+            ticket.sla_status = 'met'
+        sla_scheduler.cancel(ticket.id)
+        return
+    policy = match_policy(ticket, active_policies() if policies is None else policies)
+    if policy:
+        _set_deadlines(ticket, policy.id, policy.resolution_minutes,
+                       policy.warning_percent or DEFAULT_WARNING_PERCENT, now)
+    else:
+        minutes = [m for m in (DEFAULT_PRIORITY_MINUTES.get(ticket.priority),
+                               DEFAULT_SENSITIVITY_MINUTES.get(ticket.time_sensitivity)) if m]
+        _set_deadlines(ticket, None, min(minutes) if minutes else DEFAULT_PRIORITY_MINUTES['medium'],
+                       DEFAULT_WARNING_PERCENT, now)
+
+def set_sla_minutes(ticket, minutes, warning_percent=None, now=None):
+    """Give an open ticket a fixed resolution time instead of its policy (until its priority changes)"""
+    if ticket.status in OPEN_STATUSES:
+        _set_deadlines(ticket, None, minutes, warning_percent or DEFAULT_WARNING_PERCENT, now or datetime.utcnow())
+
+def recompute_open_slas(batch_size=500):
+    """Recompute the deadlines of every open ticket, e.g. after the policies changed; returns the count"""
+    from models import Ticket
+
+    db = current_app.db
+    policies = active_policies()
+    now = datetime.utcnow()
+    count = 0
+    for ticket in Ticket.query.filter(Ticket.status.in_(OPEN_STATUSES)).yield_per(batch_size):
+        update_sla(ticket, policies, now)
+        count += 1
+    db.session.commit()
+    return count
+
+def _recipients(tickets):
+    """ticket id -> user id to notify: the assignee, or the department that raised the ticket"""
+    from models import Department
+
+    department_ids = {t.department_id for t in tickets if not t.assigned_to}
+    department_users = dict(current_app.db.session.query(Department.id, Department.user_id)
+                            .filter(Department.id.in_(department_ids))) if department_ids else {}
+    return {t.id: t.assigned_to or department_users.get(t.department_id) for t in tickets}
+
+class SlaScheduler:
+    def __init__(self, resync_interval=RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self._app = None
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # The thread does not survive a fork; each child builds its own heap on its first request
+        self._condition = threading.Condition()
+        self._heap = []  # (fire at, ticket id, 'warning' or 'breach')
+        self._deadlines = {}  # ticket id -> (warning at, due at) as last scheduled
+        self._thread = None
+
+    def init_app(self, app):
+        """Start with the first request rather than on import, so CLI jobs do not run the scheduler"""
+        app.before_request(self._ensure_started)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._condition:
+                if self._thread is None:
+                    self._app = current_app._get_current_object()
+                    self._thread = threading.Thread(target=self._run, name='sla-scheduler', daemon=True)
+                    self._thread.start()
+
+    def schedule(self, ticket_id, warning_at, due_at):
+        with self._condition:
+            if self._deadlines.get(ticket_id) == (warning_at, due_at):
+                return
+            self._deadlines[ticket_id] = (warning_at, due_at)
+            earliest = self._heap[0][0] if self._heap else None
+            # Entries for older deadlines stay in the heap and are skipped when they come up
+            if len(self._heap) > 4 * len(self._deadlines) + 1024:
+                self._heap = [entry for tid, (warning, due) in self._deadlines.items()
+                              for entry in ((warning, tid, 'warning'), (due, tid, 'breach'))]
+                heapq.heapify(self._heap)
+            else:
+                heapq.heappush(self._heap, (warning_at, ticket_id, 'warning'))
+                heapq.heappush(self._heap, (due_at, ticket_id, 'breach'))
+            if earliest is None or warning_at < earliest:
+                self._condition.notify()
+
+    def cancel(self, ticket_id):
+        with self._condition:
+            self._deadlines.pop(ticket_id, None)
+
+    def _pop_due(self, now):
+        """Remove and return {'warning': [...], 'breach': [...]} ticket ids whose deadline has passed"""
+        due = {'warning': [], 'breach': []}
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, ticket_id, kind = heapq.heappop(self._heap)
+            deadlines = self._deadlines.get(ticket_id)
+            if deadlines and deadlines[0 if kind == 'warning' else 1] == fire_at:
+                due[kind].append(ticket_id)
+                if kind == 'breach':
+                    del self._deadlines[ticket_id]
+        return due
+
+    def _run(self):
+        self._safely(self._resync, full=True)
+        next_resync = time.monotonic() + self.resync_interval
+        while True:
+            with self._condition:
+                due = self._pop_due(datetime.utcnow())
+                if not (due['warning'] or due['breach']):
+                    timeout = next_resync - time.monotonic()
+                    if self._heap:
+                        timeout = min(timeout, (self._heap[0][0] - datetime.utcnow()).total_seconds())
+                    if timeout > 0:
+                        self._condition.wait(timeout)
+            if due['warning'] or due['breach']:
+                fired = self._safely(self._fire, due) or []
+                # Not fired (e.g. changed by an uncommitted transaction): the resync schedules them again
+                for ticket_id in set(due['warning'] + due['breach']) - set(fired):
+                    self.cancel(ticket_id)
+            if time.monotonic() >= next_resync:
+                self._safely(self._resync)
+                next_resync = time.monotonic() + self.resync_interval
+
+    def _safely(self, method, *args, **kwargs):
+        with self._app.app_context():
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                current_app.db.session.rollback()
+                current_app.logger.exception('SLA scheduler %s failed', method.__name__)
+                return None
+
+    def _resync(self, full=False):
+        """Schedule active deadlines: all of them, or those due before the next resync"""
+        from models import Ticket
+
+        query = current_app.db.session.query(Ticket.id, Ticket.sla_warning_at, Ticket.sla_due_at)\
+            .filter(Ticket.status.in_(OPEN_STATUSES))
+        if full:
+            rows = query.filter(Ticket.sla_status.in_(ACTIVE_SLA_STATUSES)).all()
+        else:
+            horizon = datetime.utcnow() + timedelta(seconds=2 * self.resync_interval)
+            rows = query.filter(Ticket.sla_status == 'pending', Ticket.sla_warning_at <= horizon).all() + \
+                query.filter(Ticket.sla_status == 'warning', Ticket.sla_due_at <= horizon).all()
+        for ticket_id, warning_at, due_at in rows:
+            if warning_at and due_at:
+                self.schedule(ticket_id, warning_at, due_at)
+
+    def _mark(self, ticket_ids, from_statuses, deadline, to_status, now):
+        """Move tickets whose deadline has passed to to_status; returns the ids this call changed"""
+        from models import Ticket
+
+        if not ticket_ids:
+            return []
+        statement = update(Ticket).where(
+            Ticket.id.in_(ticket_ids), Ticket.status.in_(OPEN_STATUSES),
+            Ticket.sla_status.in_(from_statuses), deadline <= now
+        ).values(sla_status=to_status, updated_at=Ticket.updated_at).returning(Ticket.id)
+        return [row[0] for row in current_app.db.session.execute(
+            statement, execution_options={'synchronize_session': False})]
+
+    def _fire(self, due):
+        """Raise the warnings and breaches that are still due; returns the ids that fired"""
+        from models import Ticket
+        from routes.notification_routes import create_notification
+        from workflow_engine import workflow_engine
+
+        db = current_app.db
+        now = datetime.utcnow()
+        # Breaches first: a ticket past both deadlines only gets the breach
+        breached = self._mark(due['breach'], ACTIVE_SLA_STATUSES, Ticket.sla_due_at, 'breached', now)
+        warned = self._mark(due['warning'], ['pending'], Ticket.sla_warning_at, 'warning', now)
+        if not (breached or warned):
+            db.session.commit()
+            return []
+
+        tickets = Ticket.query.filter(Ticket.id.in_(breached + warned)).all()
+        recipients = _recipients(tickets)
+        for ticket in tickets:
+            is_breach = ticket.id in breached
+            due_text = ticket.sla_due_at.strftime('%Y-%m-%d %H:%M UTC')
+            record_event('ticket', ticket.id, 'sla_breached' if is_breach else 'sla_warning',
+                         new_value=ticket.sla_due_at.isoformat(), summary=f'Due {due_text}')
+            if recipients.get(ticket.id):
+                create_notification(
+                    user_id=recipients[ticket.id],
+                    title=f"SLA {'Breached' if is_breach else 'Warning'}: #{ticket.id}",
+                    message=f"Ticket '{ticket.title}' {'was' if is_breach else 'is'} due by {due_text}.",
+                    notification_type='error' if is_breach else 'warning',
+                    ticket_id=ticket.id,
+                    commit=False
+                )
+        db.session.commit()
+
+        for ticket_id in breached:
+            workflow_engine.trigger_workflows('sla_breached', ticket_id)
+        return breached + warned
+
+# Global SLA breach scheduler, started by the first request
+sla_scheduler = SlaScheduler()
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        print(f"Recomputed SLA deadlines for {recompute_open_slas()} open tickets")
@@ -0,0 +1,250 @@
+"""
+Structured Lab Results and Prescriptions
+Normalizes the JSON lab_results/prescriptions of medical records into
+LabObservation and PrescriptionLine rows so they can be indexed and queried.
+Lab values are flagged against data/lab_reference_ranges.json (by analyte,
+unit, sex and age band) as they are written.
+
+Backfill existing records with:
+    python structured_records.py
+"""
+
+import json
+import os
+import re
+from datetime import date
+from flask import current_app
+
+REFERENCE_RANGES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'lab_reference_ranges.json')
+ABNORMAL_FLAGS = ['critical_low', 'low', 'high', 'critical_high']
+CRITICAL_FLAGS = ['critical_low', 'critical_high']
+
+RANGE_PATTERN = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(-?\d+(?:\.\d+)?)\s*$')
+BOUND_PATTERN = re.compile(r'^\s*([<>]=?)\s*(-?\d+(?:\.\d+)?)\s*$')
+
+def normalize_analyte(name):
+    """Normalize an analyte name into a lookup key ("Blood Glucose" -> "blood_glucose")"""
+    return re.sub(r'[^a-z0-9]+', '_', name.strip().lower()).strip('_')
+
+def parse_reference_range(reference):
+    """Parse "3.5-5.0", "<200" or ">40" into (low, high)"""
+    if not reference:
+        return None, None
+    reference = str(reference)
+    match = RANGE_PATTERN.match(reference)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    match = BOUND_PATTERN.match(reference)
+    if match:
+        bound = float(match.group(2))
+        return (None, bound) if match.group(1).startswith('<') else (bound, None)
+    return None, None
+
+def _unit_key(unit):
+    return re.sub(r'\s+', '', str(unit)).replace('µ', 'u').replace('μ', 'u').replace('x10', '10').lower() if unit else None
+
+def _load_reference_ranges(path=REFERENCE_RANGES_PATH):
+    """Index the reference table as (analyte, unit) -> ranges, plus the units known per analyte"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    by_unit = {}
+    units = {}
+    for analyte, ranges in data.get('ranges', {}).items():
+        for entry in ranges:
+            unit = _unit_key(entry['unit'])
+            by_unit.setdefault((analyte, unit), []).append(entry)
+            units.setdefault(analyte, set()).add(unit)
+    return data.get('aliases', {}), by_unit, units
+
+RANGE_ALIASES, RANGES_BY_UNIT, RANGE_UNITS = _load_reference_ranges()
+
+def _patient_sex_and_age(patient, on_date):
+    sex = (patient.gender or '').strip().lower() if patient else ''
+    sex = {'m': 'male', 'f': 'female'}.get(sex, sex)
+    age = None
+    if patient and patient.date_of_birth:
+        dob = patient.date_of_birth
+        age = on_date.year - dob.year - ((on_date.month, on_date.day) < (dob.month, dob.day))
+    elif patient and patient.age is not None:
+        age = patient.age
+    return sex, age
+
+def _find_range(analyte, unit, sex, age):
+    analyte = RANGE_ALIASES.get(analyte, analyte)
+    unit = _unit_key(unit)
+    if unit is None:
+        # Without a unit the table can only be trusted if the analyte has a single unit
+        known = RANGE_UNITS.get(analyte, set())
+        if len(known) != 1:
+            return None
+        unit = next(iter(known))
+    for entry in RANGES_BY_UNIT.get((analyte, unit), []):
+        if entry.get('sex') and entry['sex'] != sex:
+            continue
+        if age is not None:
+            if entry.get('age_min') is not None and age < entry['age_min']:
+                continue
+            if entry.get('age_max') is not None and age >= entry['age_max']:
+                continue
+        elif entry.get('age_min') or entry.get('age_max'):
+            # Age-banded ranges need an age; fall through to the adult band only
+            if entry.get('age_max') is not None:
+                continue
+        return entry
+    return None
+
+def flag_observations(observations, patient, on_date):
+    """Set 'flag' and 'is_abnormal' on every observation dict of one record in a single pass.
+
+    The range printed with the result (reference_low/high) takes precedence
+    over the table's normal range; critical limits always come from the table.
+    Non-numeric results and analytes without a usable range get no flag.
+    """
+    sex, age = _patient_sex_and_age(patient, on_date or date.today())
+    for observation in observations:
+        value = observation.get('value')
+        table = _find_range(observation['analyte'], observation.get('unit'), sex, age) if value is not None else None
+        low, high = observation.get('reference_low'), observation.get('reference_high')
+        if table and low is None and high is None:
+            low, high = table.get('low'), table.get('high')
+
+        flag = None
+        if value is not None and (low is not None or high is not None):
+            if table and table.get('critical_low') is not None and value < table['critical_low']:
+                flag = 'critical_low'
+            elif table and table.get('critical_high') is not None and value > table['critical_high']:
+                flag = 'critical_high'
+            elif low is not None and value < low:
+                flag = 'low'
+            elif high is not None and value > high:
+                flag = 'high'
+            else:
+                flag = 'normal'
+        observation['flag'] = flag
+        observation['is_abnormal'] = flag in ABNORMAL_FLAGS
+    return observations
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_lab_results(lab_results):
+    """Turn lab_results in any of the accepted shapes into observation dicts.
+
+    Accepts a list of {"test", "value", "unit", "reference"} entries (the
+    shape the frontend renders), a mapping of analyte -> value, or a mapping
+    of analyte -> {"value", "unit", "reference"}.
+    """
+    if not lab_results:
+        return []
+    if isinstance(lab_results, str):
+        try:
+            lab_results = json.loads(lab_results)
+        except ValueError:
+            return []
+
+    if isinstance(lab_results, dict):
+        entries = []
+        for name, result in lab_results.items():
+            entry = dict(result) if isinstance(result, dict) else {'value': result}
+            entry['test'] = name
+            entries.append(entry)
+    elif isinstance(lab_results, list):
+        entries = [e for e in lab_results if isinstance(e, dict)]
+    else:
+        return []
+
+    observations = []
+    for entry in entries:
+        name = entry.get('test') or entry.get('analyte') or entry.get('name')
+        if not name or not normalize_analyte(str(name)):
+            continue
+        reference = entry.get('reference') or entry.get('reference_range')
+        low, high = parse_reference_range(reference)
+        value = entry.get('value')
+        observations.append({
+            'analyte': normalize_analyte(str(name)),
+            'analyte_name': str(name)[:150],
+            'value': _to_float(value),
+            'value_text': str(value)[:200] if value is not None else None,
+            'unit': entry.get('unit'),
+            'reference_range': str(reference)[:100] if reference else None,
+            'reference_low': low,
+            'reference_high': high
+        })
+    return observations
+
+def parse_prescriptions(prescriptions):
+    """Turn prescriptions (list of {"medication", "dosage", ...} or strings) into line dicts"""
+    if not prescriptions:
+        return []
+    if isinstance(prescriptions, str):
+        try:
+            prescriptions = json.loads(prescriptions)
+        except ValueError:
+            return []
+    if isinstance(prescriptions, dict):
+        prescriptions = [prescriptions]
+
+    lines = []
+    for entry in prescriptions:
+        if isinstance(entry, str):
+            entry = {'medication': entry}
+        if not isinstance(entry, dict) or not entry.get('medication'):
+            continue
+        lines.append({
+            'medication': str(entry['medication'])[:150],
+            'dosage': entry.get('dosage') or entry.get('dose'),
+            'frequency': entry.get('frequency'),
+            'duration': entry.get('duration')
+        })
+    return lines
+
+def sync_record_lines(record):
+    """Replace a record's LabObservation and PrescriptionLine rows within the current transaction"""
+    from models import LabObservation, Patient, PrescriptionLine
+
+    db = current_app.db
+    LabObservation.query.filter_by(record_id=record.id).delete(synchronize_session=False)
+    PrescriptionLine.query.filter_by(record_id=record.id).delete(synchronize_session=False)
+
+    common = {'record_id': record.id, 'patient_id': record.patient_id, 'visit_date': record.visit_date}
+    observations = [dict(common, department_id=record.department_id, **o) for o in parse_lab_results(record.lab_results)]
+    if observations:
+        flag_observations(observations, db.session.get(Patient, record.patient_id), record.visit_date)
+    lines = [dict(common, **l) for l in parse_prescriptions(record.prescriptions)]
+    if observations:
+        db.session.bulk_insert_mappings(LabObservation, observations)
+    if lines:
+        db.session.bulk_insert_mappings(PrescriptionLine, lines)
+    return observations, lines
+
+def delete_record_lines(record_id):
+    from models import LabObservation, PrescriptionLine
+
+    LabObservation.query.filter_by(record_id=record_id).delete(synchronize_session=False)
+    PrescriptionLine.query.filter_by(record_id=record_id).delete(synchronize_session=False)
+
+def backfill_record_lines(batch_size=500):
+    """Populate the structured tables for every existing record, committing per batch"""
+    from models import MedicalRecord
+
+    db = current_app.db
+    record_ids = [row[0] for row in db.session.query(MedicalRecord.id).filter(
+        (MedicalRecord.lab_results.isnot(None)) | (MedicalRecord.prescriptions.isnot(None))
+    ).order_by(MedicalRecord.id)]
+
+    for i in range(0, len(record_ids), batch_size):
+        for record in MedicalRecord.query.filter(MedicalRecord.id.in_(record_ids[i:i + batch_size])):
+            sync_record_lines(record)
+        db.session.commit()
+    return len(record_ids)
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        count = backfill_record_lines()
+        print(f"Structured lab results and prescriptions rebuilt for {count} medical records")
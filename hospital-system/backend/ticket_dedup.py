@@ -0,0 +1,234 @@
+"""
+Duplicate Ticket Detection
+Finds open tickets that probably report the same fault as a new one.
+
+Each open ticket's wording is reduced to a MinHash signature (one-permutation
+MinHash: every word is hashed once and kept in one of NUM_PERM bins, with
+empty bins filled from their neighbours) and stored in a locality-sensitive
+hash (LSH) index, so tickets with similar wording share a
+band bucket and are found with a few dictionary lookups instead of a table
+scan. Tickets with the same equipment identifier or location are found
+through exact-match buckets. Candidates are then scored on estimated text
+similarity plus equipment, location and department agreement.
+
+The index lives in process memory and is built from the open tickets on
+first use. Before every lookup each process loads the tickets whose
+updated_at is at or after the latest one it has seen, so tickets created,
+edited, reopened or closed by other workers are added or dropped. Writers
+commit one at a time, so a later commit never carries an earlier
+timestamp; the CATCH_UP_OVERLAP re-reads cover timestamps set from the
+application clock rather than the database's. Candidates are also
+re-checked against the database before they are returned.
+"""
+
+import hashlib
+import re
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import func
+
+OPEN_STATUSES = ['open', 'in_progress']
+NUM_PERM = 64
+BANDS = 16  # 4 rows per band: pairs above ~0.5 Jaccard similarity usually share a bucket
+ROWS = NUM_PERM // BANDS
+EMPTY_BIN_OFFSET = 1 << 60  # Larger than any bin value, so borrowed values never equal real ones
+MAX_DUPLICATES = 5
+MIN_SCORE = 0.5
+LINK_SCORE = 0.75  # Minimum score to set duplicate_of_id when the caller asks for linking
+CATCH_UP_OVERLAP = timedelta(seconds=2)
+
+STOP_WORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it', 'not',
+              'of', 'on', 'or', 'the', 'to', 'was', 'with', 'this', 'that', 'please', 'needs', 'need'}
+
+def _token_hash(token):
+    # Stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), 'little')
+
+def shingles(title, description):
+    """Words and adjacent word pairs of the ticket text, without stop words"""
+    words = [w for w in re.findall(r'[a-z0-9]+', f'{title or ""} {description or ""}'.lower()) if w not in STOP_WORDS]
+    return set(words) | {f'{a} {b}' for a, b in zip(words, words[1:])}
+
+def minhash(tokens):
+    """One hash per token instead of one per token and permutation, which is what makes indexing cheap"""
+    if not tokens:
+        return None
+    bins = [None] * NUM_PERM
+    for token in tokens:
+        value, index = divmod(_token_hash(token), NUM_PERM)
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    # An empty bin borrows the nearest filled bin to its right, offset by the distance
+    signature = list(bins)
+    for index in range(NUM_PERM):
+        distance = 1
+        while signature[index] is None:
+            borrowed = bins[(index + distance) % NUM_PERM]
+            if borrowed is not None:
+                signature[index] = borrowed + distance * EMPTY_BIN_OFFSET
+            distance += 1
+    return tuple(signature)
+
+def estimated_similarity(first, second):
+    return sum(1 for x, y in zip(first, second) if x == y) / NUM_PERM
+
+def normalize_key(value):
+    value = re.sub(r'[^a-z0-9]+', ' ', (value or '').lower()).strip()
+    return value or None
+
+class OpenTicketIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._watermark = None  # Latest updated_at loaded so far
+        self._entries = {}  # ticket id -> (signature, equipment key, location key, department id)
+        self._bands = defaultdict(set)
+        self._equipment = defaultdict(set)
+        self._locations = defaultdict(set)
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS)]
+
+    def _add(self, ticket_id, title, description, equipment_id, location_details, department_id):
+        self._remove(ticket_id)
+        signature = minhash(shingles(title, description))
+        equipment, location = normalize_key(equipment_id), normalize_key(location_details)
+        self._entries[ticket_id] = (signature, equipment, location, department_id)
+        if signature:
+            for key in self._band_keys(signature):
+                self._bands[key].add(ticket_id)
+        if equipment:
+            self._equipment[equipment].add(ticket_id)
+        if location:
+            self._locations[location].add(ticket_id)
+
+    def _remove(self, ticket_id):
+        entry = self._entries.pop(ticket_id, None)
+        if not entry:
+            return
+        signature, equipment, location, _ = entry
+        for buckets, keys in ((self._bands, self._band_keys(signature) if signature else []),
+                              (self._equipment, [equipment] if equipment else []),
+                              (self._locations, [location] if location else [])):
+            for key in keys:
+                buckets[key].discard(ticket_id)
+                if not buckets[key]:
+                    del buckets[key]
+
+    def _catch_up(self):
+        """Apply tickets changed since the watermark (all open tickets on first use); reads outside the lock"""
+        from models import Ticket
+
+        with self._lock:
+            loaded, watermark = self._loaded, self._watermark
+        db = current_app.db
+        # Read before the rows: anything committed in between has a later updated_at and is loaded next time
+        latest = db.session.query(func.max(Ticket.updated_at)).scalar()
+        query = db.session.query(Ticket.id, Ticket.status, Ticket.title, Ticket.description, Ticket.equipment_id,
+                                 Ticket.location_details, Ticket.department_id)
+        if not loaded:
+            rows = query.filter(Ticket.status.in_(OPEN_STATUSES)).all()
+        elif watermark:
+            rows = query.filter(Ticket.updated_at >= watermark - CATCH_UP_OVERLAP).all()
+        else:
+            rows = query.all()  # There were no tickets at the last catch up
+
+        with self._lock:
+            for ticket_id, status, *fields in rows:
+                if status in OPEN_STATUSES:
+                    self._add(ticket_id, *fields)
+                else:
+                    self._remove(ticket_id)
+            if latest and (self._watermark is None or latest > self._watermark):
+                self._watermark = latest
+            self._loaded = True
+
+    def update(self, ticket):
+        """Add a ticket while it is open and drop it once it is closed"""
+        with self._lock:
+            if not self._loaded:
+                return  # The ticket is picked up when the index is first built
+            if ticket.status in OPEN_STATUSES:
+                self._add(ticket.id, ticket.title, ticket.description, ticket.equipment_id,
+                          ticket.location_details, ticket.department_id)
+            else:
+                self._remove(ticket.id)
+
+    def find_duplicates(self, ticket, limit=MAX_DUPLICATES, patient_id=None):
+        """Return [(score, ticket id, reasons)] for open tickets that look like the same report, best first.
+
+        With patient_id only that patient's tickets are returned.
+        """
+        from models import Ticket
+
+        signature = minhash(shingles(ticket.title, ticket.description))
+        equipment, location = normalize_key(ticket.equipment_id), normalize_key(ticket.location_details)
+        self._catch_up()
+        with self._lock:
+            candidates = set()
+            if signature:
+                for key in self._band_keys(signature):
+                    candidates |= self._bands.get(key, set())
+            if equipment:
+                candidates |= self._equipment.get(equipment, set())
+            if location:
+                candidates |= self._locations.get(location, set())
+            candidates.discard(ticket.id)
+            entries = {ticket_id: self._entries[ticket_id] for ticket_id in candidates}
+
+        scored = []
+        for ticket_id, (other_signature, other_equipment, other_location, department_id) in entries.items():
+            text = estimated_similarity(signature, other_signature) if signature and other_signature else 0.0
+            reasons = []
+            score = text
+            if text >= MIN_SCORE:
+                reasons.append('similar wording')
+            if equipment and equipment == other_equipment:
+                score += 0.4
+                reasons.append('same equipment')
+            if location and location == other_location:
+                score += 0.2
+                reasons.append('same location')
+            if department_id == ticket.department_id:
+                score += 0.1
+            score = min(score, 1.0)
+            if score >= MIN_SCORE and reasons:
+                scored.append((score, ticket_id, reasons))
+        scored.sort(key=lambda item: (-item[0], -item[1]))
+
+        # Tickets closed by another process are still in this index until it sees them again
+        ids = [ticket_id for _, ticket_id, _ in scored]
+        rows = current_app.db.session.query(Ticket.id, Ticket.patient_id)\
+            .filter(Ticket.id.in_(ids), Ticket.status.in_(OPEN_STATUSES)).all() if ids else []
+        if len(rows) < len(ids):
+            with self._lock:
+                for ticket_id in set(ids) - {row[0] for row in rows}:
+                    self._remove(ticket_id)
+        visible = {ticket_id for ticket_id, owner_id in rows if patient_id is None or owner_id == patient_id}
+        return [item for item in scored if item[1] in visible][:limit]
+
+# Global open ticket index, built on first lookup
+open_ticket_index = OpenTicketIndex()
+
+def check_duplicates(ticket, link=False, patient_id=None):
+    """Find likely duplicates of a new (flushed) ticket; optionally link it to the best one.
+
+    Returns the list included in create responses as possible_duplicates.
+    Pass patient_id when a patient files the ticket, so that only their own
+    tickets are matched and shown.
+    """
+    from models import Ticket
+
+    matches = open_ticket_index.find_duplicates(ticket, patient_id=patient_id)
+    if link and matches and matches[0][0] >= LINK_SCORE:
+        ticket.duplicate_of_id = matches[0][1]
+    titles = dict(current_app.db.session.query(Ticket.id, Ticket.title)
+                  .filter(Ticket.id.in_([ticket_id for _, ticket_id, _ in matches]))) if matches else {}
+    return [{
+        'ticket_id': ticket_id,
+        'title': titles.get(ticket_id),
+        'score': round(score, 2),
+        'reasons': reasons
+    } for score, ticket_id, reasons in matches]
@@ -0,0 +1,79 @@
+"""
+Ticket Triage Ranking
+Orders the ticket queue by clinical urgency and by how long tickets have waited.
+
+A ticket's triage score is the sum of points for its priority, time
+sensitivity, patient impact and the number of patients affected, plus one
+point for every SECONDS_PER_POINT it has been waiting. Every ticket ages at
+the same rate, so ordering by score is the same as ordering by
+
+    triage_rank = created_at in epoch seconds - base score * SECONDS_PER_POINT
+
+ascending, and that value does not change while the ticket waits. It is
+computed when a ticket is created or its priority changes, and queues are
+read in order straight from the triage indexes.
+
+Tickets without a rank (e.g. in a database upgraded from before triage
+ranking) are ranked when the app starts. Recompute every ticket's rank
+(e.g. after changing the points) with:
+    python triage.py
+"""
+
+import calendar
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import update
+
+SECONDS_PER_POINT = 3600  # One point per hour of waiting
+
+PRIORITY_POINTS = {'critical': 40, 'high': 25, 'medium': 10, 'low': 0}
+SENSITIVITY_POINTS = {'immediate': 30, 'within_hour': 20, 'within_shift': 10, 'within_day': 5}
+IMPACT_POINTS = {'critical': 30, 'severe': 20, 'moderate': 10, 'minor': 3, 'none': 0}
+POINTS_PER_EXTRA_PATIENT = 2
+MAX_EXTRA_PATIENTS = 10
+
+def base_score(priority, time_sensitivity, patient_impact, patients_affected):
+    extra_patients = min(max((patients_affected or 1) - 1, 0), MAX_EXTRA_PATIENTS)
+    return (PRIORITY_POINTS.get(priority, 0) + SENSITIVITY_POINTS.get(time_sensitivity, 0)
+            + IMPACT_POINTS.get(patient_impact, 0) + extra_patients * POINTS_PER_EXTRA_PATIENT)
+
+def _epoch(moment):
+    return calendar.timegm(moment.timetuple())
+
+def triage_rank(priority, time_sensitivity, patient_impact, patients_affected, created_at):
+    return _epoch(created_at) - base_score(priority, time_sensitivity, patient_impact, patients_affected) * SECONDS_PER_POINT
+
+def update_triage_rank(ticket):
+    """Set the rank of a new ticket, or of one whose priority or impact fields changed"""
+    ticket.triage_rank = triage_rank(ticket.priority, ticket.time_sensitivity, ticket.patient_impact,
+                                     ticket.patients_affected, ticket.created_at or datetime.utcnow())
+
+def current_score(rank, now=None):
+    """The score a ranked ticket has now, waiting time included"""
+    return round((_epoch(now or datetime.utcnow()) - rank) / SECONDS_PER_POINT, 1) if rank is not None else None
+
+def recompute_triage_ranks(batch_size=1000, unranked_only=False):
+    """Recompute the rank of every ticket, or only of those without one, with set-based updates; returns the count"""
+    from models import Ticket
+
+    db = current_app.db
+    query = db.session.query(Ticket.id, Ticket.priority, Ticket.time_sensitivity, Ticket.patient_impact,
+                             Ticket.patients_affected, Ticket.created_at, Ticket.updated_at)
+    if unranked_only:
+        query = query.filter(Ticket.triage_rank.is_(None))
+    rows = query.all()
+    for start in range(0, len(rows), batch_size):
+        # updated_at is passed back unchanged: a new rank is not an edit of the ticket
+        db.session.execute(update(Ticket), [{
+            'id': ticket_id,
+            'triage_rank': triage_rank(priority, sensitivity, impact, affected, created_at or datetime.utcnow()),
+            'updated_at': updated_at
+        } for ticket_id, priority, sensitivity, impact, affected, created_at, updated_at in rows[start:start + batch_size]])
+    db.session.commit()
+    return len(rows)
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        print(f"Recomputed triage ranks for {recompute_triage_ranks()} tickets")
@@ -0,0 +1,173 @@
+"""
+Appointment Utilization Rollup
+Keeps per doctor per day counters in AppointmentRollup up to date on each
+appointment write, and builds utilization reports from them.
+"""
+
+from collections import OrderedDict
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import case, func
+
+BOOKED_STATUSES = ['scheduled', 'confirmed', 'completed']
+COUNTER_FIELDS = ['total_count', 'booked_minutes', 'cancelled_count', 'completed_count', 'no_show_count']
+
+def rollup_snapshot(appointment):
+    """Capture the fields of an appointment that feed the rollup"""
+    return (appointment.department_id, appointment.doctor_id, appointment.appointment_date,
+            appointment.status or 'scheduled', appointment.duration_minutes or 30)
+
+def _counters(snapshot, sign):
+    _, _, _, status, duration = snapshot
+    return {
+        'total_count': sign,
+        'booked_minutes': sign * duration if status in BOOKED_STATUSES else 0,
+        'cancelled_count': sign if status == 'cancelled' else 0,
+        'completed_count': sign if status == 'completed' else 0,
+        'no_show_count': sign if status == 'no_show' else 0
+    }
+
+def apply_appointment_change(before, after):
+    """Move an appointment's contribution from one rollup snapshot to another.
+
+    Either side may be None (create / delete). Runs in the caller's
+    transaction using in-place increments, so concurrent writers to the same
+    row do not lose updates.
+    """
+    from models import AppointmentRollup
+
+    if before == after:
+        return
+    db = current_app.db
+
+    for snapshot, sign in ((before, -1), (after, 1)):
+        if not snapshot:
+            continue
+        department_id, doctor_id, day = snapshot[:3]
+        deltas = _counters(snapshot, sign)
+
+        query = AppointmentRollup.query.filter(
+            AppointmentRollup.department_id == department_id,
+            AppointmentRollup.day == day,
+            AppointmentRollup.doctor_id == doctor_id if doctor_id else AppointmentRollup.doctor_id.is_(None)
+        )
+        updated = query.update({getattr(AppointmentRollup, field): getattr(AppointmentRollup, field) + delta
+                                for field, delta in deltas.items()}, synchronize_session=False)
+        if not updated:
+            db.session.add(AppointmentRollup(department_id=department_id, doctor_id=doctor_id, day=day, **deltas))
+            db.session.flush()
+
+def rebuild_rollup():
+    """Recompute the whole rollup from appointments with a single grouped query"""
+    from models import Appointment, AppointmentRollup
+
+    db = current_app.db
+    duration = func.coalesce(Appointment.duration_minutes, 30)
+    rows = db.session.query(
+        Appointment.department_id,
+        Appointment.doctor_id,
+        Appointment.appointment_date,
+        func.count(Appointment.id),
+        func.sum(case((Appointment.status.in_(BOOKED_STATUSES), duration), else_=0)),
+        func.sum(case((Appointment.status == 'cancelled', 1), else_=0)),
+        func.sum(case((Appointment.status == 'completed', 1), else_=0)),
+        func.sum(case((Appointment.status == 'no_show', 1), else_=0))
+    ).group_by(Appointment.department_id, Appointment.doctor_id, Appointment.appointment_date).all()
+
+    AppointmentRollup.query.delete()
+    db.session.bulk_insert_mappings(AppointmentRollup, [
+        dict(zip(['department_id', 'doctor_id', 'day'] + COUNTER_FIELDS, row)) for row in rows
+    ])
+    db.session.commit()
+    return len(rows)
+
+def _period_key(day, group_by):
+    if group_by == 'week':
+        year, week, _ = day.isocalendar()
+        return f'{year}-W{week:02d}'
+    return day.isoformat()
+
+def _available_minutes(weekday, doctor_id=None, department_id=None):
+    from scheduling import schedule_cache
+    grid = schedule_cache.get_grid(weekday, doctor_id, department_id)
+    return sum(end - start for start, end in grid.windows)
+
+def utilization_report(date_from, date_to, group_by='day', level='doctor', department_id=None, doctor_id=None):
+    """Aggregate rollup rows into per-period utilization and outcome rates.
+
+    Available minutes come from the cached schedule grids, so the report
+    reflects the hours in force when it is requested.
+    """
+    from models import AppointmentRollup, Doctor, Department
+
+    query = AppointmentRollup.query.filter(AppointmentRollup.day >= date_from, AppointmentRollup.day <= date_to)
+    doctors_query = Doctor.query
+    if department_id:
+        query = query.filter(AppointmentRollup.department_id == department_id)
+        doctors_query = doctors_query.filter(Doctor.department_id == department_id)
+    if doctor_id:
+        query = query.filter(AppointmentRollup.doctor_id == doctor_id)
+        doctors_query = doctors_query.filter(Doctor.id == doctor_id)
+
+    doctors = doctors_query.all()
+    doctors_by_department = {}
+    for doctor in doctors:
+        doctors_by_department.setdefault(doctor.department_id, []).append(doctor)
+    if department_id:
+        department_ids = [department_id]
+    else:
+        department_ids = set(doctors_by_department) | {
+            d.id for d in Department.query.filter_by(type='hospital').with_entities(Department.id)
+        }
+
+    # Seed every (period, scope) with its available minutes so idle doctors show up
+    buckets = OrderedDict()
+    def bucket(period, dept_id, doc_id):
+        key = (period, dept_id, doc_id)
+        if key not in buckets:
+            buckets[key] = dict.fromkeys(COUNTER_FIELDS + ['available_minutes'], 0)
+        return buckets[key]
+
+    day = date_from
+    while day <= date_to:
+        period = _period_key(day, group_by)
+        if level == 'doctor':
+            for doctor in doctors:
+                bucket(period, doctor.department_id, doctor.id)['available_minutes'] += \
+                    _available_minutes(day.weekday(), doctor.id, doctor.department_id)
+        else:
+            # A department's capacity is its doctors' hours, or its own hours if it has no doctors
+            for dept_id in department_ids:
+                staff = doctors_by_department.get(dept_id)
+                if staff:
+                    minutes = sum(_available_minutes(day.weekday(), d.id, dept_id) for d in staff)
+                else:
+                    minutes = _available_minutes(day.weekday(), department_id=dept_id)
+                bucket(period, dept_id, None)['available_minutes'] += minutes
+        day += timedelta(days=1)
+
+    for row in query.all():
+        doc_id = row.doctor_id if level == 'doctor' else None
+        target = bucket(_period_key(row.day, group_by), row.department_id, doc_id)
+        for field in COUNTER_FIELDS:
+            target[field] += getattr(row, field)
+
+    doctor_names = {d.id: d.name for d in doctors}
+    result = []
+    for (period, dept_id, doc_id), counters in buckets.items():
+        total = counters['total_count']
+        available = counters['available_minutes']
+        result.append({
+            'period': period,
+            'department_id': dept_id,
+            'doctor_id': doc_id,
+            'doctor_name': doctor_names.get(doc_id),
+            'appointments': total,
+            'booked_minutes': counters['booked_minutes'],
+            'available_minutes': available,
+            'utilization_percent': round(counters['booked_minutes'] / available * 100, 1) if available else None,
+            'cancellation_rate': round(counters['cancelled_count'] / total * 100, 1) if total else 0,
+            'completion_rate': round(counters['completed_count'] / total * 100, 1) if total else 0,
+            'no_show_rate': round(counters['no_show_count'] / total * 100, 1) if total else 0
+        })
+    return result
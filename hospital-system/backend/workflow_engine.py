@@ -7,6 +7,11 @@ import json
 from datetime import datetime, timedelta
 from models import Workflow, WorkflowStep, WorkflowExecution, Ticket, User, Notification
 from routes.notification_routes import notify_ticket_assignment, notify_ticket_resolved
+from patient_summary import refresh_patient_summary
+from ticket_dedup import open_ticket_index
+from activity_log import record_changes, snapshot
+from sla_engine import update_sla, set_sla_minutes
+from triage import update_triage_rank
 from flask import current_app
 
 class WorkflowEngine:
@@ -146,8 +151,11 @@ class WorkflowEngine:
         elif assignment_rule == 'specific_user':
             user_id = config.get('user_id')
             if user_id:
+                before = snapshot(ticket)
                 ticket.assigned_to = user_id
                 ticket.status = 'in_progress'
+                record_changes('ticket', ticket, before)
+                refresh_patient_summary(ticket.patient_id, 'tickets')
                 db.session.commit()
                 return True
 
@@ -158,7 +166,12 @@ class WorkflowEngine:
         db = self.get_db()
         new_priority = config.get('priority')
         if new_priority in ['low', 'medium', 'high', 'critical']:
+            before = snapshot(ticket)
             ticket.priority = new_priority
+            record_changes('ticket', ticket, before)
+            update_sla(ticket)
+            update_triage_rank(ticket)
+            refresh_patient_summary(ticket.patient_id, 'tickets')
             db.session.commit()
             return True
         return False
@@ -178,24 +191,40 @@ class WorkflowEngine:
         return True
 
     def _action_set_sla(self, config, ticket):
-        """Set SLA for ticket"""
-        # This would set SLA tracking - implementation depends on SLA model
+        """Set SLA for ticket: a fixed resolution time if configured, otherwise the matching policy"""
+        db = self.get_db()
+        resolution_minutes = config.get('resolution_minutes')
+        if resolution_minutes:
+            set_sla_minutes(ticket, int(resolution_minutes), config.get('warning_percent'))
+        else:
+            update_sla(ticket)
+        db.session.commit()
         return True
 
     def _action_escalate_ticket(self, config, ticket):
         """Escalate ticket"""
         db = self.get_db()
+        before = snapshot(ticket)
         ticket.priority = 'critical'
+        record_changes('ticket', ticket, before)
+        update_sla(ticket)
+        update_triage_rank(ticket)
         # Could also reassign to manager, etc.
+        refresh_patient_summary(ticket.patient_id, 'tickets')
         db.session.commit()
         return True
 
     def _action_auto_close(self, config, ticket):
         """Auto-close ticket"""
         db = self.get_db()
+        before = snapshot(ticket)
         ticket.status = 'closed'
         ticket.resolved_at = datetime.utcnow()
+        record_changes('ticket', ticket, before)
+        update_sla(ticket)
+        refresh_patient_summary(ticket.patient_id, 'tickets')
         db.session.commit()
+        open_ticket_index.update(ticket)
         return True
 
     # Condition implementations